@@ -0,0 +1,9 @@
+"""
+benchmarks for gitback, run from the repository root
+
+    python benchmarks/bench_backup.py --out before.json
+    python benchmarks/bench_hashing.py
+    python benchmarks/bench_chunking.py
+
+treegen makes the reproducible source trees bench_backup runs on.
+"""
@@ -0,0 +1,205 @@
+"""
+time backup_folder and recover on a synthetic tree, as json to compare between commits
+
+Scenarios, in order, on one tree made by treegen:
+
+    first         backup into an empty destination
+    no_change     the same backup again
+    small_change  again after an edit_round, once per --rounds
+    restore       recover the latest snapshot into an empty folder
+
+Each one reports files/s and MB/s of the source tree (of the restored
+files for restore), CPU seconds, peak RSS and the read/write syscall
+counts and bytes of this process from /proc/self/io, so process pool
+compression is not in them.  Indexes are closed between scenarios, as
+between runs.
+
+    python benchmarks/bench_backup.py --out before.json
+    python benchmarks/bench_backup.py --out after.json --compare before.json
+"""
+import argparse
+import contextlib
+import json
+import logging
+import os
+import platform
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+# gitback prints on import, keep stdout for the json
+with contextlib.redirect_stdout(sys.stderr):
+    import gitback  # noqa: E402
+from benchmarks import treegen  # noqa: E402
+
+
+def read_proc_io():
+    counts = {}
+    try:
+        with open("/proc/self/io") as fp:
+            for line in fp:
+                key, val = line.split(":")
+                counts[key.strip()] = int(val)
+    except OSError:
+        pass
+    return counts
+
+
+def reset_peak_rss():
+    # Linux 4.0+ resets VmHWM on "5", elsewhere the peak is of the whole process
+    try:
+        with open("/proc/self/clear_refs", "w") as fp:
+            fp.write("5")
+    except OSError:
+        pass
+
+
+def peak_rss_mb():
+    try:
+        with open("/proc/self/status") as fp:
+            for line in fp:
+                if line.startswith("VmHWM:"):
+                    return round(int(line.split()[1]) / 1024, 1)
+    except OSError:
+        pass
+    return round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)
+
+
+def measure(name, func):
+    """
+    time func, which returns the (files, bytes) it went through
+    """
+    reset_peak_rss()
+    io_start = read_proc_io()
+    ru_start = resource.getrusage(resource.RUSAGE_SELF)
+    start = time.perf_counter()
+    nfiles, nbytes = func()
+    seconds = time.perf_counter() - start
+    ru_end = resource.getrusage(resource.RUSAGE_SELF)
+    io_end = read_proc_io()
+    res = {"scenario": name,
+           "seconds": round(seconds, 3),
+           "files": nfiles,
+           "MB": round(nbytes / 2 ** 20, 2),
+           "files_per_s": round(nfiles / seconds, 1) if seconds > 0 else None,
+           "MB_per_s": round(nbytes / 2 ** 20 / seconds, 1) if seconds > 0 else None,
+           "cpu_s": round(ru_end.ru_utime - ru_start.ru_utime + ru_end.ru_stime - ru_start.ru_stime, 3),
+           "peak_rss_MB": peak_rss_mb()}
+    for key in ("syscr", "syscw", "rchar", "wchar", "read_bytes", "write_bytes"):
+        if key in io_end:
+            res[key] = io_end[key] - io_start.get(key, 0)
+    return res
+
+
+def commit_id():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"],
+                                       cwd=os.path.dirname(os.path.abspath(__file__)),
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(args, folder):
+    src = os.path.join(folder, "src")
+    dst = os.path.join(folder, "dst")
+    tmp = os.path.join(folder, "tmp")
+    out = os.path.join(folder, "restored")
+    tree = treegen.generate(src, tiny=args.tiny, medium=args.medium, huge=args.huge,
+                            huge_mb=args.huge_mb, depth=args.depth,
+                            incompressible=args.incompressible, seed=args.seed)
+    gb = gitback.GitBack(logfilepath=os.path.join(folder, "bench.log"))
+    # console logging would be timed along with the backup
+    logging.getLogger(gitback.__file__).setLevel(logging.WARNING)
+    kwargs = dict(storage=args.storage, workers=args.workers, codec_policy=args.codec)
+
+    def backup():
+        gb.backup_folder(sourceroot=src, destroot=dst, tempfolder=tmp, **kwargs)
+        gb.close_indexes()
+        size = treegen.tree_size(src)
+        return size["files"], size["bytes"]
+
+    def restore():
+        stats = gitback.GitBack.recover(dst, out, workers=args.workers)
+        if stats.errors:
+            raise RuntimeError("restore failed for {0} files".format(len(stats.errors)))
+        return stats.counts.get("files", 0), stats.counts.get("bytes", 0)
+
+    results = [measure("first", backup), measure("no_change", backup)]
+    for rnd in range(args.rounds):
+        edits = treegen.edit_round(src, seed=args.seed * 1000 + rnd, fraction=args.edit_fraction)
+        res = measure("small_change", backup)
+        res["round"] = rnd + 1
+        res["edits"] = edits
+        results.append(res)
+    results.append(measure("restore", restore))
+    return tree, results
+
+
+def compare(results, old_path):
+    with open(old_path) as fp:
+        old = json.load(fp)
+    old_by_name = {}
+    for res in old["results"]:
+        old_by_name.setdefault((res["scenario"], res.get("round")), res)
+    lines = []
+    for res in results:
+        before = old_by_name.get((res["scenario"], res.get("round")))
+        if before is None or not before.get("MB_per_s") or not res.get("MB_per_s"):
+            continue
+        lines.append("{0:14s} {1:8.1f} -> {2:8.1f} MB/s  x{3:5.2f}   rss {4} -> {5} MB".format(
+            res["scenario"] + ("" if res.get("round") is None else " " + str(res["round"])),
+            before["MB_per_s"], res["MB_per_s"], res["MB_per_s"] / before["MB_per_s"],
+            before.get("peak_rss_MB"), res.get("peak_rss_MB")))
+    return lines
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--tiny", type=int, default=2000, help="files of up to 4 KB")
+    parser.add_argument("--medium", type=int, default=100, help="files of up to 1 MB")
+    parser.add_argument("--huge", type=int, default=2)
+    parser.add_argument("--huge-mb", type=float, default=64)
+    parser.add_argument("--depth", type=int, default=6, help="most folder levels")
+    parser.add_argument("--incompressible", type=float, default=0.3, help="share of random files")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--rounds", type=int, default=2, help="small_change runs")
+    parser.add_argument("--edit-fraction", type=float, default=0.01, help="share of files each round edits")
+    parser.add_argument("--storage", choices=["file", "chunked", "packed"], default="file")
+    parser.add_argument("--workers", type=int, default=1)
+    parser.add_argument("--codec", default=None, help="codec name or auto, default deflate")
+    parser.add_argument("--folder", default=None, help="where to make the tree, default a temp folder")
+    parser.add_argument("--keep", action="store_true", help="keep the tree and backup")
+    parser.add_argument("--out", default=None, help="write the json here instead of stdout")
+    parser.add_argument("--compare", default=None, metavar="JSON", help="an earlier --out to compare with")
+    args = parser.parse_args()
+
+    folder = tempfile.mkdtemp(prefix="bench_backup_", dir=args.folder)
+    try:
+        tree, results = run(args, folder)
+    finally:
+        if not args.keep:
+            shutil.rmtree(folder, ignore_errors=True)
+    report = {"commit": commit_id(),
+              "python": platform.python_version(),
+              "platform": platform.platform(),
+              "params": vars(args),
+              "tree": tree,
+              "results": results}
+    text = json.dumps(report, indent=2)
+    if args.out is None:
+        print(text)
+    else:
+        with open(args.out, "w") as fp:
+            fp.write(text + "\n")
+    if args.compare is not None:
+        for line in compare(results, args.compare):
+            print(line, file=sys.stderr if args.out is None else sys.stdout)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,108 @@
+"""
+compare the fixed and gear chunkers on an edited-file corpus
+
+Each base file is followed by edited versions of itself (overwrites,
+inserts and deletes at random offsets), as a backup would see them.
+For every chunker this reports the chunking speed in MB/s and the
+dedup ratio, total bytes over the bytes of distinct chunks.
+
+    python benchmarks/bench_chunking.py --files 4 --size-mb 16 --edits 3
+"""
+import argparse
+import contextlib
+import hashlib
+import io
+import json
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+# gitback prints on import, keep stdout for the json
+with contextlib.redirect_stdout(sys.stderr):
+    from gitback import FixedChunker, GearChunker  # noqa: E402
+
+
+def make_base(rng, size):
+    # half random, half repetitive text, so compressible and not
+    words = [b"backup", b"version", b"chunk", b"index", b"folder", b"file"]
+    nrand = size // 2
+    text = b" ".join(rng.choice(words) for _ in range((size - nrand) // 6 + 1))
+    return bytearray(rng.randbytes(nrand) + text[:size - nrand])
+
+
+def edit(rng, data):
+    data = bytearray(data)
+    for _ in range(rng.randint(1, 5)):
+        kind = rng.choice(["overwrite", "insert", "delete"])
+        pos = rng.randrange(len(data))
+        n = rng.randint(1, 8192)
+        if kind == "overwrite":
+            data[pos:pos + n] = rng.randbytes(len(data[pos:pos + n]))
+        elif kind == "insert":
+            data[pos:pos] = rng.randbytes(n)
+        else:
+            del data[pos:pos + n]
+    return data
+
+
+def make_corpus(nfiles, size, nedits, seed):
+    rng = random.Random(seed)
+    corpus = []
+    for _ in range(nfiles):
+        data = make_base(rng, size)
+        corpus.append(bytes(data))
+        for _ in range(nedits):
+            data = edit(rng, data)
+            corpus.append(bytes(data))
+    return corpus
+
+
+def run(chunker, corpus):
+    seen = {}
+    total = 0
+    nchunks = 0
+    seconds = 0.0
+    for data in corpus:
+        start = time.perf_counter()
+        chunks = list(chunker.chunks(io.BytesIO(data)))
+        seconds += time.perf_counter() - start
+        for chunk in chunks:
+            seen[hashlib.sha256(chunk).digest()] = len(chunk)
+        nchunks += len(chunks)
+        total += len(data)
+    unique = sum(seen.values())
+    return {"chunker": chunker.name,
+            "MB_per_s": round(total / 2 ** 20 / seconds, 1),
+            "chunks": nchunks,
+            "avg_chunk": total // max(nchunks, 1),
+            "total_MB": round(total / 2 ** 20, 2),
+            "stored_MB": round(unique / 2 ** 20, 2),
+            "dedup_ratio": round(total / max(unique, 1), 2)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--files", type=int, default=4)
+    parser.add_argument("--size-mb", type=float, default=16)
+    parser.add_argument("--edits", type=int, default=3, help="edited versions per file")
+    parser.add_argument("--chunk-size", type=int, default=64 * 1024,
+                        help="fixed chunk size, and the gear average chunk size")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--json", action="store_true", help="print results as json")
+    args = parser.parse_args()
+
+    corpus = make_corpus(args.files, int(args.size_mb * 2 ** 20), args.edits, args.seed)
+    results = [run(FixedChunker(args.chunk_size), corpus),
+               run(GearChunker(args.chunk_size), corpus)]
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return
+    for res in results:
+        print("{chunker:6s} {MB_per_s:8.1f} MB/s  {chunks:7d} chunks  avg {avg_chunk:7d}  "
+              "{total_MB:8.2f} MB -> {stored_MB:8.2f} MB  dedup {dedup_ratio:5.2f}x".format(**res))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,94 @@
+"""
+compare FileHasher with the 4 KB read loop across file sizes
+
+For each size a file of random bytes is written to a temp folder and
+hashed --repeat times by each method, from the page cache (every file
+is read once first), so the numbers are the per-call overhead and the
+hashing itself rather than the disk.
+
+    python benchmarks/bench_hashing.py --sizes-mb 0.004 0.1 1 16 256
+"""
+import argparse
+import contextlib
+import hashlib
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+# gitback prints on import, keep stdout for the json
+with contextlib.redirect_stdout(sys.stderr):
+    from gitback import FileHasher, Utilities  # noqa: E402
+
+
+def loop_4k(fpath):
+    return Utilities.sha_256(fpath, size=4096)
+
+
+def engine(fpath):
+    return FileHasher.hexdigest(fpath)
+
+
+def make_file(folder, size):
+    fpath = os.path.join(folder, "file_{0}.bin".format(size))
+    with open(fpath, "wb") as fp:
+        left = size
+        while left > 0:
+            n = min(left, 16 * 2 ** 20)
+            fp.write(os.urandom(n))
+            left -= n
+    return fpath
+
+
+def run(name, func, fpath, size, repeat):
+    func(fpath)
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        digest = func(fpath)
+        seconds = time.perf_counter() - start
+        best = seconds if best is None else min(best, seconds)
+    return {"method": name,
+            "size": size,
+            "strategy": FileHasher.strategy(size) if name == "engine" else "read 4096",
+            "ms": round(best * 1000, 3),
+            "MB_per_s": round(size / 2 ** 20 / best, 1) if best > 0 else None,
+            "digest": digest}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--sizes-mb", type=float, nargs="+",
+                        default=[0.004, 0.1, 1, 16, 128])
+    parser.add_argument("--repeat", type=int, default=3, help="runs per method, the best is kept")
+    parser.add_argument("--folder", default=None, help="where to write the files, default a temp folder")
+    parser.add_argument("--json", action="store_true", help="print results as json")
+    args = parser.parse_args()
+
+    folder = tempfile.mkdtemp(dir=args.folder)
+    results = []
+    try:
+        for size_mb in args.sizes_mb:
+            size = int(size_mb * 2 ** 20)
+            fpath = make_file(folder, size)
+            expected = hashlib.sha256(open(fpath, "rb").read()).hexdigest()
+            for name, func in [("loop_4k", loop_4k), ("engine", engine)]:
+                res = run(name, func, fpath, size, args.repeat)
+                if res.pop("digest") != expected:
+                    raise RuntimeError("{0} gave a wrong digest for {1}".format(name, fpath))
+                results.append(res)
+            os.remove(fpath)
+    finally:
+        shutil.rmtree(folder, ignore_errors=True)
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return
+    for res in results:
+        print("{method:8s} {size:>12d} B  {strategy:10s} {ms:10.3f} ms  {MB_per_s:8.1f} MB/s".format(**res))
+
+
+if __name__ == "__main__":
+    main()
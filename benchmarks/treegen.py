@@ -0,0 +1,152 @@
+"""
+generate reproducible synthetic source trees for the backup benchmarks
+
+A tree has many tiny files, some medium ones and a few huge ones, in
+folders nested up to --depth deep.  A share of the files is random
+bytes, the rest word salad that compresses well.  The same --seed
+always gives the same tree, and edit_round with the same seed the same
+edits, so runs on different commits back up the same bytes.
+
+    python benchmarks/treegen.py /tmp/bench_tree --tiny 2000 --huge 2 --huge-mb 64
+"""
+import argparse
+import json
+import os
+import random
+
+WORDS = [b"backup", b"version", b"chunk", b"index", b"folder", b"file", b"snapshot",
+         b"restore", b"journal", b"digest", b"the", b"a", b"of", b"and", b"to", b"2024",
+         b"error", b"info", b"size", b"path", b"\n"]
+PIECE = 1024 * 1024
+
+
+def text_bytes(rng, size):
+    data = b" ".join(rng.choices(WORDS, k=size // 5 + 1))
+    return data[:size]
+
+
+def file_bytes(rng, size, compressible):
+    if compressible:
+        return text_bytes(rng, size)
+    return rng.randbytes(size)
+
+
+def write_file(rng, fpath, size, compressible):
+    os.makedirs(os.path.dirname(fpath), exist_ok=True)
+    with open(fpath, "wb") as fp:
+        left = size
+        while left > 0:
+            n = min(left, PIECE)
+            fp.write(file_bytes(rng, n, compressible))
+            left -= n
+
+
+def nested_folder(rng, root, depth):
+    parts = ["d{0}".format(rng.randrange(4)) for _ in range(rng.randint(0, depth))]
+    return os.path.join(root, *parts)
+
+
+def generate(root, tiny=2000, tiny_max=4096, medium=100, medium_max=1024 * 1024,
+             huge=2, huge_mb=64, depth=6, incompressible=0.3, seed=1):
+    """
+    write a tree under root, which should not exist yet
+
+    :param tiny: files of 0 to tiny_max bytes
+    :param medium: files of tiny_max to medium_max bytes
+    :param huge: files of huge_mb MB each
+    :param depth: most folder levels under root
+    :param incompressible: share of the files that are random bytes
+    :return: dict with the files and bytes written
+    """
+    if os.path.exists(root):
+        raise ValueError("{0} exists already".format(root))
+    rng = random.Random(seed)
+    sizes = ([rng.randint(0, tiny_max) for _ in range(tiny)]
+             + [rng.randint(tiny_max, medium_max) for _ in range(medium)]
+             + [int(huge_mb * 2 ** 20)] * huge)
+    exts = {True: [".txt", ".log", ".csv", ".dat"], False: [".bin", ".dat", ".jpg"]}
+    total = 0
+    for i, size in enumerate(sizes):
+        compressible = rng.random() >= incompressible
+        folder = nested_folder(rng, root, depth)
+        fpath = os.path.join(folder, "f{0}{1}".format(i, rng.choice(exts[compressible])))
+        write_file(rng, fpath, size, compressible)
+        total += size
+    return {"files": len(sizes), "bytes": total}
+
+
+def tree_files(root):
+    fpaths = []
+    for folder, dirnames, filenames in os.walk(root):
+        dirnames.sort()
+        fpaths.extend(os.path.join(folder, name) for name in sorted(filenames))
+    return fpaths
+
+
+def tree_size(root):
+    fpaths = tree_files(root)
+    return {"files": len(fpaths), "bytes": sum(os.path.getsize(fpath) for fpath in fpaths)}
+
+
+def edit_round(root, seed, fraction=0.01):
+    """
+    one round of an edit history: about fraction of the files get a
+    block overwritten, bytes inserted or appended, a few files are
+    added and a few deleted
+
+    :return: dict of the number of each edit made
+    """
+    rng = random.Random(seed)
+    fpaths = tree_files(root)
+    nedits = max(1, int(len(fpaths) * fraction))
+    counts = {"overwrite": 0, "insert": 0, "append": 0, "add": 0, "delete": 0}
+    for fpath in rng.sample(fpaths, min(nedits, len(fpaths))):
+        kind = rng.choice(["overwrite", "overwrite", "insert", "append"])
+        size = os.path.getsize(fpath)
+        if kind == "overwrite" and size > 0:
+            # in place, as a database or disk image changes
+            with open(fpath, "r+b") as fp:
+                n = min(size, 4096)
+                fp.seek(rng.randrange(size - n + 1))
+                fp.write(rng.randbytes(n))
+        elif kind == "insert" and 0 < size <= 16 * PIECE:
+            with open(fpath, "rb") as fp:
+                data = fp.read()
+            pos = rng.randrange(size)
+            with open(fpath, "wb") as fp:
+                fp.write(data[:pos] + text_bytes(rng, rng.randint(1, 8192)) + data[pos:])
+        else:
+            kind = "append"
+            with open(fpath, "ab") as fp:
+                fp.write(text_bytes(rng, rng.randint(1, 8192)))
+        counts[kind] += 1
+    for i in range(max(1, nedits // 10)):
+        fpath = os.path.join(nested_folder(rng, root, 2), "new_{0}_{1}.txt".format(seed, i))
+        write_file(rng, fpath, rng.randint(0, 4096), True)
+        counts["add"] += 1
+    for fpath in rng.sample(fpaths, min(max(1, nedits // 10), len(fpaths))):
+        if os.path.isfile(fpath):
+            os.remove(fpath)
+            counts["delete"] += 1
+    return counts
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("root", help="folder to create the tree in")
+    parser.add_argument("--tiny", type=int, default=2000)
+    parser.add_argument("--medium", type=int, default=100)
+    parser.add_argument("--huge", type=int, default=2)
+    parser.add_argument("--huge-mb", type=float, default=64)
+    parser.add_argument("--depth", type=int, default=6)
+    parser.add_argument("--incompressible", type=float, default=0.3)
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+    res = generate(args.root, tiny=args.tiny, medium=args.medium, huge=args.huge,
+                   huge_mb=args.huge_mb, depth=args.depth,
+                   incompressible=args.incompressible, seed=args.seed)
+    print(json.dumps(res))
+
+
+if __name__ == "__main__":
+    main()
@@ -2,25 +2,49 @@
 
 import os
 import sys
+import asyncio
+import argparse
+import configparser
 import datetime
 import time
 import inspect
 import warnings
 import traceback
 import hashlib
+import io
 import zlib
+import bz2
+import lzma
 import zipfile
+import contextlib
+import copy
+import struct
+import mmap
 import pickle
+import json
 import shutil
 import re
+import fnmatch
 import logging
 import subprocess
+import sqlite3
+import threading
+import select
+import ctypes
+import ctypes.util
+import itertools
+import concurrent.futures
 from collections import OrderedDict
+from collections import deque
 from collections import namedtuple
 from pathlib import PurePath
 import pandas as pd
 import numpy as np
 from subprocess import Popen, PIPE
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
 print("python exe: {0}".format(sys.executable))
 # import win32api
 
@@ -44,6 +68,9 @@ RESET_SEQ = "\033[0m"
 COLOR_SEQ = "\033[1;%dm"
 BOLD_SEQ = "\033[1m"
 
+# name suffix of files still being written into the backup store
+PARTIAL_EXT = ".partial"
+
 
 def formatter_message(message, use_color=False):
     if use_color:
@@ -169,6 +196,10 @@ class Utilities(object):
     txt_effects["underline"] = "\033[4m"
     txt_effects["blackback"] = "\033[7m"
 
+    # last time handed out by nowshortstr, which never repeats one
+    stamp_lock = threading.Lock()
+    last_stamp = None
+
     @staticmethod
     def setup_logging(outLogName="Out", errLogName="Err",
                       outLevel=logging.INFO, errLevel=logging.ERROR):
@@ -219,9 +250,19 @@ class Utilities(object):
 
     @staticmethod
     def nowshortstr(fmt="%Y%m%d_%H%M%S"):
-        now = datetime.datetime.now()
-        res = now.strftime(fmt) + "_" + str(now.microsecond %  100)
-        return res
+        """
+        time stamp naming versions, journals and snapshots: zero padded
+        microseconds, so names sort in time order, and a microsecond later
+        than the last one handed out if the clock has not moved on, so two
+        names never collide
+        """
+        with Utilities.stamp_lock:
+            now = datetime.datetime.now()
+            last = Utilities.last_stamp
+            if last is not None and now <= last:
+                now = last + datetime.timedelta(microseconds=1)
+            Utilities.last_stamp = now
+        return now.strftime(fmt) + "_" + "{0:06d}".format(now.microsecond)
 
     @staticmethod
     def get_drives():
@@ -388,23 +429,31 @@ class Utilities(object):
     def is_file_binary(filepath,
                        nlines=1000,
                        verbosity=0):
-        try:
-            with open(filepath, "r") as f:
-                for _ in range(nlines):
-                    line = f.readline()
-                    line.lower()
-        except UnicodeDecodeError:
-            return True
-        return False
+        """
+        True unless FileSniffer labels the file "text", from its first
+        few KB; nlines is no longer used
+        """
+        return FileSniffer.classify(filepath) != "text"
 
     @staticmethod
     def sha_256(fpath,
                 fmode='rb',
                 encoding=None,
-                size=4096):
+                size=None,
+                algorithm="sha256"):
+        """
+        hex digest of a file, sha256 unless another algorithm is asked for
+
+        :param size: read size for the plain read loop; None (binary mode)
+            lets FileHasher pick whole reads, readinto or mmap by file size
+        :param algorithm: one of FileHasher.algorithms
+        """
         logger = logging.getLogger(__file__)
-        m = hashlib.sha256()
+        m = FileHasher.new(algorithm)
         try:
+            if size is None and 'b' in fmode:
+                return FileHasher.hexdigest(fpath, algorithm=algorithm)
+            size = size or 4096
             lastchunk = None
             fsize = os.path.getsize(fpath)
             with open(fpath, mode=fmode, encoding=encoding) as fp:
@@ -429,7 +478,7 @@ class Utilities(object):
             logger.warning(errmsg)
             # if tried text, then try binary
             if fmode == 'r':
-                return Utilities.sha_256(fpath, fmode='rb', encoding=None)
+                return Utilities.sha_256(fpath, fmode='rb', encoding=None, algorithm=algorithm)
             else:
                 raise PermissionError(pe)
         except TypeError as te:
@@ -438,7 +487,7 @@ class Utilities(object):
             logger.warning(errmsg)
             if fmode == 'r':
                 # try binary
-                return Utilities.sha_256(fpath, fmode='rb', encoding=None)
+                return Utilities.sha_256(fpath, fmode='rb', encoding=None, algorithm=algorithm)
             raise TypeError(te)
         except OSError as oe:
             errmsg = "fpath: {0}".format(fpath)
@@ -769,237 +818,3283 @@ class Utilities(object):
                 print(f" closed {zipfilepath}  {res}")
         return epath
 
+    @staticmethod
+    def stream_zip(infilepath, zipfilepath,
+                   compresslevel=zlib.Z_DEFAULT_COMPRESSION,
+                   bufsize=1024 * 1024,
+                   rawfilepath=None,
+                   digest=None,
+                   engine=None,
+                   meter=None):
+        """
+        zip one file in a single streaming pass, reading the source once
+        and writing the deflated bytes straight to zipfilepath
 
-# noinspection SpellCheckingInspection,SpellCheckingInspection,PyShadowingNames,PyBroadException
-class GitBack(object):
-    def __init__(self,
-                 logfilepath=None,
-                 loglevel=logging.DEBUG,
-                 dt_fmt="%Y%m%d_%H%M%S",
-                 verbosity=0):
-        self.verbosity = verbosity
-        self.dt_fmt = dt_fmt
-        if logfilepath is None:
-            logfilepath = __name__ + "_" + Utilities.nowstr(fmt=self.dt_fmt) + ".log"
-
-        logger = logging.getLogger(__file__)
-        logger.setLevel(logging.DEBUG)
+        Each buffer read can also feed a digest (e.g. hashlib.sha256())
+        and a raw copy at rawfilepath, so hashing, zipping and copying
+        share the one read.  zipfilepath may be None for just the copy.
 
-        # create console handler and set level to debug
-        ch = logging.StreamHandler()
-        ch.setLevel(logging.DEBUG)
-        #ch.setFormatter(CustomFormatter())
-        # create formatter
-        #formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
-        #formatter = logging.Formatter('%(levelname)s - %(message)s')
+        :param engine: CompressionEngine to deflate on, else done inline
+        :param meter: StageMeter to add the read, compress and write time to
+        :return: (orig_size, comp_size), comp_size is None without a zip
+        """
+        if meter is None:
+            meter = StageMeter()
+        start = time.perf_counter()
+        state = {"crc": 0, "size": 0}
+        with contextlib.ExitStack() as stack:
+            fp = stack.enter_context(open(infilepath, mode="rb"))
+            rawfp = None
+            if rawfilepath is not None:
+                rawfp = stack.enter_context(open(rawfilepath, mode="wb"))
+            writer = None
+            if zipfilepath is not None:
+                zfp = stack.enter_context(open(zipfilepath, mode="wb"))
+                writer = ZipEntryWriter(zfp, zipfile.ZipInfo.from_file(infilepath))
+
+            def read_chunks():
+                while True:
+                    with meter.stage("read"):
+                        chunk = fp.read(bufsize)
+                    if not chunk:
+                        break
+                    state["crc"] = zlib.crc32(chunk, state["crc"])
+                    state["size"] += len(chunk)
+                    if digest is not None:
+                        digest.update(chunk)
+                    if rawfp is not None:
+                        with meter.stage("write"):
+                            rawfp.write(chunk)
+                    yield chunk
+
+            if writer is None:
+                for _ in read_chunks():
+                    pass
+            elif engine is not None:
+                for piece in engine.deflate_chunks(read_chunks(), compresslevel):
+                    with meter.stage("write"):
+                        writer.write(piece)
+            else:
+                comp = zlib.compressobj(compresslevel, zlib.DEFLATED, -15)
+                for chunk in read_chunks():
+                    with meter.stage("compress"):
+                        piece = comp.compress(chunk)
+                    with meter.stage("write"):
+                        writer.write(piece)
+                writer.write(comp.flush())
+            if writer is not None:
+                writer.close(state["crc"], state["size"])
+        comp_size = None
+        if zipfilepath is not None:
+            comp_size = os.path.getsize(zipfilepath)
+        if rawfilepath is not None:
+            shutil.copymode(infilepath, rawfilepath)
+        if engine is not None and writer is not None:
+            # deflated on other processes, the time not spent here was theirs
+            meter.seconds["compress"] += max(0.0, time.perf_counter() - start - sum(meter.seconds.values()))
+        meter.bytes_in += state["size"]
+        meter.bytes_out += (comp_size or 0) + (state["size"] if rawfilepath is not None else 0)
+        return state["size"], comp_size
 
-        # add formatter to ch
-        #ch.setFormatter(formatter)
+    @staticmethod
+    def encode_small(infilepath, zipfilepath, rawfilepath, comp_thresh,
+                     codec="deflate", compresslevel=zlib.Z_DEFAULT_COMPRESSION,
+                     digest=None, meter=None):
+        """
+        read a small file whole, compress it in memory and write only the
+        one worth keeping: the zip (or codec stream) at zipfilepath if its
+        ratio is within comp_thresh, else the raw copy at rawfilepath
 
-        # add ch to logger
-        logger.addHandler(ch)
-        logging.basicConfig(filename=logfilepath, level=loglevel)
+        :return: (orig_size, comp_size, zipped)
+        """
+        if meter is None:
+            meter = StageMeter()
+        with meter.stage("read"):
+            with open(infilepath, mode="rb") as fp:
+                data = fp.read()
+        if digest is not None:
+            digest.update(data)
+        with meter.stage("compress"):
+            if codec == "deflate":
+                buf = io.BytesIO()
+                writer = ZipEntryWriter(buf, zipfile.ZipInfo.from_file(infilepath))
+                comp = zlib.compressobj(compresslevel, zlib.DEFLATED, -15)
+                writer.write(comp.compress(data) + comp.flush())
+                writer.close(zlib.crc32(data), len(data))
+                encoded = buf.getvalue()
+            else:
+                encoded = Codecs.compress(codec, data, compresslevel)
+        zipped = len(data) > 0 and float(len(encoded)) / len(data) <= comp_thresh
+        with meter.stage("write"):
+            with open(zipfilepath if zipped else rawfilepath, mode="wb") as fp:
+                fp.write(encoded if zipped else data)
+        if not zipped:
+            shutil.copymode(infilepath, rawfilepath)
+        meter.bytes_in += len(data)
+        meter.bytes_out += len(encoded) if zipped else len(data)
+        return len(data), len(encoded), zipped
 
-    def backup_folders(self, folders=None,
-                       dest_drive=None,
-                       dest_folder=None,
-                       temp_folder=None,
-                       exclude_folders=None,
-                       include_exts=None,
-                       exclude_exts=None,
-                       verbosity=0):
+    @staticmethod
+    def probe_compressibility(filepath,
+                              compresslevel=zlib.Z_DEFAULT_COMPRESSION,
+                              block_size=64 * 1024,
+                              nblocks=3):
         """
-        try to backup folders to a destination
+        estimate the compression ratio from a few sampled blocks
+        (head, middle and tail) instead of compressing the whole file
 
-        :param folders: list of folders to backup
-        :param dest_drive: destination drive
-        :param dest_folder: destination root directory
-        :param temp_folder: for temp files
-        :param exclude_folders: folder names to exclude
-        :param include_exts: extensions to include
-        :param exclude_exts: extensions to exclude
-        :param verbosity: level of diagnostics
-        :return: 0 on success
+        :return: estimated comp_size / orig_size, or None if the file is
+            so small the sample would be the whole file
         """
+        fsize = os.path.getsize(filepath)
+        if fsize <= nblocks * block_size:
+            return None
+        step = (fsize - block_size) / max(nblocks - 1, 1)
+        orig_size = 0
+        comp_size = 0
+        with open(filepath, mode="rb") as fp:
+            for i in range(nblocks):
+                fp.seek(int(i * step))
+                block = fp.read(block_size)
+                orig_size += len(block)
+                comp_size += len(zlib.compress(block, compresslevel))
+        return float(comp_size) / orig_size
 
-        ldict = locals()
-        verbosity = max(self.verbosity, verbosity)
-        logger = logging.getLogger(__file__)
-        Utilities.check_folders(folders)
-        errmsg = ''
-        req_param_types = {"folders": list,
-                           "dest_drive": str,
-                           "dest_folder": str}
-        for pname in req_param_types.keys():
-            ptype = req_param_types[pname]
-            val = ldict[pname]
-            if val is None:
-                errmsg += "No {0} specified".format(pname)
-            elif not isinstance(val, ptype):
-                errmsg += "{0} should be {1}, got {2}".format(pname, ptype, type(val))
-        if len(errmsg) > 0:
-            raise RuntimeError(errmsg)
+    @staticmethod
+    def copy_atomic(sourcepath, destpath):
+        """
+        copy to a ".partial" name next to destpath, then rename into place,
+        so destpath is never seen half written
+        """
+        partialpath = destpath + PARTIAL_EXT
+        try:
+            shutil.copy(sourcepath, partialpath)
+            os.replace(partialpath, destpath)
+        except Exception:
+            if os.path.isfile(partialpath):
+                os.remove(partialpath)
+            raise
+        return destpath
 
-        msg = "Backup starting {0}".format(datetime.datetime.now())
-        logger.info(msg)
-        
-        for folder in folders:
-            if not os.path.isdir(folder):
-                msg = "'{0}' not a folder".format(folder)
+    @staticmethod
+    def sha_256_zipped(zipfilepath, size=1024 * 1024):
+        """
+        sha256 of the single file inside a backup zip, read straight
+        from the archive so nothing is extracted to a temp folder
+        """
+        m = hashlib.sha256()
+        with zipfile.ZipFile(zipfilepath, mode='r') as zfile:
+            zinfolist = zfile.infolist()
+            if len(zinfolist) != 1:
+                zlen = len(zinfolist)
+                msg = "file = {0}, zinfolist len= {1}, should be 1".format(zipfilepath, zlen)
                 raise ValueError(msg)
-            pp = PurePath(folder)
-            less_drive = os.sep.join(pp.parts[1:])
-
-            destroot = os.path.join(dest_drive, dest_folder)
-            if verbosity > 0:
-                msg = "Source folder= {0}".format(folder)
-                msg += "\nSource less drive: {0}".format(less_drive)
-                msg += "\nDest root: {0}".format(destroot)
-                logger.info(msg)
-            try:
-                self.backup_folder(sourceroot=folder,
-                                   destroot=destroot,
-                                   exclude_exts=exclude_exts,
-                                   exclude_folders=exclude_folders,
-                                   tempfolder=temp_folder,
-                                   testing=False,
-                                   verbosity=verbosity)
-            except PermissionError as e:
-                msg = Utilities.last_exception_info(verbose=verbosity)
-                warnings.warn(msg)
-                raise PermissionError(msg)
-            except Exception as e:
-                msg = Utilities.last_exception_info(verbose=verbosity)
-                logger.error(msg)
-                warnings.warn(e)
-            else:
-                msg = "Seems ok {0}".format(datetime.datetime.now())
-                logger.info(msg)
-        return 0
+            with zfile.open(zinfolist[0], mode='r') as fp:
+                for chunk in iter(lambda: fp.read(size), b''):
+                    m.update(chunk)
+        return m.hexdigest()
 
     @staticmethod
-    def clean_temp_folder(tempfolder, verbosity=0):
+    def scan_tree(root, exclude_folders=None, verbosity=0):
+        """
+        walk a folder tree with os.scandir, one folder at a time
+
+        Folders named in exclude_folders are dropped before they are
+        entered, so nothing under them is listed.  Like os.walk, links to
+        folders are not followed and unreadable folders are skipped.
+
+        :param root: top of the tree
+        :param exclude_folders: folder names to leave out
+        :return: generator of (folder, list of os.DirEntry of its files);
+            entry.stat() is cached, so each file is stat'ed once
+        """
         logger = logging.getLogger(__file__)
-        if verbosity > 0:
-            msg = f"{Utilities.whoami()} <{Utilities.now()}>"
-            logger.info(msg)
-        tempfiles = os.listdir(tempfolder)
-        for tfile in tempfiles:
+        exclude = set(exclude_folders or [])
+        if any(part in exclude for part in PurePath(root).parts):
+            return
+        stack = [root]
+        while len(stack) > 0:
+            folder = stack.pop()
+            files = []
+            subfolders = []
             try:
-                tpath = os.path.join(tempfolder, tfile)
-
-                if os.path.isfile(tpath):
-                    if verbosity > 0:
-                        msg = f"   file {tempfolder}  {tfile}"
-                        logger.info(msg)
-                    os.remove(os.path.join(tempfolder, tfile))
-                elif os.path.isdir(tpath):
-                    if verbosity > 0:
-                        msg = f"  folder {tempfolder}  {tfile}"
-                        logger.info(msg)
-                    shutil.rmtree(tpath)
-            except Exception as e:
-                msg = f"  Error deleting File: {tpath}"
+                with os.scandir(folder) as it:
+                    for entry in it:
+                        try:
+                            is_dir = entry.is_dir()
+                        except OSError:
+                            is_dir = False
+                        if not is_dir:
+                            files.append(entry)
+                        elif entry.name in exclude:
+                            if verbosity > 0:
+                                logger.info("skipping {0} due to exclude_folders".format(entry.path))
+                        elif not entry.is_symlink():
+                            subfolders.append(entry.path)
+            except OSError:
+                msg = "could not list {0}".format(folder)
                 msg += Utilities.last_exception_info()
-                msg += Utilities.nowstr()
-                logger = logging.getLogger(__file__)
-                logger.error(msg)
-                raise RuntimeError(msg)
+                logger.warning(msg)
+                continue
+            yield folder, files
+            # depth first, subfolders in listing order
+            stack.extend(reversed(subfolders))
 
     @staticmethod
-    def make_temp_folder(tempfolder, exclude_folders=None, verbosity=0):
-        try:
-            if tempfolder is None:
-                tempfoldername = "zztemp"
-                tempfolder = os.path.join(os.path.splitext(__file__)[0], tempfoldername)
-                if exclude_folders is None:
-                    exclude_folders = []
-                exclude_folders.append(tempfoldername)
-            if not os.path.isdir(tempfolder):
-                os.makedirs(tempfolder)
+    def scan_paths(paths):
+        """
+        some files, grouped by folder, in the form scan_tree gives them
 
-            tempfiles = os.listdir(tempfolder)
-            for tfile in tempfiles:
-                try:
-                    tpath = os.path.join(tempfolder, tfile)
-                    if os.path.isfile(tpath):
-                        os.remove(os.path.join(tempfolder, tfile))
-                    elif os.path.isdir(tpath):
-                        shutil.rmtree(tpath)
-                except:
-                    msg = Utilities.last_exception_info()
-                    print(msg)
-                    raise RuntimeError(msg)
-            return tempfolder
-        except Exception as e:
-            msg = Utilities.last_exception_info()
-            logger.warning(msg)
-            RuntimeError(e)
+        :param paths: file paths
+        :return: generator of (folder, list of os.DirEntry); paths that are
+            gone or are folders are left out
+        """
+        by_folder = OrderedDict()
+        for path in paths:
+            by_folder.setdefault(os.path.dirname(path), set()).add(os.path.basename(path))
+        for folder, names in by_folder.items():
+            try:
+                with os.scandir(folder) as it:
+                    entries = [e for e in it if e.name in names and not e.is_dir()]
+            except OSError:
+                continue
+            if len(entries) > 0:
+                yield folder, entries
 
-    def backup_folder(self, sourceroot,
-                      destroot,
-                      tempfolder=None,
-                      exclude_folders=None,
-                      include_exts=None,
-                      exclude_exts=None,
-                      dt_fmt='%Y-%m-%dT%H:%M:%S',
-                      comp_thresh=0.9,
-                      compression=zipfile.ZIP_DEFLATED,
-                      compresslevel=zlib.Z_DEFAULT_COMPRESSION,
-                      testing=False,
-                      verbosity=0):
+    @staticmethod
+    def read_meta_txt(meta_file_path):
+        """
+        read a meta_files/*.txt written by GitBack.backup_file
 
+        :param meta_file_path: path to the meta txt file
+        :return: OrderedDict of the "key: value" lines
         """
-        try to make a backup of a single folder
-        :param sourceroot: original (source) path
-        :param destroot: destination path
-        :param tempfolder: folder for temp files
-        :param include_exts: file extensions to include
-        :param exclude_exts: file extensions to exclude
-        :param dt_fmt: format for dates
-        :param comp_thresh: threshold for compression
-            if compression ratio less than this then don't compress
-        :param compression: method for compression
-        :param compresslevel: level of compression
-        :param testing: switch for just testing process
-        :param verbosity: level of diagnostics
-        :return: 0 on success
+        meta_dict = OrderedDict()
+        with open(meta_file_path, mode="r", encoding="UTF-8") as fp:
+            for line in fp:
+                line = line.rstrip("\n")
+                if ": " not in line:
+                    continue
+                key, val = line.split(": ", 1)
+                meta_dict[key] = val
+        return meta_dict
+
+
+class FileHasher(object):
+    """
+    hashes whole files with few python level calls, by file size
+
+    Files under small_size are read in one call, files of mmap_size and
+    more are mapped and fed to the digest in block_size views, the rest
+    are read with readinto into a reusable per-thread buffer.  hashlib
+    releases the GIL on large updates, so worker threads hash in parallel.
+
+    The identity digest is "sha256" or "blake2b" (256 bit, faster on CPUs
+    without SHA instructions); the index records which one made each
+    digest.  prefilter is a cheap fingerprint that can prove two files
+    differ without reading them whole.
+    """
+    small_size = 1024 * 1024
+    mmap_size = 64 * 1024 * 1024
+    block_size = 8 * 1024 * 1024
+    prefilter_block = 64 * 1024
+    algorithms = OrderedDict([("sha256", hashlib.sha256),
+                              ("blake2b", lambda data=b"": hashlib.blake2b(data, digest_size=32))])
+    local = threading.local()
+
+    @staticmethod
+    def new(algorithm="sha256", data=b""):
         """
-        argdict = locals().copy()
-        verbosity = max(verbosity, self.verbosity)
-        logger = logging.getLogger(__file__)
-        if verbosity > 0:
-            msg = "{0} <{1}>".format(Utilities.whoami(), Utilities.now())
-            for key in argdict.keys():
-                msg += "\n  {0}: {1}".format(key, argdict[key])
-            logger.info(msg)
+        :return: a hashlib object for algorithm, fed with data
+        """
+        if algorithm not in FileHasher.algorithms:
+            msg = "digest algorithm should be one of {0}, got {1}".format(
+                list(FileHasher.algorithms.keys()), algorithm)
+            raise ValueError(msg)
+        return FileHasher.algorithms[algorithm](data)
 
-        tempfolder = GitBack.make_temp_folder(tempfolder=tempfolder,
-                                              exclude_folders=exclude_folders,
-                                              verbosity=verbosity)
-        # process include_exts and exclude_exts
-        for xname in ('include_exts', 'exclude_exts'):
-            x = argdict[xname]
-            if isinstance(x, str):
-                x = [x]
-            if isinstance(x, list):
-                if len(x) == 0:
-                    x = None
-            elif x is not None:
-                raise ValueError("{0} should be None or string or list of strings")
-            if verbosity > 1:
-                logger.info("{0}: {1}".format(xname, x))
-            locals()[xname] = x
+    @staticmethod
+    def buffer():
+        buf = getattr(FileHasher.local, "buf", None)
+        if buf is None:
+            buf = FileHasher.local.buf = bytearray(FileHasher.block_size)
+        return buf
 
-        pp_sourceroot = PurePath(sourceroot)
-        if not pp_sourceroot.is_absolute():
-            logger.warning("sourceroot must be absolute, {0}".format(sourceroot))
+    @staticmethod
+    def strategy(size):
+        if size < FileHasher.small_size:
+            return "read"
+        if size >= FileHasher.mmap_size:
+            return "mmap"
+        return "readinto"
 
-        pp_destroot = PurePath(destroot)
-        if not pp_destroot.is_absolute():
-            logger.warning("destroot must be absolute, {0}".format(destroot))
+    @staticmethod
+    def update(digests, fpath):
+        """
+        feed the contents of fpath into a digest, or a list of digests
+        in the same pass
 
-        if (sourceroot == destroot) or (pp_sourceroot == pp_destroot):
+        :return: number of bytes hashed
+        """
+        if not isinstance(digests, (list, tuple)):
+            digests = [digests]
+        with open(fpath, mode="rb") as fp:
+            strategy = FileHasher.strategy(os.fstat(fp.fileno()).st_size)
+            if strategy == "read":
+                data = fp.read()
+                for digest in digests:
+                    digest.update(data)
+                return len(data)
+            if strategy == "mmap":
+                try:
+                    mm = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+                except (OSError, ValueError):
+                    # not mappable (a special file, or truncated since the stat)
+                    strategy = "readinto"
+                else:
+                    with mm, memoryview(mm) as view:
+                        for pos in range(0, len(view), FileHasher.block_size):
+                            for digest in digests:
+                                digest.update(view[pos:pos + FileHasher.block_size])
+                        return len(view)
+            buf = FileHasher.buffer()
+            total = 0
+            with memoryview(buf) as view:
+                while True:
+                    n = fp.readinto(buf)
+                    if not n:
+                        break
+                    for digest in digests:
+                        digest.update(view[:n])
+                    total += n
+            return total
+
+    @staticmethod
+    def hexdigest(fpath, algorithm="sha256"):
+        digest = FileHasher.new(algorithm)
+        FileHasher.update(digest, fpath)
+        return digest.hexdigest()
+
+    @staticmethod
+    def hexdigests(fpath, algorithms):
+        """
+        :return: OrderedDict algorithm -> hex digest, from one read of fpath
+        """
+        digests = OrderedDict((algorithm, FileHasher.new(algorithm)) for algorithm in algorithms)
+        FileHasher.update(list(digests.values()), fpath)
+        return OrderedDict((algorithm, digest.hexdigest()) for algorithm, digest in digests.items())
+
+    @staticmethod
+    def prefilter(fpath, data=None):
+        """
+        size plus a hash of the first and last prefilter_block bytes:
+        files with different prefilters differ, equal ones still need
+        the full digest to tell
+
+        :param data: the contents of fpath, if already read
+        """
+        block = FileHasher.prefilter_block
+        m = hashlib.blake2b(digest_size=16)
+        if data is not None:
+            m.update(struct.pack("<Q", len(data)))
+            if len(data) <= 2 * block:
+                m.update(data)
+            else:
+                m.update(data[:block])
+                m.update(data[-block:])
+            return m.hexdigest()
+        with open(fpath, mode="rb") as fp:
+            size = os.fstat(fp.fileno()).st_size
+            m.update(struct.pack("<Q", size))
+            if size <= 2 * block:
+                m.update(fp.read())
+            else:
+                m.update(fp.read(block))
+                fp.seek(size - block)
+                m.update(fp.read(block))
+        return m.hexdigest()
+
+
+class PrefilterTap(object):
+    """
+    a digest that also keeps the size, head and tail of what it is fed,
+    so the pass that hashes a file gives its FileHasher.prefilter as well
+    without reading the file again
+    """
+
+    def __init__(self, digest):
+        self.digest = digest
+        self.name = digest.name
+        self.size = 0
+        self.head = bytearray()
+        self.tail = bytearray()
+
+    def update(self, data):
+        self.digest.update(data)
+        block = FileHasher.prefilter_block
+        if len(self.head) < 2 * block:
+            self.head += data[:2 * block - len(self.head)]
+        self.tail += data[-block:]
+        if len(self.tail) > 2 * block:
+            del self.tail[:-block]
+        self.size += len(data)
+
+    def hexdigest(self):
+        return self.digest.hexdigest()
+
+    def prefilter(self):
+        """
+        :return: FileHasher.prefilter of the contents fed so far
+        """
+        block = FileHasher.prefilter_block
+        m = hashlib.blake2b(digest_size=16)
+        m.update(struct.pack("<Q", self.size))
+        if self.size <= 2 * block:
+            m.update(self.head)
+        else:
+            m.update(self.head[:block])
+            m.update(self.tail[-block:])
+        return m.hexdigest()
+
+
+class FileSniffer(object):
+    """
+    labels a file from its first header_size bytes, one small read
+
+    Magic signatures at the start of the file tell "media" (formats that
+    are compressed already: images, audio, video), "archive" (compressed
+    archives) and "executable".  Anything else is "text" when the header
+    has no NUL bytes and few control bytes, counting bytes >= 0x80 as text
+    when they decode as UTF-8, and "binary" otherwise.  The engine stores
+    media and archives without compressing or chunking them.
+    """
+    header_size = 4096
+    # share of odd bytes above which a header is not text
+    max_odd = 0.3
+    # (offset, magic, label), the first match wins
+    signatures = [
+        (0, b"\xff\xd8\xff", "media"),                 # jpeg
+        (0, b"\x89PNG\r\n\x1a\n", "media"),
+        (0, b"GIF87a", "media"),
+        (0, b"GIF89a", "media"),
+        (8, b"WEBP", "media"),
+        (8, b"AVI ", "media"),
+        (4, b"ftyp", "media"),                         # mp4, m4a, mov, heic
+        (0, b"\x1a\x45\xdf\xa3", "media"),             # mkv, webm
+        (0, b"ID3", "media"),                          # mp3
+        (0, b"\xff\xfb", "media"),
+        (0, b"OggS", "media"),
+        (0, b"fLaC", "media"),
+        (0, b"PK\x03\x04", "archive"),                 # zip, docx, xlsx, jar
+        (0, b"PK\x05\x06", "archive"),
+        (0, b"\x1f\x8b", "archive"),                    # gzip
+        (0, b"BZh", "archive"),
+        (0, b"\xfd7zXZ\x00", "archive"),
+        (0, b"\x28\xb5\x2f\xfd", "archive"),             # zstd
+        (0, b"7z\xbc\xaf\x27\x1c", "archive"),
+        (0, b"Rar!\x1a\x07", "archive"),
+        (0, b"\x7fELF", "executable"),
+        (0, b"MZ", "executable"),
+        (0, b"\xcf\xfa\xed\xfe", "executable"),          # mach-o
+        (0, b"\xce\xfa\xed\xfe", "executable"),
+        (0, b"\xca\xfe\xba\xbe", "executable"),          # fat mach-o, java class
+        (0, b"\x00asm", "executable"),
+    ]
+    boms = (b"\xef\xbb\xbf", b"\xff\xfe", b"\xfe\xff")
+    # control bytes found in text
+    text_controls = b"\t\n\r\f\b\x1b"
+    uncompressible = ("media", "archive")
+
+    @staticmethod
+    def classify_bytes(header):
+        """
+        :return: "text", "media", "archive", "executable" or "binary"
+        """
+        for offset, magic, label in FileSniffer.signatures:
+            if header[offset:offset + len(magic)] == magic:
+                return label
+        if not header or header.startswith(FileSniffer.boms):
+            return "text"
+        if b"\x00" in header:
+            return "binary"
+        try:
+            header.decode("utf-8")
+            utf8 = True
+        except UnicodeDecodeError as exc:
+            # a character cut by the end of the header is fine
+            utf8 = exc.start >= len(header) - 3 and exc.reason == "unexpected end of data"
+        odd = header.translate(None, bytes(range(32, 127)) + FileSniffer.text_controls)
+        if utf8:
+            odd = odd.translate(None, bytes(range(128, 256)))
+        return "text" if len(odd) <= FileSniffer.max_odd * len(header) else "binary"
+
+    @staticmethod
+    def classify(filepath):
+        with open(filepath, "rb") as fp:
+            return FileSniffer.classify_bytes(fp.read(FileSniffer.header_size))
+
+
+class BackupIndex(object):
+    """
+    persistent index of the versions stored under one backup root
+
+    An sqlite database in the backup root maps source path and version
+    to sha256, size, mode and stored path, so "is this content already
+    stored?" is one indexed lookup instead of unzipping and re-hashing
+    every earlier version.  The index can be rebuilt from the run journals.
+    The sha256 column holds the digest made by the version's algorithm,
+    so stores hashed with different FileHasher algorithms mix.
+
+    It also learns how well contents compress: the compressed size each
+    content hash reached, and per extension and codec a histogram of the
+    ratios seen, so zipped_or_orig can skip the trial for known contents
+    and decide up front for files of a type that always, or never, compresses.
+    """
+    dbname = "backup_index.sqlite"
+    # ratio histogram buckets of 1 / hist_buckets, the last one for >= 1
+    hist_buckets = 10
+    # samples an extension needs before its histogram decides
+    hist_min_samples = 20
+    # share of the samples that must agree for the histogram to decide
+    hist_agree = 0.95
+
+    def __init__(self, destroot, commit_every=100, verbosity=0):
+        self.destroot = destroot
+        self.dbpath = os.path.join(destroot, BackupIndex.dbname)
+        self.commit_every = commit_every
+        self.verbosity = verbosity
+        self.pending = 0
+        self.lock = threading.RLock()
+        # sourcepath -> stat key, once warm() has loaded file_state
+        self.state_cache = None
+        # (ext, codec) -> bucket counts, loaded on first use
+        self.hist_cache = None
+        Utilities.check_make_path(destroot, verbosity=verbosity)
+        self.created = not os.path.isfile(self.dbpath)
+        self.conn = sqlite3.connect(self.dbpath, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.create_tables()
+
+    def create_tables(self):
+        with self.lock:
+            self.conn.execute("""
+                CREATE TABLE IF NOT EXISTS versions (
+                    id INTEGER PRIMARY KEY,
+                    sourcepath TEXT NOT NULL,
+                    version TEXT NOT NULL,
+                    sha256 TEXT NOT NULL,
+                    size INTEGER,
+                    mode TEXT,
+                    stored_path TEXT,
+                    ctime TEXT,
+                    mtime TEXT,
+                    filename TEXT,
+                    algorithm TEXT DEFAULT 'sha256',
+                    prefilter TEXT,
+                    UNIQUE (sourcepath, version))""")
+            columns = [row[1] for row in self.conn.execute("PRAGMA table_info(versions)")]
+            if "filename" not in columns:
+                # indexes from before lookups by file name
+                self.conn.create_function("basename", 1, os.path.basename)
+                self.conn.execute("ALTER TABLE versions ADD COLUMN filename TEXT")
+                self.conn.execute("UPDATE versions SET filename = basename(sourcepath)")
+            if "algorithm" not in columns:
+                # indexes from before pluggable digests, all sha256
+                self.conn.execute("ALTER TABLE versions ADD COLUMN algorithm TEXT DEFAULT 'sha256'")
+                self.conn.execute("ALTER TABLE versions ADD COLUMN prefilter TEXT")
+            self.conn.execute("""
+                CREATE INDEX IF NOT EXISTS versions_path_sha
+                    ON versions (sourcepath, sha256)""")
+            self.conn.execute("""
+                CREATE INDEX IF NOT EXISTS versions_filename
+                    ON versions (filename)""")
+            self.conn.execute("""
+                CREATE INDEX IF NOT EXISTS versions_sha
+                    ON versions (sha256)""")
+            self.conn.execute("""
+                CREATE INDEX IF NOT EXISTS versions_size
+                    ON versions (size)""")
+            # stat of each source file at its last successful backup
+            self.conn.execute("""
+                CREATE TABLE IF NOT EXISTS file_state (
+                    sourcepath TEXT PRIMARY KEY,
+                    size INTEGER,
+                    mtime_ns INTEGER,
+                    inode INTEGER,
+                    ctime_ns INTEGER,
+                    sha256 TEXT)""")
+            # chunks held by the ChunkStore
+            self.conn.execute("""
+                CREATE TABLE IF NOT EXISTS chunks (
+                    hash TEXT PRIMARY KEY,
+                    size INTEGER,
+                    stored_size INTEGER)""")
+            # data entries of the PackStore, where each one starts
+            self.conn.execute("""
+                CREATE TABLE IF NOT EXISTS pack_entries (
+                    key TEXT PRIMARY KEY,
+                    pack TEXT NOT NULL,
+                    offset INTEGER NOT NULL,
+                    length INTEGER,
+                    codec TEXT,
+                    size INTEGER)""")
+            # compressed size reached by each content, comp_size is an
+            #  estimate from the probe when the file was stored untried
+            self.conn.execute("""
+                CREATE TABLE IF NOT EXISTS compressibility (
+                    hash TEXT NOT NULL,
+                    algorithm TEXT NOT NULL,
+                    prefilter TEXT,
+                    size INTEGER,
+                    comp_size INTEGER,
+                    codec TEXT,
+                    PRIMARY KEY (hash, algorithm))""")
+            self.conn.execute("""
+                CREATE INDEX IF NOT EXISTS compressibility_prefilter
+                    ON compressibility (prefilter)""")
+            self.conn.execute("""
+                CREATE TABLE IF NOT EXISTS ext_compressibility (
+                    ext TEXT NOT NULL,
+                    codec TEXT NOT NULL,
+                    bucket INTEGER NOT NULL,
+                    count INTEGER,
+                    PRIMARY KEY (ext, codec, bucket))""")
+            self.conn.commit()
+
+    def relpath(self, path):
+        # stored paths are kept relative so the store can change drive letter
+        return os.path.relpath(path, self.destroot)
+
+    def abspath(self, stored_path):
+        return os.path.join(self.destroot, stored_path)
+
+    def find_version(self, sourcepath, sha256):
+        """
+        :param sourcepath: path of the source file
+        :param sha256: hex digest of the source file contents
+        :return: absolute path of a stored version with the same contents or None
+        """
+        with self.lock:
+            row = self.conn.execute("""
+                SELECT stored_path FROM versions
+                    WHERE sourcepath = ? AND sha256 = ?
+                    LIMIT 1""", (sourcepath, sha256)).fetchone()
+        if row is None:
+            return None
+        return self.abspath(row[0])
+
+    def find_by_hash(self, sha256):
+        """
+        look for the contents under any source path, for store wide dedup
+
+        :param sha256: hex digest of the contents
+        :return: (absolute stored path, mode) of a stored version or None
+        """
+        with self.lock:
+            row = self.conn.execute("""
+                SELECT stored_path, mode FROM versions
+                    WHERE sha256 = ?
+                    LIMIT 1""", (sha256,)).fetchone()
+        if row is None:
+            return None
+        return self.abspath(row[0]), row[1]
+
+    def has_size(self, size):
+        """
+        True if some stored version has this size, a cheap hint that
+        hashing first may find the contents stored under another path
+        """
+        with self.lock:
+            row = self.conn.execute("""
+                SELECT 1 FROM versions WHERE size = ? LIMIT 1""", (size,)).fetchone()
+        return row is not None
+
+    def candidate_algorithms(self, size, prefilter=None, sourcepath=None):
+        """
+        the digest algorithms of the stored versions that could hold
+        the same contents: same size and, where both are known, same
+        prefilter.  An empty list proves the contents are not stored.
+
+        :param sourcepath: only look at versions of this path
+        """
+        query = """
+            SELECT DISTINCT algorithm FROM versions
+                WHERE (size = ? OR size IS NULL)
+                    AND (prefilter IS NULL OR ? IS NULL OR prefilter = ?)"""
+        params = (size, prefilter, prefilter)
+        if sourcepath is not None:
+            query += " AND sourcepath = ?"
+            params += (sourcepath,)
+        with self.lock:
+            rows = self.conn.execute(query, params).fetchall()
+        return [row[0] or "sha256" for row in rows]
+
+    def add_version(self, sourcepath, version, sha256, size, mode,
+                    stored_path, ctime=None, mtime=None,
+                    algorithm="sha256", prefilter=None):
+        with self.lock:
+            self.conn.execute("""
+                INSERT OR REPLACE INTO versions
+                    (sourcepath, version, sha256, size, mode, stored_path, ctime, mtime, filename,
+                     algorithm, prefilter)
+                    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)""",
+                              (sourcepath, version, sha256, size, mode,
+                               self.relpath(stored_path), ctime, mtime,
+                               os.path.basename(sourcepath), algorithm, prefilter))
+            self.pending += 1
+            if self.pending >= self.commit_every:
+                self.flush()
+
+    @staticmethod
+    def stat_key(st):
+        return st.st_size, st.st_mtime_ns, st.st_ino, st.st_ctime_ns
+
+    def unchanged(self, sourcepath, st):
+        """
+        quick check: True if (size, mtime_ns, inode, ctime) match the
+        values recorded at the last successful backup of sourcepath
+        """
+        with self.lock:
+            if self.state_cache is not None:
+                return self.state_cache.get(sourcepath) == BackupIndex.stat_key(st)
+            row = self.conn.execute("""
+                SELECT size, mtime_ns, inode, ctime_ns FROM file_state
+                    WHERE sourcepath = ?""", (sourcepath,)).fetchone()
+        if row is None:
+            return False
+        return tuple(row) == BackupIndex.stat_key(st)
+
+    def likely_stored(self, sourcepath, st):
+        """
+        True if the contents are probably already stored: the stat is
+        unchanged (a paranoid re-check), or the path has versions but no
+        recorded stat (an index rebuilt from meta_files)
+        """
+        with self.lock:
+            if self.state_cache is not None:
+                row = self.state_cache.get(sourcepath)
+            else:
+                row = self.conn.execute("""
+                    SELECT size, mtime_ns, inode, ctime_ns FROM file_state
+                        WHERE sourcepath = ?""", (sourcepath,)).fetchone()
+            if row is not None:
+                return tuple(row) == BackupIndex.stat_key(st)
+            row = self.conn.execute("""
+                SELECT 1 FROM versions WHERE sourcepath = ? LIMIT 1""",
+                                    (sourcepath,)).fetchone()
+        return row is not None
+
+    def warm(self):
+        """
+        load file_state into memory, so a long running process answers
+        the quick check without a query per file; set_state keeps it current
+        """
+        with self.lock:
+            if self.state_cache is None:
+                rows = self.conn.execute("""
+                    SELECT sourcepath, size, mtime_ns, inode, ctime_ns FROM file_state""")
+                self.state_cache = {row[0]: tuple(row[1:]) for row in rows}
+        return len(self.state_cache)
+
+    def set_state(self, sourcepath, st, sha256):
+        with self.lock:
+            self.conn.execute("""
+                INSERT OR REPLACE INTO file_state
+                    (sourcepath, size, mtime_ns, inode, ctime_ns, sha256)
+                    VALUES (?, ?, ?, ?, ?, ?)""",
+                              (sourcepath,) + BackupIndex.stat_key(st) + (sha256,))
+            if self.state_cache is not None:
+                self.state_cache[sourcepath] = BackupIndex.stat_key(st)
+            self.pending += 1
+            if self.pending >= self.commit_every:
+                self.flush()
+
+    def known_ratio(self, content_hash=None, algorithm="sha256", prefilter=None):
+        """
+        compression ratio learned for these contents, looked up by hash,
+        or by prefilter when the hash is not known yet
+
+        :return: comp_size / size, or None if the contents are new
+        """
+        with self.lock:
+            row = None
+            if content_hash is not None:
+                row = self.conn.execute("""
+                    SELECT size, comp_size FROM compressibility
+                        WHERE hash = ? AND algorithm = ?""", (content_hash, algorithm)).fetchone()
+            if row is None and prefilter is not None:
+                row = self.conn.execute("""
+                    SELECT size, comp_size FROM compressibility
+                        WHERE prefilter = ? LIMIT 1""", (prefilter,)).fetchone()
+        if row is None or not row[0] or row[1] is None:
+            return None
+        return float(row[1]) / row[0]
+
+    def ext_histogram(self, ext, codec):
+        with self.lock:
+            if self.hist_cache is None:
+                self.hist_cache = {}
+                rows = self.conn.execute("""
+                    SELECT ext, codec, bucket, count FROM ext_compressibility""")
+                for ext_, codec_, bucket, count in rows:
+                    counts = self.hist_cache.setdefault((ext_, codec_), [0] * (self.hist_buckets + 1))
+                    counts[bucket] = count
+            return self.hist_cache.get((ext.lower(), codec))
+
+    def learn_ratio(self, ext, codec, size, comp_size,
+                    content_hash=None, algorithm="sha256", prefilter=None):
+        """
+        remember the compressed size reached for one file's contents,
+        and add its ratio to the histogram of ext and codec
+        """
+        if not size:
+            return
+        ext = ext.lower()
+        bucket = min(int(float(comp_size) / size * self.hist_buckets), self.hist_buckets)
+        self.ext_histogram(ext, codec)
+        with self.lock:
+            if content_hash is not None:
+                self.conn.execute("""
+                    INSERT OR REPLACE INTO compressibility
+                        (hash, algorithm, prefilter, size, comp_size, codec)
+                        VALUES (?, ?, ?, ?, ?, ?)""",
+                                  (content_hash, algorithm, prefilter, size, comp_size, codec))
+            self.conn.execute("""
+                INSERT INTO ext_compressibility (ext, codec, bucket, count)
+                    VALUES (?, ?, ?, 1)
+                    ON CONFLICT (ext, codec, bucket) DO UPDATE SET count = count + 1""",
+                              (ext, codec, bucket))
+            counts = self.hist_cache.setdefault((ext, codec), [0] * (self.hist_buckets + 1))
+            counts[bucket] += 1
+            self.pending += 1
+            if self.pending >= self.commit_every:
+                self.flush()
+
+    def compress_hint(self, ext, codec, comp_thresh,
+                      content_hash=None, algorithm="sha256", prefilter=None):
+        """
+        decide without a trial whether a file is worth compressing: from
+        the ratio its contents reached before, else from the histogram
+        of its extension once that has enough samples that agree
+
+        :return: "compress", "store", or None to try it
+        """
+        ratio = self.known_ratio(content_hash, algorithm=algorithm, prefilter=prefilter)
+        if ratio is not None:
+            return "compress" if ratio <= comp_thresh else "store"
+        counts = self.ext_histogram(ext, codec)
+        if counts is None or sum(counts) < self.hist_min_samples:
+            return None
+        # buckets wholly at or under comp_thresh
+        below = sum(counts[:int(comp_thresh * self.hist_buckets + 1e-9)])
+        share = float(below) / sum(counts)
+        if share >= self.hist_agree:
+            return "compress"
+        if share <= 1 - self.hist_agree:
+            return "store"
+        return None
+
+    def has_chunk(self, chash):
+        with self.lock:
+            row = self.conn.execute("""
+                SELECT 1 FROM chunks WHERE hash = ?""", (chash,)).fetchone()
+        return row is not None
+
+    def add_chunk(self, chash, size, stored_size):
+        with self.lock:
+            self.conn.execute("""
+                INSERT OR IGNORE INTO chunks (hash, size, stored_size)
+                    VALUES (?, ?, ?)""", (chash, size, stored_size))
+            self.pending += 1
+            if self.pending >= self.commit_every:
+                self.flush()
+
+    def find_pack_entry(self, key):
+        """
+        :return: (pack name, offset) of the entry stored under key or None
+        """
+        with self.lock:
+            row = self.conn.execute("""
+                SELECT pack, offset FROM pack_entries WHERE key = ?""", (key,)).fetchone()
+        return None if row is None else tuple(row)
+
+    def add_pack_entry(self, key, pack, offset, length, codec, size):
+        with self.lock:
+            self.conn.execute("""
+                INSERT OR IGNORE INTO pack_entries (key, pack, offset, length, codec, size)
+                    VALUES (?, ?, ?, ?, ?, ?)""", (key, pack, offset, length, codec, size))
+            self.pending += 1
+            if self.pending >= self.commit_every:
+                self.flush()
+
+    def current_version(self, sourcepath):
+        """
+        the version holding the contents recorded at the last backup of
+        sourcepath, or its latest version if no state is recorded
+
+        :return: dict with filepath, version, sha256, size, backup_mode,
+            stored_path (relative), algorithm, or None
+        """
+        with self.lock:
+            row = self.conn.execute("""
+                SELECT v.version, v.sha256, v.size, v.mode, v.stored_path, v.algorithm
+                    FROM versions v JOIN file_state f
+                        ON v.sourcepath = f.sourcepath AND v.sha256 = f.sha256
+                    WHERE v.sourcepath = ?
+                    ORDER BY v.version DESC LIMIT 1""", (sourcepath,)).fetchone()
+            if row is None:
+                row = self.conn.execute("""
+                    SELECT version, sha256, size, mode, stored_path, algorithm FROM versions
+                        WHERE sourcepath = ?
+                        ORDER BY version DESC LIMIT 1""", (sourcepath,)).fetchone()
+        if row is None:
+            return None
+        return OrderedDict(zip(("filepath", "version", "sha256", "size", "backup_mode", "stored_path",
+                                "algorithm"),
+                               (sourcepath,) + tuple(row)))
+
+    version_fields = ("filepath", "version", "sha256", "size", "backup_mode",
+                      "stored_path", "ctime", "mtime", "algorithm")
+
+    @staticmethod
+    def pattern_query(pattern):
+        """
+        :param pattern: a file name, an exact source path, or a glob of either
+        :return: (where clause, parameter) matching the pattern
+        """
+        column = "sourcepath" if ("/" in pattern or os.sep in pattern) else "filename"
+        if any(c in pattern for c in "*?["):
+            return "{0} GLOB ?".format(column), pattern
+        return "{0} = ?".format(column), pattern
+
+    def find_versions(self, pattern):
+        """
+        every stored version of the files matching pattern
+
+        :param pattern: a file name, an exact source path, or a glob of either
+        :return: list of dicts with filepath, version, sha256, size, backup_mode,
+            stored_path (absolute), ctime, mtime and algorithm, by path then version
+        """
+        where, param = BackupIndex.pattern_query(pattern)
+        with self.lock:
+            rows = self.conn.execute("""
+                SELECT sourcepath, version, sha256, size, mode, stored_path, ctime, mtime, algorithm
+                    FROM versions WHERE {0}
+                    ORDER BY sourcepath, version""".format(where), (param,)).fetchall()
+        found = []
+        for row in rows:
+            record = OrderedDict(zip(BackupIndex.version_fields, row))
+            record["stored_path"] = self.abspath(record["stored_path"])
+            found.append(record)
+        return found
+
+    def versions(self, sourcepath):
+        with self.lock:
+            rows = self.conn.execute("""
+                SELECT version, sha256, size, mode, stored_path, ctime, mtime
+                    FROM versions WHERE sourcepath = ?
+                    ORDER BY version""", (sourcepath,)).fetchall()
+        return rows
+
+    def count(self):
+        with self.lock:
+            return self.conn.execute("SELECT COUNT(*) FROM versions").fetchone()[0]
+
+    def flush(self):
+        with self.lock:
+            self.conn.commit()
+            self.pending = 0
+
+    def close(self):
+        with self.lock:
+            self.flush()
+            self.conn.close()
+
+    def rebuild(self, verbosity=0):
+        """
+        rebuild the index from the store: the chunks, the pack files,
+        the meta_files of older runs and the run journals
+
+        :return: number of versions indexed
+        """
+        verbosity = max(verbosity, self.verbosity)
+        logger = logging.getLogger(__file__)
+        if verbosity > 0:
+            msg = f"{Utilities.whoami()} {self.destroot} <{Utilities.now()}>"
+            logger.info(msg)
+        chunkroot = os.path.join(self.destroot, ChunkStore.foldername)
+        packroot = os.path.join(self.destroot, PackStore.foldername)
+        with self.lock:
+            self.conn.execute("DELETE FROM versions")
+            self.conn.execute("DELETE FROM chunks")
+            self.conn.execute("DELETE FROM pack_entries")
+            if os.path.isdir(packroot):
+                self.rebuild_packs(packroot, verbosity=verbosity)
+            for chunk_folder, _, filenames in os.walk(chunkroot):
+                for chash in filenames:
+                    if chash.endswith(PARTIAL_EXT):
+                        continue
+                    self.add_chunk(chash, None,
+                                   os.path.getsize(os.path.join(chunk_folder, chash)))
+            records = itertools.chain(RunJournal.meta_file_records(self.destroot, verbosity=verbosity),
+                                      RunJournal.records(self.destroot))
+            for record in records:
+                self.add_record(record)
+            self.flush()
+            # a version may be both in a pack and in a journal
+            nversions = self.count()
+        if verbosity > 0:
+            logger.info(f"  indexed {nversions} versions <{Utilities.now()}>")
+        return nversions
+
+    def add_record(self, record):
+        """
+        index one RunJournal record
+        """
+        self.add_version(sourcepath=record["filepath"],
+                         version=record["version"],
+                         sha256=record["sha256"],
+                         size=record.get("size"),
+                         mode=record["backup_mode"],
+                         stored_path=self.abspath(record["stored_path"]),
+                         ctime=record.get("ctime"),
+                         mtime=record.get("mtime"),
+                         algorithm=record.get("algorithm") or "sha256",
+                         prefilter=record.get("prefilter"))
+
+    def rebuild_packs(self, packroot, verbosity=0):
+        """
+        index the data entries and the packed versions of every pack
+
+        :return: number of versions indexed
+        """
+        logger = logging.getLogger(__file__)
+        nversions = 0
+        for packname in sorted(os.listdir(packroot)):
+            if not packname.endswith(PackStore.pack_ext):
+                continue
+            packpath = os.path.join(packroot, packname)
+            try:
+                with open(packpath, mode="rb") as fp:
+                    for offset, kind, codec, key, crc, length, data_offset in PackStore.scan(packpath):
+                        if kind == b"D":
+                            self.add_pack_entry(key, packname, offset, length,
+                                                codec.decode("ascii"), None)
+                            continue
+                        fp.seek(data_offset)
+                        meta = json.loads(fp.read(length).decode("UTF-8"))
+                        # the contents are in this pack or an earlier one
+                        entry = self.find_pack_entry(meta["sha256"])
+                        stored_path = packpath if entry is None else os.path.join(packroot, entry[0])
+                        self.add_version(sourcepath=meta["filepath"],
+                                         version=meta["version"],
+                                         sha256=meta["sha256"],
+                                         size=meta.get("size"),
+                                         mode=meta["backup_mode"],
+                                         stored_path=stored_path,
+                                         ctime=meta.get("ctime"),
+                                         mtime=meta.get("mtime"),
+                                         algorithm=meta.get("algorithm") or "sha256",
+                                         prefilter=meta.get("prefilter"))
+                        nversions += 1
+            except Exception:
+                msg = f"  problem indexing {packpath}"
+                msg += Utilities.last_exception_info()
+                logger.warning(msg)
+        return nversions
+
+
+class RunJournal(object):
+    """
+    append-only record of the versions stored by one run
+
+    One JSON object per line in <destroot>/journal/run_<stamp>.jsonl with
+    the meta_files fields (filename, folder, filepath, ctime, mtime,
+    backup_mode) plus sha256, size, version and stored_path, relative to
+    destroot.  Records are buffered and written flush_every at a time,
+    instead of one meta txt file per stored file.
+    """
+    foldername = "journal"
+    journal_ext = ".jsonl"
+
+    def __init__(self, destroot, name=None, flush_every=200, verbosity=0):
+        """
+        :param destroot: backup root
+        :param name: journal file name, default run_<stamp>.jsonl
+        :param flush_every: records buffered before a write
+        """
+        self.destroot = destroot
+        self.root = os.path.join(destroot, RunJournal.foldername)
+        if name is None:
+            name = "run_" + Utilities.nowshortstr() + RunJournal.journal_ext
+        self.path = os.path.join(self.root, name)
+        self.flush_every = flush_every
+        self.verbosity = verbosity
+        self.lock = threading.RLock()
+        self.buffer = []
+        self.nrecords = 0
+        self.fp = None
+
+    def append(self, record):
+        """
+        :param record: dict of the version's fields, stored_path relative to destroot
+        """
+        line = json.dumps(record) + "\n"
+        with self.lock:
+            self.buffer.append(line)
+            self.nrecords += 1
+            if len(self.buffer) >= self.flush_every:
+                self.flush()
+
+    def flush(self):
+        with self.lock:
+            if len(self.buffer) == 0:
+                return
+            if self.fp is None:
+                os.makedirs(self.root, exist_ok=True)
+                self.fp = open(self.path, mode="a", encoding="UTF-8")
+            self.fp.write("".join(self.buffer))
+            self.fp.flush()
+            self.buffer = []
+
+    def close(self):
+        with self.lock:
+            self.flush()
+            if self.fp is not None:
+                os.fsync(self.fp.fileno())
+                self.fp.close()
+                self.fp = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    @staticmethod
+    def journal_paths(destroot):
+        root = os.path.join(destroot, RunJournal.foldername)
+        if not os.path.isdir(root):
+            return []
+        return [os.path.join(root, f) for f in sorted(os.listdir(root))
+                if f.endswith(RunJournal.journal_ext)]
+
+    @staticmethod
+    def read(journal_path):
+        """
+        :return: generator of the records in one journal; a line cut short
+            by an interrupted write is skipped
+        """
+        with open(journal_path, mode="r", encoding="UTF-8") as fp:
+            for line in fp:
+                try:
+                    yield json.loads(line)
+                except ValueError:
+                    continue
+
+    @staticmethod
+    def records(destroot):
+        """
+        :return: generator of the records of every journal, oldest run first
+        """
+        for journal_path in RunJournal.journal_paths(destroot):
+            for record in RunJournal.read(journal_path):
+                yield record
+
+    @staticmethod
+    def meta_file_records(destroot, verbosity=0):
+        """
+        walk a store and turn its meta_files into journal records
+
+        :return: generator of records
+        """
+        logger = logging.getLogger(__file__)
+        for dest_folder, dirnames, filenames in RunJournal.walk_store(destroot):
+            if "meta_files" not in dirnames:
+                continue
+            try:
+                records = RunJournal.folder_records(destroot, dest_folder, filenames)
+            except Exception:
+                msg = f"  problem reading the meta_files in {dest_folder}"
+                msg += Utilities.last_exception_info()
+                logger.warning(msg)
+                continue
+            for record in records:
+                yield record
+
+    @staticmethod
+    def walk_store(destroot):
+        """
+        os.walk of a store without the chunk, pack, journal and snapshot folders
+        """
+        skip = [os.path.join(destroot, f) for f in (ChunkStore.foldername,
+                                                    PackStore.foldername,
+                                                    RunJournal.foldername,
+                                                    Snapshot.foldername)]
+        for dest_folder, dirnames, filenames in os.walk(destroot, topdown=True):
+            if dest_folder in skip:
+                dirnames[:] = []
+                continue
+            yield dest_folder, dirnames, filenames
+
+    @staticmethod
+    def folder_records(destroot, dest_folder, filenames):
+        """
+        the records of the versions stored in one folder, from its meta_files
+
+        Meta files written before the index existed have no sha256 or
+        stored_file entry; for those the stored file is paired with its meta
+        file by timestamp order and re-hashed.  A meta file with a
+        shared_path entry is a version whose contents are stored under
+        another source path.
+
+        :param filenames: the files in dest_folder
+        :return: list of records
+        """
+        meta_folder = os.path.join(dest_folder, "meta_files")
+        if not os.path.isdir(meta_folder):
+            return []
+        metas = [Utilities.read_meta_txt(os.path.join(meta_folder, f))
+                 for f in sorted(os.listdir(meta_folder))]
+        metas = [m for m in metas if "filepath" in m]
+        if len(metas) == 0:
+            return []
+        data_files = sorted(f for f in filenames if not f.endswith(PARTIAL_EXT))
+        by_stored = {m["stored_file"]: m for m in metas if "stored_file" in m}
+        legacy = [m for m in metas if "stored_file" not in m]
+        legacy_files = [f for f in data_files if f not in by_stored]
+        records = []
+        for dfile in data_files:
+            meta = by_stored.get(dfile)
+            if meta is None and len(legacy) == len(legacy_files):
+                meta = legacy[legacy_files.index(dfile)]
+            if meta is None:
+                meta = OrderedDict(filepath=metas[0]["filepath"])
+            dpath = os.path.join(dest_folder, dfile)
+            mode = meta.get("backup_mode")
+            if mode is None:
+                source_ext = os.path.splitext(meta["filepath"])[1]
+                dext = os.path.splitext(dfile)[1]
+                mode = "zip" if dext == ".zip" and source_ext != ".zip" else "orig"
+            sha256 = meta.get("sha256")
+            if sha256 is None:
+                if mode == "zip":
+                    sha256 = Utilities.sha_256_zipped(dpath)
+                else:
+                    sha256 = Utilities.sha_256(dpath)
+            record = OrderedDict(meta)
+            record["backup_mode"] = mode
+            record["sha256"] = sha256
+            record["version"] = meta.get("version", os.path.splitext(dfile)[0])
+            record["stored_path"] = os.path.relpath(dpath, destroot)
+            records.append(record)
+        for meta in metas:
+            if "shared_path" in meta:
+                record = OrderedDict(meta)
+                record["stored_path"] = meta["shared_path"]
+                records.append(record)
+        for record in records:
+            # where the data is, is in stored_path now
+            record.pop("stored_file", None)
+            record.pop("shared_path", None)
+            if record.get("size") is not None:
+                record["size"] = int(record["size"])
+        return records
+
+    @staticmethod
+    def import_meta_files(destroot, verbosity=0):
+        """
+        copy the records of a store's meta_files into a journal of their own,
+        import_<stamp>.jsonl; the meta_files are left in place
+
+        :return: path of the journal written
+        """
+        logger = logging.getLogger(__file__)
+        name = "import_" + Utilities.nowshortstr() + RunJournal.journal_ext
+        with RunJournal(destroot, name=name, verbosity=verbosity) as journal:
+            for record in RunJournal.meta_file_records(destroot, verbosity=verbosity):
+                journal.append(record)
+        if verbosity > 0:
+            logger.info(f"  imported {journal.nrecords} meta_files records into {journal.path}")
+        return journal.path
+
+
+class Snapshot(object):
+    """
+    manifest of one run: for every file seen, the version that holds its
+    contents at the end of the run
+
+    Written to <destroot>/snapshots/snapshot_<stamp>.jsonl, a header line
+    then one JSON line per file with filepath, version, sha256, size,
+    backup_mode and stored_path (relative to destroot), so a restore needs
+    neither the index nor a walk of the store.
+    """
+    foldername = "snapshots"
+    snapshot_ext = ".jsonl"
+
+    def __init__(self, destroot, name=None, verbosity=0):
+        self.destroot = destroot
+        self.root = os.path.join(destroot, Snapshot.foldername)
+        if name is None:
+            name = "snapshot_" + Utilities.nowshortstr() + Snapshot.snapshot_ext
+        self.path = os.path.join(self.root, name)
+        self.verbosity = verbosity
+        self.lock = threading.Lock()
+        self.roots = []
+        self.sourcepaths = []
+
+    def add_root(self, sourceroot):
+        with self.lock:
+            if sourceroot not in self.roots:
+                self.roots.append(sourceroot)
+
+    def add(self, sourcepath):
+        with self.lock:
+            self.sourcepaths.append(sourcepath)
+
+    def write(self, index):
+        """
+        look up the current version of every file seen and write the manifest
+
+        :return: number of files in the manifest
+        """
+        logger = logging.getLogger(__file__)
+        os.makedirs(self.root, exist_ok=True)
+        partialpath = self.path + PARTIAL_EXT
+        nfiles = 0
+        with self.lock:
+            sourcepaths = sorted(set(self.sourcepaths))
+            header = OrderedDict(snapshot=os.path.basename(self.path),
+                                 created=Utilities.nowstr(),
+                                 roots=self.roots)
+        with open(partialpath, mode="w", encoding="UTF-8") as fp:
+            fp.write(json.dumps(header) + "\n")
+            for sourcepath in sourcepaths:
+                record = index.current_version(sourcepath)
+                if record is None:
+                    continue
+                fp.write(json.dumps(record) + "\n")
+                nfiles += 1
+            fp.flush()
+            os.fsync(fp.fileno())
+        os.replace(partialpath, self.path)
+        if self.verbosity > 0:
+            logger.info(f"  snapshot of {nfiles} files in {self.path}")
+        return nfiles
+
+    @staticmethod
+    def snapshot_paths(destroot):
+        root = os.path.join(destroot, Snapshot.foldername)
+        if not os.path.isdir(root):
+            return []
+        return [os.path.join(root, f) for f in sorted(os.listdir(root))
+                if f.endswith(Snapshot.snapshot_ext)]
+
+    @staticmethod
+    def find(destroot, snapshot=None):
+        """
+        :param snapshot: path or file name of a manifest, None for the latest
+        :return: path of the manifest
+        """
+        if snapshot is None:
+            paths = Snapshot.snapshot_paths(destroot)
+            if len(paths) == 0:
+                raise FileNotFoundError("no snapshots in {0}".format(destroot))
+            return paths[-1]
+        if os.path.isfile(snapshot):
+            return snapshot
+        path = os.path.join(destroot, Snapshot.foldername, snapshot)
+        if not os.path.isfile(path):
+            raise FileNotFoundError("no snapshot {0} in {1}".format(snapshot, destroot))
+        return path
+
+    @staticmethod
+    def load(snapshot_path):
+        """
+        :return: (header, list of file records)
+        """
+        with open(snapshot_path, mode="r", encoding="UTF-8") as fp:
+            header = json.loads(fp.readline())
+            records = [json.loads(line) for line in fp if line.strip()]
+        return header, records
+
+
+class _StoredCodec(object):
+    # compressobj / decompressobj stand in for the "stored" codec
+    def compress(self, data):
+        return bytes(data)
+
+    def decompress(self, data):
+        return bytes(data)
+
+    def flush(self):
+        return b""
+
+
+class Codecs(object):
+    """
+    the codecs a version, chunk or pack entry can be stored with
+
+    "stored" and "deflate" are always there, "bz2" and "lzma" come with
+    python, "zstd" needs the zstandard package.  A whole file version
+    compressed with deflate keeps the one entry zip of backup_mode "zip";
+    the other codecs write a plain compressed stream with ext from exts
+    and the codec's name as backup_mode.  Chunks and pack entries start
+    with, or carry, the codec's one byte tag.
+    """
+    tags = OrderedDict([("stored", b"R"), ("deflate", b"Z"), ("bz2", b"B"),
+                        ("lzma", b"L"), ("zstd", b"S")])
+    exts = OrderedDict([("bz2", ".bz2"), ("lzma", ".xz"), ("zstd", ".zst")])
+    # (lowest, highest) level of each codec
+    levels = {"deflate": (1, 9), "bz2": (1, 9), "lzma": (0, 9), "zstd": (1, 22)}
+    # the level each codec compresses at when none is given
+    default_levels = {"deflate": 6, "bz2": 9, "lzma": 6, "zstd": 3}
+
+    @staticmethod
+    def available(name):
+        if name == "zstd":
+            return zstandard is not None
+        return name in Codecs.tags
+
+    @staticmethod
+    def check(name):
+        if name not in Codecs.tags:
+            msg = "codec should be one of {0}, got {1}".format(list(Codecs.tags.keys()), name)
+            raise ValueError(msg)
+        if not Codecs.available(name):
+            raise ValueError("codec {0} needs the zstandard package".format(name))
+        return name
+
+    @staticmethod
+    def by_tag(tag):
+        for name, ctag in Codecs.tags.items():
+            if ctag == tag:
+                return name
+        raise ValueError("unknown codec tag {0}".format(tag))
+
+    @staticmethod
+    def compressobj(name, level=None):
+        Codecs.check(name)
+        if level is None and name in Codecs.default_levels:
+            level = Codecs.default_levels[name]
+        if name == "deflate":
+            return zlib.compressobj(level)
+        if name == "bz2":
+            return bz2.BZ2Compressor(level)
+        if name == "lzma":
+            return lzma.LZMACompressor(preset=level)
+        if name == "zstd":
+            return zstandard.ZstdCompressor(level=level).compressobj()
+        return _StoredCodec()
+
+    @staticmethod
+    def decompressobj(name):
+        Codecs.check(name)
+        if name == "deflate":
+            return zlib.decompressobj()
+        if name == "bz2":
+            return bz2.BZ2Decompressor()
+        if name == "lzma":
+            return lzma.LZMADecompressor()
+        if name == "zstd":
+            return zstandard.ZstdDecompressor().decompressobj()
+        return _StoredCodec()
+
+    @staticmethod
+    def compress(name, data, level=None):
+        comp = Codecs.compressobj(name, level)
+        return comp.compress(data) + comp.flush()
+
+    @staticmethod
+    def decompress(name, data):
+        return Codecs.decompressobj(name).decompress(data)
+
+    @staticmethod
+    def encode_file(infilepath, outfilepath, name, level=None,
+                    bufsize=1024 * 1024, rawfilepath=None, digest=None, meter=None):
+        """
+        compress one file into a plain stream of codec name, in a single
+        pass that can also feed a digest and write a raw copy, as stream_zip
+
+        :param meter: StageMeter to add the read, compress and write time to
+        :return: (orig_size, comp_size)
+        """
+        if meter is None:
+            meter = StageMeter()
+        comp = Codecs.compressobj(name, level)
+        orig_size = 0
+        with contextlib.ExitStack() as stack:
+            fp = stack.enter_context(open(infilepath, mode="rb"))
+            outfp = stack.enter_context(open(outfilepath, mode="wb"))
+            rawfp = None
+            if rawfilepath is not None:
+                rawfp = stack.enter_context(open(rawfilepath, mode="wb"))
+            while True:
+                with meter.stage("read"):
+                    chunk = fp.read(bufsize)
+                if not chunk:
+                    break
+                orig_size += len(chunk)
+                if digest is not None:
+                    digest.update(chunk)
+                with meter.stage("compress"):
+                    piece = comp.compress(chunk)
+                with meter.stage("write"):
+                    if rawfp is not None:
+                        rawfp.write(chunk)
+                    outfp.write(piece)
+            with meter.stage("compress"):
+                piece = comp.flush()
+            with meter.stage("write"):
+                outfp.write(piece)
+        if rawfilepath is not None:
+            shutil.copymode(infilepath, rawfilepath)
+        comp_size = os.path.getsize(outfilepath)
+        meter.bytes_in += orig_size
+        meter.bytes_out += comp_size + (orig_size if rawfilepath is not None else 0)
+        return orig_size, comp_size
+
+    @staticmethod
+    def decode_file(inpath, outpath, name, bufsize=1024 * 1024):
+        """
+        decompress a stream written by encode_file to outpath, atomically
+        """
+        decomp = Codecs.decompressobj(name)
+        partialpath = outpath + PARTIAL_EXT
+        try:
+            with open(inpath, mode="rb") as fp, open(partialpath, mode="wb") as outfp:
+                for chunk in iter(lambda: fp.read(bufsize), b''):
+                    outfp.write(decomp.decompress(chunk))
+            os.replace(partialpath, outpath)
+        except Exception:
+            if os.path.isfile(partialpath):
+                os.remove(partialpath)
+            raise
+        return outpath
+
+
+class CodecPolicy(object):
+    """
+    picks the codec and level for a file from its extension and size
+
+    Each rule is (exts, min_size, max_size, choices): exts a list of
+    lower case extensions and FileSniffer labels, or None for any,
+    max_size None for no limit,
+    choices a list of (codec, level) of which the first available one is
+    used.  The first matching rule wins; a level of None means the
+    compresslevel the backup was started with for deflate, and
+    Codecs.default_levels for the other codecs.
+    """
+    compressed_exts = [".jpg", ".jpeg", ".png", ".gif", ".webp", ".heic", ".mp3", ".m4a",
+                       ".aac", ".ogg", ".flac", ".mp4", ".m4v", ".mkv", ".mov", ".avi",
+                       ".webm", ".zip", ".gz", ".tgz", ".bz2", ".xz", ".zst", ".7z", ".rar",
+                       ".docx", ".xlsx", ".pptx", ".odt", ".ods", ".jar", ".apk", ".whl"]
+    text_exts = [".txt", ".log", ".csv", ".tsv", ".json", ".jsonl", ".xml", ".html", ".htm",
+                 ".md", ".rst", ".ini", ".cfg", ".yaml", ".yml", ".sql", ".py", ".c",
+                 ".h", ".cpp", ".java", ".js", ".ts", ".css", ".bat", ".sh", ".tex"]
+    default_rules = [
+        (compressed_exts, 0, None, [("stored", None)]),
+        # text compresses well at fast levels, faster still for large files
+        (text_exts, 0, 16 * 1024 * 1024, [("zstd", 3), ("deflate", None)]),
+        (text_exts, 16 * 1024 * 1024, None, [("zstd", 1), ("deflate", 1)]),
+        # files of other extensions, by what their header says
+        (list(FileSniffer.uncompressible), 0, None, [("stored", None)]),
+        (["text"], 0, 16 * 1024 * 1024, [("zstd", 3), ("deflate", None)]),
+        (["text"], 16 * 1024 * 1024, None, [("zstd", 1), ("deflate", 1)]),
+        (None, 0, None, [("deflate", None)]),
+    ]
+
+    def __init__(self, rules=None):
+        self.rules = list(CodecPolicy.default_rules if rules is None else rules)
+
+    @staticmethod
+    def fixed(codec, level=None):
+        """
+        a policy storing every file with one codec
+        """
+        Codecs.check(codec)
+        return CodecPolicy([(None, 0, None, [(codec, level)])])
+
+    @staticmethod
+    def make(policy):
+        """
+        :param policy: a CodecPolicy, "auto" for the default rules, a codec
+            name for fixed(name), or None
+        :return: a CodecPolicy, or None for deflate at the backup's compresslevel
+        """
+        if policy is None or isinstance(policy, CodecPolicy):
+            return policy
+        if policy == "auto":
+            return CodecPolicy()
+        return CodecPolicy.fixed(policy)
+
+    def choose(self, filepath, size, label=None, compresslevel=None):
+        """
+        :param label: FileSniffer label of the file, if known
+        :param compresslevel: deflate level for rules that give none
+        :return: (codec, level) for a file of size bytes, the level None
+            only for "stored"
+        """
+        ext = os.path.splitext(filepath)[1].lower()
+        for exts, min_size, max_size, choices in self.rules:
+            if exts is not None and ext not in exts and label not in exts:
+                continue
+            if size < min_size or (max_size is not None and size >= max_size):
+                continue
+            for codec, level in choices:
+                if Codecs.available(codec):
+                    return codec, CodecPolicy.resolve_level(codec, level, compresslevel)
+        return "deflate", CodecPolicy.resolve_level("deflate", None, compresslevel)
+
+    @staticmethod
+    def resolve_level(codec, level, compresslevel=None):
+        if level is not None or codec == "stored":
+            return level
+        if codec == "deflate" and compresslevel is not None and compresslevel >= 0:
+            return compresslevel
+        return Codecs.default_levels[codec]
+
+
+class ZipEntryWriter(object):
+    """
+    write a zip archive holding one DEFLATE entry from raw deflate bytes
+    that were produced elsewhere, e.g. by CompressionEngine workers
+
+    The local header is written with placeholder sizes and patched on
+    close, so fp must be seekable.
+    """
+    def __init__(self, fp, zinfo):
+        self.fp = fp
+        self.zinfo = zinfo
+        self.zinfo.compress_type = zipfile.ZIP_DEFLATED
+        self.zinfo.header_offset = fp.tell()
+        # same rule as zipfile, a little headroom over the source size
+        self.zip64 = zinfo.file_size * 1.05 > zipfile.ZIP64_LIMIT
+        self.zinfo.CRC = 0
+        self.zinfo.compress_size = 0
+        self.fp.write(self.zinfo.FileHeader(self.zip64))
+        self.data_offset = fp.tell()
+
+    def write(self, data):
+        self.fp.write(data)
+        self.zinfo.compress_size += len(data)
+
+    def close(self, crc, file_size):
+        zinfo = self.zinfo
+        zinfo.CRC = crc
+        zinfo.file_size = file_size
+        end_offset = self.fp.tell()
+        self.fp.seek(zinfo.header_offset)
+        self.fp.write(zinfo.FileHeader(self.zip64))
+        self.fp.seek(end_offset)
+        self.write_end_record()
+        return zinfo
+
+    def write_end_record(self):
+        zinfo = self.zinfo
+        dt = zinfo.date_time
+        dosdate = (dt[0] - 1980) << 9 | dt[1] << 5 | dt[2]
+        dostime = dt[3] << 11 | dt[4] << 5 | (dt[5] // 2)
+        extra = []
+        file_size = zinfo.file_size
+        compress_size = zinfo.compress_size
+        if file_size > zipfile.ZIP64_LIMIT or compress_size > zipfile.ZIP64_LIMIT:
+            extra = [file_size, compress_size]
+            file_size = compress_size = 0xffffffff
+        extra_data = b""
+        version = zipfile.DEFAULT_VERSION
+        if extra:
+            extra_data = struct.pack("<HH" + "Q" * len(extra), 1, 8 * len(extra), *extra)
+            version = zipfile.ZIP64_VERSION
+        try:
+            filename = zinfo.filename.encode("ascii")
+            flag_bits = zinfo.flag_bits
+        except UnicodeEncodeError:
+            filename = zinfo.filename.encode("utf-8")
+            flag_bits = zinfo.flag_bits | 0x800
+        cd_offset = self.fp.tell()
+        centdir = struct.pack("<4s4B4HL2L5H2L", b"PK\001\002",
+                              version, zinfo.create_system, version, zinfo.reserved,
+                              flag_bits, zinfo.compress_type, dostime, dosdate,
+                              zinfo.CRC, compress_size, file_size,
+                              len(filename), len(extra_data), 0, 0,
+                              zinfo.internal_attr, zinfo.external_attr,
+                              zinfo.header_offset)
+        self.fp.write(centdir + filename + extra_data)
+        cd_end = self.fp.tell()
+        cd_size = cd_end - cd_offset
+        if cd_offset > zipfile.ZIP64_LIMIT:
+            self.fp.write(struct.pack("<4sQ2H2L4Q", b"PK\006\006", 44, 45, 45, 0, 0,
+                                      1, 1, cd_size, cd_offset))
+            self.fp.write(struct.pack("<4sLQL", b"PK\006\007", 0, cd_end, 1))
+            cd_offset = 0xffffffff
+        self.fp.write(struct.pack("<4s4H2LH", b"PK\005\006", 0, 0, 1, 1,
+                                  cd_size, cd_offset, 0))
+
+
+def _deflate_chunk(data, compresslevel, zdict=None):
+    # runs in a CompressionEngine worker process; each chunk ends on a
+    # byte boundary (sync flush) so the pieces concatenate into one stream
+    if zdict:
+        comp = zlib.compressobj(compresslevel, zlib.DEFLATED, -15, zdict=zdict)
+    else:
+        comp = zlib.compressobj(compresslevel, zlib.DEFLATED, -15)
+    return comp.compress(data) + comp.flush(zlib.Z_SYNC_FLUSH)
+
+
+def _zip_small(sourcepath, zipfilepath, compresslevel):
+    # runs in a CompressionEngine worker process; the whole file in one go
+    zinfo = zipfile.ZipInfo.from_file(sourcepath)
+    with open(sourcepath, mode="rb") as fp:
+        data = fp.read()
+    with open(zipfilepath, mode="wb") as zfp:
+        writer = ZipEntryWriter(zfp, zinfo)
+        writer.write(_deflate_chunk(data, compresslevel))
+        writer.write(CompressionEngine.final_block)
+        writer.close(zlib.crc32(data), len(data))
+    return len(data), os.path.getsize(zipfilepath)
+
+
+class CompressionEngine(object):
+    """
+    DEFLATE on a process pool, so compression is not held to one core
+
+    Many small files are zipped whole, one per worker; a large file is
+    cut into chunk_size pieces that are deflated in parallel, each primed
+    with the 32K before it as in pigz, and joined into one zip entry.
+    The result is an ordinary zip that create_new_zip/unzip_to_temp read.
+    """
+    # an empty final fixed-huffman block, ends the concatenated stream
+    final_block = b"\x03\x00"
+    window = 32 * 1024
+
+    def __init__(self, processes=None, chunk_size=4 * 1024 * 1024,
+                 compresslevel=zlib.Z_DEFAULT_COMPRESSION, verbosity=0):
+        self.processes = processes or os.cpu_count() or 1
+        self.chunk_size = chunk_size
+        self.compresslevel = compresslevel
+        self.verbosity = verbosity
+        self.pool = concurrent.futures.ProcessPoolExecutor(max_workers=self.processes)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        self.pool.shutdown(wait=True)
+
+    def deflate_chunks(self, chunks, compresslevel=None):
+        """
+        deflate an iterable of byte chunks on the pool,
+        at most 2 * processes chunks in flight
+
+        :return: generator of the raw deflate pieces, in order,
+            ending with the final block
+        """
+        if compresslevel is None:
+            compresslevel = self.compresslevel
+        pending = deque()
+        zdict = None
+        for chunk in chunks:
+            pending.append(self.pool.submit(_deflate_chunk, chunk, compresslevel, zdict))
+            zdict = chunk[-CompressionEngine.window:]
+            while len(pending) >= 2 * self.processes:
+                yield pending.popleft().result()
+        while len(pending) > 0:
+            yield pending.popleft().result()
+        yield CompressionEngine.final_block
+
+    def zip_file(self, sourcepath, zipfilepath, compresslevel=None):
+        """
+        zip one file, in parallel chunks if it is larger than chunk_size
+
+        :return: (orig_size, comp_size)
+        """
+        if compresslevel is None:
+            compresslevel = self.compresslevel
+        if os.path.getsize(sourcepath) <= self.chunk_size:
+            return self.pool.submit(_zip_small, sourcepath, zipfilepath,
+                                    compresslevel).result()
+        return Utilities.stream_zip(sourcepath, zipfilepath,
+                                    compresslevel=compresslevel,
+                                    bufsize=self.chunk_size,
+                                    engine=self)
+
+    def zip_files(self, pairs, compresslevel=None):
+        """
+        zip many files at once
+
+        :param pairs: list of (sourcepath, zipfilepath)
+        :return: list of (orig_size, comp_size), in the order of pairs
+        """
+        if compresslevel is None:
+            compresslevel = self.compresslevel
+        futures = []
+        for sourcepath, zipfilepath in pairs:
+            if os.path.getsize(sourcepath) <= self.chunk_size:
+                futures.append(self.pool.submit(_zip_small, sourcepath, zipfilepath,
+                                                compresslevel))
+            else:
+                futures.append(None)
+        results = []
+        for (sourcepath, zipfilepath), future in zip(pairs, futures):
+            if future is None:
+                results.append(self.zip_file(sourcepath, zipfilepath, compresslevel))
+            else:
+                results.append(future.result())
+        return results
+
+
+class FixedChunker(object):
+    """
+    cut a stream into fixed size chunks
+    """
+    name = "fixed"
+
+    def __init__(self, chunk_size=1024 * 1024):
+        self.chunk_size = chunk_size
+
+    def chunks(self, fp):
+        for chunk in iter(lambda: fp.read(self.chunk_size), b''):
+            yield chunk
+
+
+class GearChunker(object):
+    """
+    content defined chunking with a Gear rolling hash, FastCDC style
+
+    Cut points depend on the bytes around them, not on their offset,
+    so an insert near the start of a file only changes the chunks around
+    it.  Normalized chunking: a stricter mask before avg_size and a looser
+    one after it keep chunk sizes close to avg_size, between min_size and
+    max_size.
+
+    The hash over a 32 byte window, h[i] = sum(G[b[i-k]] << k, k < 32),
+    is computed for a whole buffer with numpy by prefix doubling,
+    S2m[i] = Sm[i] + (Sm[i-m] << m), so 5 vector passes replace the
+    byte at a time loop.
+    """
+    name = "gear"
+    window = 32
+
+    # 32 bit gear table, fixed so cut points are the same on every run
+    gear = np.array([int.from_bytes(hashlib.sha256(bytes([i])).digest()[:4], "little")
+                     for i in range(256)], dtype=np.uint32)
+
+    def __init__(self, avg_size=64 * 1024, min_size=None, max_size=None,
+                 read_size=8 * 1024 * 1024):
+        self.avg_size = avg_size
+        self.min_size = min_size if min_size is not None else avg_size // 4
+        self.max_size = max_size if max_size is not None else avg_size * 4
+        if not (GearChunker.window <= self.min_size <= self.avg_size <= self.max_size):
+            msg = "need {0} <= min_size <= avg_size <= max_size, got {1} {2} {3}".format(
+                GearChunker.window, self.min_size, self.avg_size, self.max_size)
+            raise ValueError(msg)
+        self.read_size = max(read_size, 2 * self.max_size)
+        bits = max(int(round(np.log2(avg_size))), 4)
+        # masks on the top bits, which depend on the whole window
+        self.mask_strict = np.uint32(((1 << (bits + 2)) - 1) << (32 - (bits + 2)))
+        self.mask_loose = np.uint32(((1 << (bits - 2)) - 1) << (32 - (bits - 2)))
+
+    @staticmethod
+    def gear_hash(buf):
+        h = GearChunker.gear[np.frombuffer(buf, dtype=np.uint8)]
+        m = 1
+        while m < GearChunker.window:
+            # the shifted right hand side is built before the add, so in place is safe
+            h[m:] += h[:-m] << np.uint32(m)
+            m *= 2
+        return h
+
+    def cut_points(self, buf, final):
+        """
+        :return: list of chunk end offsets in buf; the bytes after the
+            last one are left over for the next buffer unless final
+        """
+        h = GearChunker.gear_hash(buf)
+        # a cut after byte i ends the chunk at i + 1
+        strict = np.flatnonzero((h & self.mask_strict) == 0) + 1
+        loose = np.flatnonzero((h & self.mask_loose) == 0) + 1
+        ends = []
+        start = 0
+        nbytes = len(buf)
+        while True:
+            if nbytes - start <= self.min_size or (not final and nbytes - start < self.max_size):
+                break
+            end = None
+            i = np.searchsorted(strict, start + self.min_size)
+            if i < len(strict) and strict[i] < start + self.avg_size:
+                end = int(strict[i])
+            else:
+                i = np.searchsorted(loose, start + self.avg_size)
+                if i < len(loose) and loose[i] < start + self.max_size:
+                    end = int(loose[i])
+            if end is None:
+                end = start + self.max_size
+            if end > nbytes:
+                break
+            ends.append(end)
+            start = end
+        if final and start < nbytes:
+            ends.append(nbytes)
+        return ends
+
+    def chunks(self, fp):
+        leftover = b''
+        while True:
+            data = fp.read(self.read_size)
+            final = len(data) == 0
+            buf = leftover + data
+            if len(buf) == 0:
+                return
+            start = 0
+            for end in self.cut_points(buf, final):
+                yield buf[start:end]
+                start = end
+            leftover = buf[start:]
+            if final:
+                return
+
+
+class PackStore(object):
+    """
+    append-only pack files under <destroot>/packs
+
+    Small files and chunks are appended to a large segment file instead
+    of each getting a directory, a data file and a meta file.  Every entry
+    is a fixed header, its key and its data:
+
+        magic, kind, codec, key length, crc32 of data, data length
+
+    kind b"D" is data stored under its key (the sha256 of the contents),
+    kind b"M" is the JSON meta record of a packed version.  The index
+    keeps (pack, offset, length) of every data entry, so a read is one
+    seek; the packs themselves are only scanned by rebuild.  A pack is
+    sealed once it reaches seal_size and the next entry starts a new one.
+
+    A key counts as stored only once its entry is appended and indexed;
+    a put or has of a key another thread is still storing waits for it.
+    """
+    foldername = "packs"
+    pack_ext = ".pack"
+    magic = b"GBPK"
+    header = struct.Struct("<4sccHIQ")
+
+    def __init__(self, destroot, index, seal_size=64 * 1024 * 1024,
+                 small_size=1024 * 1024, comp_thresh=0.9,
+                 compresslevel=zlib.Z_DEFAULT_COMPRESSION, verbosity=0):
+        """
+        :param destroot: backup root
+        :param index: BackupIndex holding the entry offsets
+        :param seal_size: start a new pack once the current one is this big
+        :param small_size: files smaller than this are packed
+        :param comp_thresh: keep the zlib compressed data if the ratio is below this
+        """
+        if index is None:
+            raise ValueError("a PackStore needs a BackupIndex")
+        self.destroot = destroot
+        self.root = os.path.join(destroot, PackStore.foldername)
+        self.index = index
+        self.seal_size = seal_size
+        self.small_size = small_size
+        self.comp_thresh = comp_thresh
+        self.compresslevel = compresslevel
+        self.verbosity = verbosity
+        self.lock = threading.Lock()
+        self.fp = None
+        self.packname = None
+        # keys appended and indexed, and key -> Event of the puts in progress
+        self.known = set()
+        self.pending = {}
+
+    def packpath(self, packname):
+        return os.path.join(self.root, packname)
+
+    @staticmethod
+    def scan(packpath):
+        """
+        walk the entries of one pack
+
+        :return: generator of (offset, kind, codec, key, crc, length, data offset);
+            stops at the first incomplete entry, the tail of an interrupted write
+        """
+        with open(packpath, mode="rb") as fp:
+            end = os.fstat(fp.fileno()).st_size
+            offset = 0
+            while offset + PackStore.header.size <= end:
+                fp.seek(offset)
+                magic, kind, codec, keylen, crc, length = PackStore.header.unpack(
+                    fp.read(PackStore.header.size))
+                data_offset = offset + PackStore.header.size + keylen
+                if magic != PackStore.magic or data_offset + length > end:
+                    return
+                key = fp.read(keylen).decode("UTF-8")
+                yield offset, kind, codec, key, crc, length, data_offset
+                offset = data_offset + length
+
+    def open_pack(self):
+        """
+        reopen the newest pack if it is not sealed, else start a new one;
+        an incomplete entry at the end of the pack is cut off
+        """
+        os.makedirs(self.root, exist_ok=True)
+        packs = sorted(f for f in os.listdir(self.root) if f.endswith(PackStore.pack_ext))
+        number = 0
+        if len(packs) > 0:
+            last = packs[-1]
+            number = int(last[len("pack_"):-len(PackStore.pack_ext)])
+            lastpath = self.packpath(last)
+            if os.path.getsize(lastpath) < self.seal_size:
+                good_end = 0
+                for offset, _, _, _, _, length, data_offset in PackStore.scan(lastpath):
+                    good_end = data_offset + length
+                self.fp = open(lastpath, mode="r+b")
+                self.fp.truncate(good_end)
+                self.fp.seek(good_end)
+                self.packname = last
+                return
+            number += 1
+        self.packname = "pack_{0:06d}{1}".format(number, PackStore.pack_ext)
+        self.fp = open(self.packpath(self.packname), mode="wb")
+
+    def seal(self):
+        if self.fp is None:
+            return
+        self.fp.flush()
+        os.fsync(self.fp.fileno())
+        self.fp.close()
+        self.fp = None
+
+    def close(self):
+        with self.lock:
+            self.seal()
+
+    def append(self, kind, codec, key, data):
+        """
+        append one entry to the open pack, sealing it when full
+
+        :return: (pack name, offset) of the entry
+        """
+        if self.fp is None:
+            self.open_pack()
+        keyb = key.encode("UTF-8")
+        offset = self.fp.tell()
+        self.fp.write(PackStore.header.pack(PackStore.magic, kind, codec, len(keyb),
+                                            zlib.crc32(data), len(data)) + keyb)
+        self.fp.write(data)
+        # readers use their own handle, so nothing may sit in our buffer
+        self.fp.flush()
+        packname = self.packname
+        if self.fp.tell() >= self.seal_size:
+            self.seal()
+        return packname, offset
+
+    def has(self, key):
+        """
+        True if key is stored and indexed, after waiting for a put of it
+        in progress on another thread
+        """
+        with self.lock:
+            if key in self.known:
+                return True
+            event = self.pending.get(key)
+        if event is not None:
+            event.wait()
+        return key in self.known or self.index.find_pack_entry(key) is not None
+
+    def claim(self, key):
+        """
+        :return: True if the caller is to store key, False once it is
+            stored, by this or another thread
+        """
+        while True:
+            with self.lock:
+                if key in self.known or self.index.find_pack_entry(key) is not None:
+                    return False
+                event = self.pending.get(key)
+                if event is None:
+                    self.pending[key] = threading.Event()
+                    return True
+            # stored by another thread right now; if that fails, try again
+            event.wait()
+
+    def release(self, key, stored):
+        with self.lock:
+            if stored:
+                self.known.add(key)
+            self.pending.pop(key).set()
+
+    def put(self, key, data, codec="deflate", level=None):
+        """
+        store data under key unless it is already there
+
+        :param codec: Codecs name to try, kept if it gets under comp_thresh
+        :param level: codec level, None for compresslevel with deflate
+        :return: number of bytes written to the pack, 0 if it was there;
+            either way the entry is indexed when put returns
+        """
+        if not self.claim(key):
+            return 0
+        stored = False
+        try:
+            length = self.put_claimed(key, data, codec=codec, level=level)
+            stored = True
+        finally:
+            self.release(key, stored)
+        return length
+
+    def put_claimed(self, key, data, codec="deflate", level=None):
+        if codec == "deflate" and level is None:
+            level = self.compresslevel
+        comp = None
+        if codec != "stored" and len(data) > 64:
+            comp = Codecs.compress(codec, data, level)
+        if comp is not None and len(comp) <= self.comp_thresh * len(data):
+            tag, stored = Codecs.tags[codec], comp
+        else:
+            tag, stored = Codecs.tags["stored"], data
+        with self.lock:
+            packname, offset = self.append(b"D", tag, key, stored)
+        self.index.add_pack_entry(key, packname, offset, len(stored),
+                                  tag.decode("ascii"), len(data))
+        return len(stored)
+
+    def put_meta(self, meta_dict):
+        """
+        append the meta record of a packed version, read back by rebuild
+        :return: path of the pack it went into
+        """
+        key = "{0}|{1}".format(meta_dict["filepath"], meta_dict["version"])
+        with self.lock:
+            packname, _ = self.append(b"M", b"R", key, json.dumps(meta_dict).encode("UTF-8"))
+        return self.packpath(packname)
+
+    def read_at(self, packname, offset, key=None):
+        """
+        read the entry at offset in packname, checking key and crc
+
+        :return: the entry's data, decompressed
+        """
+        with open(self.packpath(packname), mode="rb") as fp:
+            fp.seek(offset)
+            magic, kind, codec, keylen, crc, length = PackStore.header.unpack(
+                fp.read(PackStore.header.size))
+            if magic != PackStore.magic:
+                raise RuntimeError("no pack entry at {0} in {1}".format(offset, packname))
+            entry_key = fp.read(keylen).decode("UTF-8")
+            data = fp.read(length)
+        if key is not None and entry_key != key:
+            msg = "pack entry at {0} in {1} is {2}, expected {3}".format(offset, packname,
+                                                                         entry_key, key)
+            raise RuntimeError(msg)
+        if len(data) != length or zlib.crc32(data) != crc:
+            raise RuntimeError("corrupt pack entry at {0} in {1}".format(offset, packname))
+        return Codecs.decompress(Codecs.by_tag(codec), data)
+
+    def get(self, key):
+        entry = self.index.find_pack_entry(key)
+        if entry is None:
+            raise KeyError("{0} is not in the packs".format(key))
+        packname, offset = entry
+        return self.read_at(packname, offset, key=key)
+
+
+class ChunkStore(object):
+    """
+    content addressed chunk store under <destroot>/chunks
+
+    A file is split into chunks and each chunk is stored once, under its
+    sha256, zlib compressed if that gets under comp_thresh.  The stored
+    version of the file is a small ".chunks" recipe listing the chunk
+    hashes, so a large file that changes by a few KB only adds the
+    chunks that changed.  With a PackStore the chunks go into its packs
+    instead of one file each.  As there, a chunk another thread is still
+    writing is waited for, so no recipe names a chunk before it exists.
+    """
+    foldername = "chunks"
+    recipe_ext = ".chunks"
+
+    def __init__(self, destroot, index=None, chunker=None,
+                 min_size=1024 * 1024, comp_thresh=0.9,
+                 compresslevel=zlib.Z_DEFAULT_COMPRESSION, packs=None, verbosity=0):
+        self.destroot = destroot
+        self.root = os.path.join(destroot, ChunkStore.foldername)
+        self.index = index
+        self.packs = packs
+        self.chunker = chunker if chunker is not None else FixedChunker()
+        self.min_size = min_size
+        self.comp_thresh = comp_thresh
+        self.compresslevel = compresslevel
+        self.verbosity = verbosity
+        self.lock = threading.Lock()
+        # chunks written and indexed, and chash -> Event of the puts in progress
+        self.known = set()
+        self.pending = {}
+        if packs is None:
+            os.makedirs(self.root, exist_ok=True)
+
+    chunkers = {"fixed": FixedChunker, "gear": GearChunker}
+
+    @staticmethod
+    def make_chunker(chunker="fixed", chunk_size=1024 * 1024):
+        """
+        :param chunker: "fixed" or "gear", or a chunker object used as is
+        :param chunk_size: the chunk size, the average chunk size for "gear"
+        """
+        if not isinstance(chunker, str):
+            return chunker
+        if chunker not in ChunkStore.chunkers:
+            msg = "chunker should be one of {0}, got {1}".format(sorted(ChunkStore.chunkers), chunker)
+            raise ValueError(msg)
+        return ChunkStore.chunkers[chunker](chunk_size)
+
+    def chunkpath(self, chash):
+        return os.path.join(self.root, chash[:2], chash[2:4], chash)
+
+    def stored(self, chash):
+        if chash in self.known:
+            return True
+        if self.index is not None:
+            return self.index.has_chunk(chash)
+        return os.path.isfile(self.chunkpath(chash))
+
+    def has_chunk(self, chash):
+        if self.packs is not None:
+            return self.packs.has(chash)
+        with self.lock:
+            event = self.pending.get(chash)
+        if event is not None:
+            event.wait()
+        return self.stored(chash)
+
+    def claim(self, chash):
+        """
+        :return: True if the caller is to write chash, False once it is
+            stored, by this or another thread
+        """
+        while True:
+            with self.lock:
+                if self.stored(chash):
+                    return False
+                event = self.pending.get(chash)
+                if event is None:
+                    self.pending[chash] = threading.Event()
+                    return True
+            # written by another thread right now; if that fails, try again
+            event.wait()
+
+    def release(self, chash, stored):
+        with self.lock:
+            if stored:
+                self.known.add(chash)
+            self.pending.pop(chash).set()
+
+    def put(self, chash, data, codec="deflate", level=None):
+        """
+        store one chunk unless it is already there, as the codec's tag
+        and the compressed bytes, or raw if that misses comp_thresh
+
+        :return: number of bytes written to the store
+        """
+        if self.packs is not None:
+            return self.packs.put(chash, data, codec=codec, level=level)
+        if not self.claim(chash):
+            return 0
+        stored = False
+        try:
+            length = self.put_claimed(chash, data, codec=codec, level=level)
+            stored = True
+        finally:
+            self.release(chash, stored)
+        return length
+
+    def put_claimed(self, chash, data, codec="deflate", level=None):
+        if codec == "deflate" and level is None:
+            level = self.compresslevel
+        payload = Codecs.tags["stored"] + data
+        if codec != "stored":
+            comp = Codecs.compress(codec, data, level)
+            if len(comp) <= self.comp_thresh * len(data):
+                payload = Codecs.tags[codec] + comp
+        chunkpath = self.chunkpath(chash)
+        os.makedirs(os.path.dirname(chunkpath), exist_ok=True)
+        partialpath = "{0}.{1}{2}".format(chunkpath, threading.get_ident(), PARTIAL_EXT)
+        try:
+            with open(partialpath, mode="wb") as fp:
+                fp.write(payload)
+            os.replace(partialpath, chunkpath)
+        except Exception:
+            if os.path.isfile(partialpath):
+                os.remove(partialpath)
+            raise
+        if self.index is not None:
+            self.index.add_chunk(chash, len(data), len(payload))
+        return len(payload)
+
+    def get(self, chash):
+        chunkpath = self.chunkpath(chash)
+        if self.packs is not None and not os.path.isfile(chunkpath):
+            return self.packs.get(chash)
+        with open(chunkpath, mode="rb") as fp:
+            payload = fp.read()
+        return Codecs.decompress(Codecs.by_tag(payload[:1]), payload[1:])
+
+    def store_file(self, sourcepath, recipepath, digest=None, codec="deflate", level=None):
+        """
+        chunk sourcepath into the store and write its recipe to recipepath
+
+        :param digest: hashlib object updated with the file contents
+        :param codec: Codecs name for the new chunks
+        :param level: codec level
+        :return: (orig_size, bytes written to the chunk store)
+        """
+        if digest is None:
+            digest = hashlib.sha256()
+        recipe = []
+        orig_size = 0
+        new_bytes = 0
+        try:
+            with open(sourcepath, mode="rb") as fp:
+                for chunk in self.chunker.chunks(fp):
+                    digest.update(chunk)
+                    chash = hashlib.sha256(chunk).hexdigest()
+                    new_bytes += self.put(chash, chunk, codec=codec, level=level)
+                    recipe.append([chash, len(chunk)])
+                    orig_size += len(chunk)
+            with open(recipepath, mode="w", encoding="UTF-8") as fp:
+                json.dump({"size": orig_size,
+                           digest.name: digest.hexdigest(),
+                           "chunker": self.chunker.name,
+                           "chunks": recipe}, fp)
+        except Exception:
+            if os.path.isfile(recipepath):
+                os.remove(recipepath)
+            raise
+        return orig_size, new_bytes
+
+    def restore_file(self, recipepath, outpath):
+        """
+        rebuild a file from its recipe, checking the digest on the way
+        """
+        with open(recipepath, mode="r", encoding="UTF-8") as fp:
+            recipe = json.load(fp)
+        # the recipe keeps the digest under its algorithm's name
+        algorithm = next((name for name in FileHasher.algorithms if name in recipe), "sha256")
+        m = FileHasher.new(algorithm)
+        partialpath = outpath + PARTIAL_EXT
+        try:
+            with open(partialpath, mode="wb") as fp:
+                for chash, length in recipe["chunks"]:
+                    data = self.get(chash)
+                    if len(data) != length:
+                        msg = "chunk {0} is {1} bytes, recipe says {2}".format(chash, len(data), length)
+                        raise RuntimeError(msg)
+                    m.update(data)
+                    fp.write(data)
+            if algorithm in recipe and m.hexdigest() != recipe[algorithm]:
+                msg = "{0} mismatch restoring {1} from {2}".format(algorithm, outpath, recipepath)
+                raise RuntimeError(msg)
+            os.replace(partialpath, outpath)
+        except Exception:
+            if os.path.isfile(partialpath):
+                os.remove(partialpath)
+            raise
+        return outpath
+
+
+class RunStats(object):
+    """
+    counters and per-file errors collected over one backup run,
+    shared by all the worker threads
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.start_dt = Utilities.now()
+        self.counts = OrderedDict()
+        self.errors = []
+        self.events = []
+
+    def add(self, key, n=1):
+        with self.lock:
+            self.counts[key] = self.counts.get(key, 0) + n
+
+    def event(self, msg):
+        with self.lock:
+            self.events.append((Utilities.now(), msg))
+
+    def error(self, sourcepath, errmsg):
+        with self.lock:
+            self.errors.append((sourcepath, errmsg))
+            self.counts["errors"] = self.counts.get("errors", 0) + 1
+
+    def summary(self):
+        seconds = np.round((Utilities.now() - self.start_dt).total_seconds(), 2)
+        msglst = ["{0}: {1}".format(key, val) for key, val in self.counts.items()]
+        return "{0} seconds, ".format(seconds) + ", ".join(msglst)
+
+
+class StageMeter(object):
+    """
+    seconds spent reading, compressing and writing while one file is
+    stored, and the bytes read and written
+    """
+    def __init__(self):
+        self.seconds = {"read": 0.0, "compress": 0.0, "write": 0.0}
+        self.bytes_in = 0
+        self.bytes_out = 0
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.seconds[name] += time.perf_counter() - start
+
+
+class AdaptiveLevel(object):
+    """
+    moves the compression level up or down as a backup runs, to keep the
+    end to end MB/s up
+
+    The StageMeters of the files stored are summed over windows of
+    window_bytes read.  After each window the level steps down (to
+    "stored" at the bottom) when compressing took more than cpu_budget
+    of the time, or more time than the smaller writes saved; it steps up
+    when writing took longer than compressing and compression stays
+    well inside the budget, i.e. the destination is the bottleneck.
+    The step is a shift along each codec's ladder of levels, applied to
+    the level the CodecPolicy chose, so per type choices keep their order.
+    Changes are counted and logged as events in the RunStats.
+    """
+    ladders = {"deflate": [1, 3, 6, 9],
+               "bz2": [1, 5, 9],
+               "lzma": [0, 3, 6, 9],
+               "zstd": [1, 3, 9, 15, 19]}
+
+    def __init__(self, cpu_budget=0.5, window_bytes=32 * 1024 * 1024, stats=None, verbosity=0):
+        if not 0 < cpu_budget <= 1:
+            raise ValueError("cpu_budget should be in (0, 1], got {0}".format(cpu_budget))
+        self.cpu_budget = cpu_budget
+        self.window_bytes = window_bytes
+        self.stats = stats
+        self.verbosity = verbosity
+        self.lock = threading.Lock()
+        self.shift = 0
+        self.max_shift = max(len(ladder) for ladder in self.ladders.values()) - 1
+        # compress rate and ratio of the last window that compressed,
+        #  to judge stepping back up from "stored"
+        self.last_compress = None
+        self.window = StageMeter()
+
+    def adjust(self, codec, level):
+        """
+        :return: (codec, level) after the current shift
+        """
+        ladder = self.ladders.get(codec)
+        if ladder is None or self.shift == 0:
+            return codec, level
+        if level is None or level < 0:
+            level = Codecs.default_levels[codec]
+        base = min(range(len(ladder)), key=lambda i: abs(ladder[i] - level))
+        pos = base + self.shift
+        if pos < 0:
+            return "stored", None
+        return codec, ladder[min(pos, len(ladder) - 1)]
+
+    def record(self, meter):
+        with self.lock:
+            for name, seconds in meter.seconds.items():
+                self.window.seconds[name] += seconds
+            self.window.bytes_in += meter.bytes_in
+            self.window.bytes_out += meter.bytes_out
+            if self.window.bytes_in >= self.window_bytes:
+                self.evaluate(self.window)
+                self.window = StageMeter()
+
+    @staticmethod
+    def rate(nbytes, seconds):
+        return nbytes / seconds / 2 ** 20 if seconds > 0 else float("inf")
+
+    def evaluate(self, window):
+        read_s = window.seconds["read"]
+        compress_s = window.seconds["compress"]
+        write_s = window.seconds["write"]
+        total_s = read_s + compress_s + write_s
+        if total_s <= 0 or write_s <= 0:
+            return
+        write_bps = window.bytes_out / write_s
+        if compress_s > 0:
+            saved_frac = max(0, window.bytes_in - window.bytes_out) / window.bytes_in
+            self.last_compress = (window.bytes_in / compress_s, saved_frac)
+        elif self.last_compress is not None:
+            # stored: what the last compressing window would cost and save now
+            compress_bps, saved_frac = self.last_compress
+            compress_s = window.bytes_in / compress_bps
+            total_s += compress_s
+        else:
+            return
+        saved_s = window.bytes_in * saved_frac / write_bps
+        share = compress_s / total_s
+        step = 0
+        stored = window.seconds["compress"] == 0
+        if not stored and (share > self.cpu_budget or compress_s > saved_s):
+            step = -1
+        elif stored and share <= self.cpu_budget and compress_s < saved_s:
+            step = 1
+        elif not stored and write_s > compress_s and share < 0.75 * self.cpu_budget:
+            step = 1
+        shift = max(-self.max_shift - 1, min(self.max_shift, self.shift + step))
+        if shift == self.shift:
+            return
+        msg = ("compression level shift {0} -> {1}: read {2:.1f} MB/s, compress {3:.1f} MB/s, "
+               "write {4:.1f} MB/s, compress share {5:.2f}").format(
+            self.shift, shift,
+            self.rate(window.bytes_in, read_s),
+            self.rate(window.bytes_in, window.seconds["compress"]),
+            self.rate(window.bytes_out, write_s), share)
+        self.shift = shift
+        if self.stats is not None:
+            self.stats.add("level_changes")
+            self.stats.event(msg)
+        if self.verbosity > 0:
+            logging.getLogger(__file__).info(msg)
+
+
+class DeferredLogFilter(logging.Filter):
+    """
+    holds back the records a worker thread logs while it backs up one file,
+    so the main thread can replay them in file order
+    """
+    def __init__(self):
+        logging.Filter.__init__(self)
+        self.local = threading.local()
+
+    def start(self):
+        self.local.records = []
+
+    def stop(self):
+        records = getattr(self.local, "records", None)
+        self.local.records = None
+        return records or []
+
+    def filter(self, record):
+        records = getattr(self.local, "records", None)
+        if records is None:
+            return True
+        records.append(record)
+        return False
+
+
+class InotifyWatcher(object):
+    """
+    Linux inotify watches on folder trees, through ctypes
+
+    Every folder of a tree gets a watch; folders created later are added
+    as they appear.  Events are coalesced per path: a path is handed out
+    by pop_ready once it has been quiet for quiet_seconds, or after
+    max_delay_seconds of continuous writes.  If the kernel queue
+    overflows, events were lost, and overflowed is set so the caller can
+    reconcile with a full pass.
+    """
+    IN_MODIFY = 0x00000002
+    IN_ATTRIB = 0x00000004
+    IN_CLOSE_WRITE = 0x00000008
+    IN_MOVED_TO = 0x00000080
+    IN_CREATE = 0x00000100
+    IN_DELETE_SELF = 0x00000400
+    IN_MOVE_SELF = 0x00000800
+    IN_Q_OVERFLOW = 0x00004000
+    IN_IGNORED = 0x00008000
+    IN_ONLYDIR = 0x01000000
+    IN_ISDIR = 0x40000000
+    IN_NONBLOCK = 0o4000
+    IN_CLOEXEC = 0o2000000
+    watch_mask = (IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE
+                  | IN_DELETE_SELF | IN_MOVE_SELF | IN_ONLYDIR)
+    event = struct.Struct("iIII")
+
+    def __init__(self, exclude_folders=None, quiet_seconds=5.0,
+                 max_delay_seconds=60.0, verbosity=0):
+        if not sys.platform.startswith("linux"):
+            raise OSError("inotify is only available on Linux")
+        self.libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        self.fd = self.libc.inotify_init1(InotifyWatcher.IN_NONBLOCK | InotifyWatcher.IN_CLOEXEC)
+        if self.fd < 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, "inotify_init1: " + os.strerror(errno))
+        self.exclude_folders = list(exclude_folders or [])
+        self.quiet_seconds = quiet_seconds
+        self.max_delay_seconds = max_delay_seconds
+        self.verbosity = verbosity
+        self.folders = {}
+        # path -> (first event, last event), monotonic seconds
+        self.dirty = OrderedDict()
+        self.overflowed = False
+
+    def close(self):
+        if self.fd >= 0:
+            os.close(self.fd)
+            self.fd = -1
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def add_folder(self, folder):
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(folder), InotifyWatcher.watch_mask)
+        if wd < 0:
+            errno = ctypes.get_errno()
+            logger = logging.getLogger(__file__)
+            # most likely fs.inotify.max_user_watches, the reconcile still covers it
+            logger.warning("could not watch {0}: {1}".format(folder, os.strerror(errno)))
+            return False
+        self.folders[wd] = folder
+        return True
+
+    def add_tree(self, root, mark_dirty=False):
+        """
+        watch root and every folder under it that is not excluded
+
+        :param mark_dirty: mark the files found dirty, for a folder created
+            after the watches were set, whose files may predate its watch
+        """
+        for folder, entries in Utilities.scan_tree(root, exclude_folders=self.exclude_folders):
+            self.add_folder(folder)
+            if mark_dirty:
+                for entry in entries:
+                    self.mark(entry.path)
+
+    def mark(self, path, now=None):
+        if now is None:
+            now = time.monotonic()
+        first, _ = self.dirty.get(path, (now, now))
+        self.dirty[path] = (first, now)
+
+    def read_events(self, timeout=1.0):
+        """
+        wait up to timeout seconds for events and record them
+
+        :return: number of events read
+        """
+        readable, _, _ = select.select([self.fd], [], [], timeout)
+        if len(readable) == 0:
+            return 0
+        try:
+            data = os.read(self.fd, 256 * 1024)
+        except BlockingIOError:
+            return 0
+        now = time.monotonic()
+        nevents = 0
+        offset = 0
+        while offset + InotifyWatcher.event.size <= len(data):
+            wd, mask, cookie, namelen = InotifyWatcher.event.unpack_from(data, offset)
+            offset += InotifyWatcher.event.size
+            name = os.fsdecode(data[offset:offset + namelen].rstrip(b"\0"))
+            offset += namelen
+            nevents += 1
+            if mask & InotifyWatcher.IN_Q_OVERFLOW:
+                self.overflowed = True
+                continue
+            if mask & InotifyWatcher.IN_IGNORED:
+                self.folders.pop(wd, None)
+                continue
+            folder = self.folders.get(wd)
+            if folder is None or len(name) == 0:
+                continue
+            path = os.path.join(folder, name)
+            if mask & InotifyWatcher.IN_ISDIR:
+                if mask & (InotifyWatcher.IN_CREATE | InotifyWatcher.IN_MOVED_TO) \
+                        and name not in self.exclude_folders:
+                    self.add_tree(path, mark_dirty=True)
+                continue
+            self.mark(path, now)
+        return nevents
+
+    def pop_ready(self, now=None):
+        """
+        :return: list of the dirty paths that are quiet, or dirty for too long
+        """
+        if now is None:
+            now = time.monotonic()
+        ready = [path for path, (first, last) in self.dirty.items()
+                 if now - last >= self.quiet_seconds or now - first >= self.max_delay_seconds]
+        for path in ready:
+            del self.dirty[path]
+        return ready
+
+    def reset(self):
+        """
+        forget the dirty paths and the overflow, after a full reconcile
+        """
+        self.dirty.clear()
+        self.overflowed = False
+
+
+# noinspection SpellCheckingInspection,SpellCheckingInspection,PyShadowingNames,PyBroadException
+class GitBack(object):
+    # what check_file found out about a file that has to be stored
+    FilePlan = namedtuple("FilePlan", ["sourcepath", "source_stat", "source_sha256", "source_algorithm",
+                                       "prefilter", "shared", "packing", "file_ext", "this_dest_folder"])
+    # a new version encoded into its partial in the destination, left for the write stage to commit
+    StagedFile = namedtuple("StagedFile", ["plan", "partialpath", "mode", "ext"])
+
+    def __init__(self,
+                 logfilepath=None,
+                 loglevel=logging.DEBUG,
+                 dt_fmt="%Y%m%d_%H%M%S",
+                 verbosity=0):
+        self.verbosity = verbosity
+        self.dt_fmt = dt_fmt
+        self.indexes = OrderedDict()
+        self.stats = None
+        self.log_filter = DeferredLogFilter()
+        self.thread_state = threading.local()
+        self.worker_ids = itertools.count()
+        if logfilepath is None:
+            logfilepath = __name__ + "_" + Utilities.nowstr(fmt=self.dt_fmt) + ".log"
+
+        logger = logging.getLogger(__file__)
+        logger.setLevel(logging.DEBUG)
+
+        # create console handler and set level to debug
+        ch = logging.StreamHandler()
+        ch.setLevel(logging.DEBUG)
+        #ch.setFormatter(CustomFormatter())
+        # create formatter
+        #formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+        #formatter = logging.Formatter('%(levelname)s - %(message)s')
+
+        # add formatter to ch
+        #ch.setFormatter(formatter)
+
+        # add ch to logger
+        logger.addHandler(ch)
+        logger.addFilter(self.log_filter)
+        logging.basicConfig(filename=logfilepath, level=loglevel)
+
+    def get_index(self, destroot, verbosity=0):
+        """
+        open (once) the BackupIndex for a backup root,
+        rebuilding it from the store if it is new
+        """
+        verbosity = max(verbosity, self.verbosity)
+        key = os.path.abspath(destroot)
+        if key not in self.indexes:
+            index = BackupIndex(destroot, verbosity=verbosity)
+            if index.created:
+                index.rebuild(verbosity=verbosity)
+            self.indexes[key] = index
+        return self.indexes[key]
+
+    def fork(self):
+        """
+        a GitBack for a run going on alongside this one's: its own stats
+        and worker temp folders, the same open indexes and log setup
+        """
+        other = copy.copy(self)
+        other.stats = None
+        other.thread_state = threading.local()
+        other.worker_ids = itertools.count()
+        return other
+
+    def close_indexes(self):
+        for index in self.indexes.values():
+            index.close()
+        self.indexes.clear()
+
+    def backup_folders(self, folders=None,
+                       dest_drive=None,
+                       dest_folder=None,
+                       temp_folder=None,
+                       exclude_folders=None,
+                       include_exts=None,
+                       exclude_exts=None,
+                       quick_check=True,
+                       paranoid=False,
+                       workers=1,
+                       check_workers=None,
+                       write_workers=None,
+                       queue_size=None,
+                       compress_processes=0,
+                       storage="file",
+                       chunker="fixed",
+                       chunk_size=1024 * 1024,
+                       pack_size=64 * 1024 * 1024,
+                       dedup=True,
+                       algorithm="sha256",
+                       use_prefilter=True,
+                       codec_policy=None,
+                       adaptive=False,
+                       cpu_budget=0.5,
+                       journal=None,
+                       snapshot=None,
+                       stats=None,
+                       verbosity=0):
+        """
+        try to backup folders to a destination
+
+        :param folders: list of folders to backup
+        :param dest_drive: destination drive
+        :param dest_folder: destination root directory
+        :param temp_folder: for temp files
+        :param exclude_folders: folder names to exclude
+        :param include_exts: extensions to include
+        :param exclude_exts: extensions to exclude
+        :param quick_check: skip files whose stat is unchanged since the last backup
+        :param paranoid: always read and hash every file, even if quick_check passes
+        :param workers: number of threads backing up files
+        :param check_workers: threads checking files ahead of the store threads
+        :param write_workers: threads writing the stored files to the destination
+        :param queue_size: files queued between the stages of the pipeline
+        :param compress_processes: if > 0, size of the process pool
+            doing the zip compression
+        :param storage: "file" for a whole copy of each version,
+            "chunked" to store large files as deduplicated chunks,
+            "packed" to also append small files and chunks to pack files
+        :param chunker: "fixed" or "gear" (content defined) chunks
+        :param chunk_size: chunk size, or average chunk size for "gear"
+        :param pack_size: size at which a pack file is sealed
+        :param dedup: store identical contents once across all source paths
+        :param algorithm: digest of new versions, "sha256" or "blake2b"
+        :param use_prefilter: skip the hash first pass when size and
+            head/tail already show the contents are new
+        :param codec_policy: CodecPolicy, codec name or "auto" for the default
+            rules, None for deflate at compresslevel
+        :param adaptive: raise or lower the codec levels, down to storing,
+            from the read, compress and write speeds measured during the run
+        :param cpu_budget: with adaptive, the most of the time compression may take
+        :param journal: RunJournal to record the stored versions in,
+            by default one is opened for the run
+        :param snapshot: Snapshot to add the files seen to, by default
+            one is written for the run
+        :param stats: RunStats to add the counts and errors to
+        :param verbosity: level of diagnostics
+        :return: 0 on success
+        """
+
+        ldict = locals()
+        verbosity = max(self.verbosity, verbosity)
+        logger = logging.getLogger(__file__)
+        Utilities.check_folders(folders)
+        errmsg = ''
+        req_param_types = {"folders": list,
+                           "dest_drive": str,
+                           "dest_folder": str}
+        for pname in req_param_types.keys():
+            ptype = req_param_types[pname]
+            val = ldict[pname]
+            if val is None:
+                errmsg += "No {0} specified".format(pname)
+            elif not isinstance(val, ptype):
+                errmsg += "{0} should be {1}, got {2}".format(pname, ptype, type(val))
+        if len(errmsg) > 0:
+            raise RuntimeError(errmsg)
+
+        msg = "Backup starting {0}".format(datetime.datetime.now())
+        logger.info(msg)
+        if stats is None:
+            stats = RunStats()
+        engine = None
+        if compress_processes > 0:
+            engine = CompressionEngine(processes=compress_processes, verbosity=verbosity)
+        # one level controller, journal and snapshot for the whole run
+        level_control = None
+        if adaptive:
+            level_control = AdaptiveLevel(cpu_budget=cpu_budget, stats=stats, verbosity=verbosity)
+        own_journal = journal is None
+        if own_journal:
+            journal = RunJournal(os.path.join(dest_drive, dest_folder), verbosity=verbosity)
+        own_snapshot = snapshot is None
+        if own_snapshot:
+            snapshot = Snapshot(os.path.join(dest_drive, dest_folder), verbosity=verbosity)
+        
+        for folder in folders:
+            if not os.path.isdir(folder):
+                msg = "'{0}' not a folder".format(folder)
+                raise ValueError(msg)
+            pp = PurePath(folder)
+            less_drive = os.sep.join(pp.parts[1:])
+
+            destroot = os.path.join(dest_drive, dest_folder)
+            if verbosity > 0:
+                msg = "Source folder= {0}".format(folder)
+                msg += "\nSource less drive: {0}".format(less_drive)
+                msg += "\nDest root: {0}".format(destroot)
+                logger.info(msg)
+            try:
+                self.backup_folder(sourceroot=folder,
+                                   destroot=destroot,
+                                   exclude_exts=exclude_exts,
+                                   exclude_folders=exclude_folders,
+                                   tempfolder=temp_folder,
+                                   quick_check=quick_check,
+                                   paranoid=paranoid,
+                                   workers=workers,
+                                   check_workers=check_workers,
+                                   write_workers=write_workers,
+                                   queue_size=queue_size,
+                                   engine=engine,
+                                   storage=storage,
+                                   chunker=chunker,
+                                   chunk_size=chunk_size,
+                                   pack_size=pack_size,
+                                   dedup=dedup,
+                                   algorithm=algorithm,
+                                   use_prefilter=use_prefilter,
+                                   codec_policy=codec_policy,
+                                   adaptive=level_control,
+                                   journal=journal,
+                                   snapshot=snapshot,
+                                   stats=stats,
+                                   testing=False,
+                                   verbosity=verbosity)
+            except PermissionError as e:
+                msg = Utilities.last_exception_info(verbose=verbosity)
+                warnings.warn(msg)
+                raise PermissionError(msg)
+            except Exception as e:
+                msg = Utilities.last_exception_info(verbose=verbosity)
+                logger.error(msg)
+                warnings.warn(e)
+            else:
+                msg = "Seems ok {0}".format(datetime.datetime.now())
+                logger.info(msg)
+        if engine is not None:
+            engine.close()
+        if own_journal:
+            journal.close()
+        else:
+            journal.flush()
+        if own_snapshot:
+            snapshot.write(self.get_index(os.path.join(dest_drive, dest_folder), verbosity=verbosity))
+        self.stats = stats
+        logger.info("Backup done, {0}".format(stats.summary()))
+        for event_dt, msg in stats.events:
+            logger.info("  {0} {1}".format(event_dt, msg))
+        for sourcepath, errmsg in stats.errors:
+            logger.error("  failed: {0}".format(sourcepath))
+        return 0
+
+    def watch_folders(self, folders=None,
+                      dest_drive=None,
+                      dest_folder=None,
+                      temp_folder=None,
+                      exclude_folders=None,
+                      include_exts=None,
+                      exclude_exts=None,
+                      workers=1,
+                      storage="file",
+                      quiet_seconds=5.0,
+                      max_delay_seconds=60.0,
+                      reconcile_seconds=3600.0,
+                      run_seconds=None,
+                      stop_event=None,
+                      verbosity=0):
+        """
+        continuous backup on Linux: back up files as inotify reports them
+        changed, instead of rescanning everything
+
+        A full backup_folders pass runs first, then again every
+        reconcile_seconds, and at once if the inotify queue overflowed,
+        to catch what the events missed.  All the passes share one run
+        journal.  Each full pass writes a snapshot, and every batch of
+        changed files after it rewrites that snapshot with their new
+        versions, so recover of the latest snapshot finds them.
+
+        :param folders: list of folders to backup
+        :param dest_drive: destination drive
+        :param dest_folder: destination root directory
+        :param temp_folder: for temp files
+        :param exclude_folders: folder names to exclude, never watched
+        :param include_exts: extensions to include
+        :param exclude_exts: extensions to exclude
+        :param workers: number of threads backing up files
+        :param storage: "file", "chunked" or "packed", see backup_folder
+        :param quiet_seconds: back up a changed file once it has had no
+            events for this long
+        :param max_delay_seconds: back up a file written to continuously
+            after this long anyway
+        :param reconcile_seconds: seconds between full passes
+        :param run_seconds: stop after this long, None to run until stop_event
+        :param stop_event: threading.Event that stops the watch when set
+        :param verbosity: level of diagnostics
+        :return: RunStats of the whole watch, full passes included
+        """
+        verbosity = max(self.verbosity, verbosity)
+        logger = logging.getLogger(__file__)
+        destroot = os.path.join(dest_drive, dest_folder)
+        full_pass = dict(folders=folders,
+                         dest_drive=dest_drive,
+                         dest_folder=dest_folder,
+                         temp_folder=temp_folder,
+                         exclude_folders=exclude_folders,
+                         include_exts=include_exts,
+                         exclude_exts=exclude_exts,
+                         workers=workers,
+                         storage=storage,
+                         verbosity=verbosity)
+        roots = [os.path.abspath(folder) for folder in folders]
+        stats = RunStats()
+        index = self.get_index(destroot, verbosity=verbosity)
+        start = time.monotonic()
+        with InotifyWatcher(exclude_folders=exclude_folders,
+                            quiet_seconds=quiet_seconds,
+                            max_delay_seconds=max_delay_seconds,
+                            verbosity=verbosity) as watcher, \
+                RunJournal(destroot, verbosity=verbosity) as journal:
+            # watch first, so nothing changed during the first pass is missed
+            for root in roots:
+                watcher.add_tree(root)
+            logger.info("watching {0} folders under {1}".format(len(watcher.folders), roots))
+            snapshot = Snapshot(destroot, verbosity=verbosity)
+            self.backup_folders(journal=journal, snapshot=snapshot, stats=stats, **full_pass)
+            snapshot.write(index)
+            last_full = time.monotonic()
+            while True:
+                if stop_event is not None and stop_event.is_set():
+                    break
+                if run_seconds is not None and time.monotonic() - start >= run_seconds:
+                    break
+                watcher.read_events(timeout=min(1.0, quiet_seconds))
+                if watcher.overflowed or time.monotonic() - last_full >= reconcile_seconds:
+                    if watcher.overflowed:
+                        logger.warning("inotify queue overflowed, running a full pass")
+                    watcher.reset()
+                    snapshot = Snapshot(destroot, verbosity=verbosity)
+                    self.backup_folders(journal=journal, snapshot=snapshot, stats=stats, **full_pass)
+                    snapshot.write(index)
+                    last_full = time.monotonic()
+                    continue
+                ready = watcher.pop_ready()
+                if len(ready) == 0:
+                    continue
+                if verbosity > 0:
+                    logger.info("{0} changed files <{1}>".format(len(ready), Utilities.now()))
+                for root in roots:
+                    prefix = root.rstrip(os.sep) + os.sep
+                    paths = [p for p in ready if p.startswith(prefix)]
+                    if len(paths) == 0:
+                        continue
+                    try:
+                        self.backup_folder(sourceroot=root,
+                                           destroot=destroot,
+                                           tempfolder=temp_folder,
+                                           exclude_folders=exclude_folders,
+                                           include_exts=include_exts,
+                                           exclude_exts=exclude_exts,
+                                           workers=workers,
+                                           storage=storage,
+                                           journal=journal,
+                                           snapshot=snapshot,
+                                           paths=paths,
+                                           stats=stats,
+                                           verbosity=verbosity)
+                    except Exception:
+                        msg = Utilities.last_exception_info(verbose=verbosity)
+                        logger.error(msg)
+                # the batch's new versions replace the ones the snapshot had
+                snapshot.write(index)
+        self.stats = stats
+        logger.info("Watch done, {0}".format(stats.summary()))
+        return stats
+
+    @staticmethod
+    def clean_temp_folder(tempfolder, verbosity=0):
+        logger = logging.getLogger(__file__)
+        if verbosity > 0:
+            msg = f"{Utilities.whoami()} <{Utilities.now()}>"
+            logger.info(msg)
+        tempfiles = os.listdir(tempfolder)
+        for tfile in tempfiles:
+            try:
+                tpath = os.path.join(tempfolder, tfile)
+
+                if os.path.isfile(tpath):
+                    if verbosity > 0:
+                        msg = f"   file {tempfolder}  {tfile}"
+                        logger.info(msg)
+                    os.remove(os.path.join(tempfolder, tfile))
+                elif os.path.isdir(tpath):
+                    if verbosity > 0:
+                        msg = f"  folder {tempfolder}  {tfile}"
+                        logger.info(msg)
+                    shutil.rmtree(tpath)
+            except Exception as e:
+                msg = f"  Error deleting File: {tpath}"
+                msg += Utilities.last_exception_info()
+                msg += Utilities.nowstr()
+                logger = logging.getLogger(__file__)
+                logger.error(msg)
+                raise RuntimeError(msg)
+
+    @staticmethod
+    def make_temp_folder(tempfolder, exclude_folders=None, verbosity=0):
+        try:
+            if tempfolder is None:
+                tempfoldername = "zztemp"
+                tempfolder = os.path.join(os.path.splitext(__file__)[0], tempfoldername)
+                if exclude_folders is None:
+                    exclude_folders = []
+                exclude_folders.append(tempfoldername)
+            if not os.path.isdir(tempfolder):
+                os.makedirs(tempfolder)
+
+            tempfiles = os.listdir(tempfolder)
+            for tfile in tempfiles:
+                try:
+                    tpath = os.path.join(tempfolder, tfile)
+                    if os.path.isfile(tpath):
+                        os.remove(os.path.join(tempfolder, tfile))
+                    elif os.path.isdir(tpath):
+                        shutil.rmtree(tpath)
+                except:
+                    msg = Utilities.last_exception_info()
+                    print(msg)
+                    raise RuntimeError(msg)
+            return tempfolder
+        except Exception as e:
+            msg = Utilities.last_exception_info()
+            logger.warning(msg)
+            RuntimeError(e)
+
+    def backup_folder(self, sourceroot,
+                      destroot,
+                      tempfolder=None,
+                      exclude_folders=None,
+                      include_exts=None,
+                      exclude_exts=None,
+                      dt_fmt='%Y-%m-%dT%H:%M:%S',
+                      comp_thresh=0.9,
+                      compression=zipfile.ZIP_DEFLATED,
+                      compresslevel=zlib.Z_DEFAULT_COMPRESSION,
+                      use_index=True,
+                      quick_check=True,
+                      paranoid=False,
+                      workers=1,
+                      check_workers=None,
+                      write_workers=None,
+                      queue_size=None,
+                      engine=None,
+                      compress_processes=0,
+                      probe=True,
+                      storage="file",
+                      chunker="fixed",
+                      chunk_size=1024 * 1024,
+                      pack_size=64 * 1024 * 1024,
+                      dedup=True,
+                      algorithm="sha256",
+                      use_prefilter=True,
+                      codec_policy=None,
+                      adaptive=None,
+                      journal=None,
+                      snapshot=None,
+                      paths=None,
+                      stats=None,
+                      testing=False,
+                      verbosity=0):
+
+        """
+        try to make a backup of a single folder
+        :param sourceroot: original (source) path
+        :param destroot: destination path
+        :param tempfolder: folder for temp files
+        :param include_exts: file extensions to include
+        :param exclude_exts: file extensions to exclude
+        :param dt_fmt: format for dates
+        :param comp_thresh: threshold for compression
+            if compression ratio less than this then don't compress
+        :param compression: method for compression
+        :param compresslevel: level of compression
+        :param use_index: look up stored contents in the BackupIndex
+            instead of re-hashing every earlier version
+        :param quick_check: skip files whose (size, mtime_ns, inode, ctime)
+            match the last successful backup, without opening them
+        :param paranoid: ignore quick_check and hash every file
+        :param workers: number of threads running the per-file
+            hash, compare, compress and copy work; each gets its own temp folder.
+            With more than one, the files go through run_pipeline and
+            workers is the concurrency of its store stage
+        :param check_workers: concurrency of the pipeline's check stage
+            (quick check, hash and lookup), by default workers
+        :param write_workers: concurrency of the pipeline's write stage
+            (renaming the stored files into place and committing them), by default workers
+        :param queue_size: files queued between pipeline stages, by default 4 * workers
+        :param engine: CompressionEngine to zip with, shared between folders
+        :param compress_processes: if > 0 and no engine given,
+            start a CompressionEngine with this many processes
+        :param probe: estimate compressibility from sampled blocks and
+            store clearly incompressible files without compressing them
+        :param storage: "file" keeps a whole copy or zip of each version,
+            "chunked" stores files of at least chunk_size in a ChunkStore
+            so unchanged chunks are stored once, "packed" is "chunked" with
+            the chunks and all files under chunk_size appended to pack files
+        :param chunker: how "chunked" storage cuts files, "fixed" size
+            chunks or "gear" content defined chunks that survive inserts
+        :param chunk_size: chunk size for "chunked" storage,
+            the average size for "gear"
+        :param pack_size: size at which a pack file is sealed, for "packed"
+        :param dedup: store contents already stored under another source
+            path as a hardlink or index reference instead of a new copy
+        :param algorithm: digest of new versions, "sha256" or "blake2b"
+        :param use_prefilter: record a size and head/tail fingerprint with each
+            version, so changed files are not hashed twice
+        :param codec_policy: CodecPolicy, a codec name for all files,
+            "auto" for the default rules by extension and size, or None
+            for deflate at compresslevel
+        :param adaptive: AdaptiveLevel to adjust the codec levels with as
+            the run goes, True for one of this call's own
+        :param journal: RunJournal to record the stored versions in,
+            by default one is opened for this call
+        :param snapshot: Snapshot to add the files seen to, by default
+            one is written for this call if use_index and not paths
+        :param paths: back up only these files under sourceroot, as found
+            by a watcher, instead of walking the tree
+        :param stats: RunStats to collect counts and per-file errors in
+        :param testing: switch for just testing process
+        :param verbosity: level of diagnostics
+        :return: 0 on success
+        """
+        argdict = locals().copy()
+        verbosity = max(verbosity, self.verbosity)
+        logger = logging.getLogger(__file__)
+        if verbosity > 0:
+            msg = "{0} <{1}>".format(Utilities.whoami(), Utilities.now())
+            for key in argdict.keys():
+                msg += "\n  {0}: {1}".format(key, argdict[key])
+            logger.info(msg)
+
+        tempfolder = GitBack.make_temp_folder(tempfolder=tempfolder,
+                                              exclude_folders=exclude_folders,
+                                              verbosity=verbosity)
+        # process include_exts and exclude_exts
+        for xname in ('include_exts', 'exclude_exts'):
+            x = argdict[xname]
+            if isinstance(x, str):
+                x = [x]
+            if isinstance(x, list):
+                if len(x) == 0:
+                    x = None
+            elif x is not None:
+                raise ValueError("{0} should be None or string or list of strings")
+            if verbosity > 1:
+                logger.info("{0}: {1}".format(xname, x))
+            locals()[xname] = x
+
+        pp_sourceroot = PurePath(sourceroot)
+        if not pp_sourceroot.is_absolute():
+            logger.warning("sourceroot must be absolute, {0}".format(sourceroot))
+
+        pp_destroot = PurePath(destroot)
+        if not pp_destroot.is_absolute():
+            logger.warning("destroot must be absolute, {0}".format(destroot))
+
+        if (sourceroot == destroot) or (pp_sourceroot == pp_destroot):
             msg = "sourceroot cannot be same as destfolder"
             msg += "Please choose a different destfolder so files will not be overwritten"
             raise RuntimeError(msg)
@@ -1007,63 +4102,350 @@ class GitBack(object):
         Utilities.check_make_path(destroot, verbosity=verbosity)
 
         destfolder = os.sep.join(pp_destroot.parts[1:])
+        index = self.get_index(destroot, verbosity=verbosity) if use_index else None
+        if stats is None:
+            stats = RunStats()
+        self.stats = stats
+        if adaptive is True:
+            adaptive = AdaptiveLevel(stats=stats, verbosity=verbosity)
+
+        own_engine = False
+        if engine is None and compress_processes > 0:
+            engine = CompressionEngine(processes=compress_processes, verbosity=verbosity)
+            own_engine = True
+        chunk_store = None
+        own_journal = journal is None
+        if own_journal:
+            journal = RunJournal(destroot, verbosity=verbosity)
+        # a snapshot is of the whole tree, not of a few paths
+        own_snapshot = snapshot is None and index is not None and paths is None
+        if own_snapshot:
+            snapshot = Snapshot(destroot, verbosity=verbosity)
+        if snapshot is not None:
+            snapshot.add_root(sourceroot)
+        pack_store = None
+        if storage == "packed":
+            if index is None:
+                raise ValueError("storage 'packed' needs use_index")
+            pack_store = PackStore(destroot, index,
+                                   seal_size=pack_size,
+                                   small_size=chunk_size,
+                                   comp_thresh=comp_thresh,
+                                   compresslevel=compresslevel,
+                                   verbosity=verbosity)
+        if storage in ("chunked", "packed"):
+            chunk_store = ChunkStore(destroot, index=index,
+                                     chunker=ChunkStore.make_chunker(chunker, chunk_size),
+                                     min_size=chunk_size,
+                                     comp_thresh=comp_thresh,
+                                     compresslevel=compresslevel,
+                                     packs=pack_store,
+                                     verbosity=verbosity)
+        elif storage != "file":
+            msg = "storage should be 'file', 'chunked' or 'packed', got {0}".format(storage)
+            raise ValueError(msg)
 
-        # Walk the entire folder tree and compress the files in each folder.
-
-        for source_folder, _, filenames in os.walk(sourceroot, topdown=True):
-            pp_source_folder = PurePath(source_folder)
-            # dirdrive = pp_source_folder.drive
-            dirfolder = os.sep.join(pp_source_folder.parts[1:])
-            skip_folder = False
-            for ef in exclude_folders:
-                if ef in pp_source_folder.parts:
-                    skip_folder = True
-                    break
-            if skip_folder:
-                msg = "skipping {0} due to exclude_folder: {1}".format(source_folder,
-                                                                       exclude_folders)
-                logger.info(msg)
-                continue
-
-            start_dt = Utilities.now()
-            if verbosity > 0:
-                logger.info(f"'{source_folder}' --> '{destroot} {destfolder}' {len(filenames)} files <{start_dt}")
+        # Walk the entire folder tree and compress the files in each folder,
+        #  excluded folders are never entered
 
-            for fi, filename in enumerate(filenames):
-                if fi % 100 == 0:
-                    if verbosity > 0:
-                        logger.info (f"  {fi} / {len(filenames)}")
-                self.backup_file(filename=filename,
-                                 sourcefolder=source_folder,
-                                 destroot=destroot,
-                                 destfolder=destfolder,
-                                 tempfolder=tempfolder,
-                                 include_exts=include_exts,
-                                 exclude_exts=exclude_exts,
-                                 dt_fmt=dt_fmt,
-                                 comp_thresh=comp_thresh,
-                                 compression=compression,
-                                 compresslevel=compresslevel,
-                                 testing=testing, verbosity=verbosity)
-                self.clean_temp_folder(tempfolder=tempfolder)
-            end_dt = Utilities.now()
-            total_seconds = np.round((end_dt - start_dt).total_seconds(), 2)
-            if verbosity > 0:
-                logger.info(f"   done took {total_seconds} seconds <{start_dt}")
+        if paths is None:
+            folders = Utilities.scan_tree(sourceroot, exclude_folders=exclude_folders,
+                                          verbosity=verbosity)
+        else:
+            folders = Utilities.scan_paths(paths)
+        file_args = dict(destroot=destroot,
+                         destfolder=destfolder,
+                         include_exts=include_exts,
+                         exclude_exts=exclude_exts,
+                         dt_fmt=dt_fmt,
+                         comp_thresh=comp_thresh,
+                         compression=compression,
+                         compresslevel=compresslevel,
+                         index=index,
+                         quick_check=quick_check,
+                         paranoid=paranoid,
+                         engine=engine,
+                         probe=probe,
+                         chunk_store=chunk_store,
+                         pack_store=pack_store,
+                         dedup=dedup,
+                         algorithm=algorithm,
+                         use_prefilter=use_prefilter,
+                         codec_policy=CodecPolicy.make(codec_policy),
+                         adaptive=adaptive,
+                         journal=journal,
+                         snapshot=snapshot,
+                         testing=testing, verbosity=verbosity)
+        if workers > 1:
+            self.run_pipeline(folders, file_args, tempfolder, stats,
+                              check_workers=check_workers or workers,
+                              store_workers=workers,
+                              write_workers=write_workers or workers,
+                              queue_size=queue_size or 4 * workers,
+                              verbosity=verbosity)
+        else:
+            for source_folder, entries in folders:
+                start_dt = Utilities.now()
+                if verbosity > 0:
+                    logger.info(f"'{source_folder}' --> '{destroot} {destfolder}' {len(entries)} files <{start_dt}")
+
+                for fi, entry in enumerate(entries):
+                    if fi % 100 == 0:
+                        if verbosity > 0:
+                            logger.info (f"  {fi} / {len(entries)}")
+                    try:
+                        source_stat = entry.stat()
+                    except OSError:
+                        source_stat = None
+                    stats.add("files")
+                    task = self.backup_file_task(tempfolder, dict(file_args,
+                                                                  filename=entry.name,
+                                                                  sourcefolder=source_folder,
+                                                                  source_stat=source_stat))
+                    self.finish_file_task(dict(filename=entry.name, sourcefolder=source_folder),
+                                          task, stats)
+                end_dt = Utilities.now()
+                total_seconds = np.round((end_dt - start_dt).total_seconds(), 2)
+                if verbosity > 0:
+                    logger.info(f"   done took {total_seconds} seconds <{start_dt}")
+        if own_engine:
+            engine.close()
+        if pack_store is not None:
+            # the pack data is on disk before the index says where it is
+            pack_store.close()
+        if own_journal:
+            journal.close()
+        else:
+            journal.flush()
+        if index is not None:
+            index.flush()
+        if own_snapshot:
+            snapshot.write(index)
         if verbosity > 0:
             logger.info("Done")
         # meta_fp.close()
         return 0
 
+    def run_pipeline(self, folders, file_args, tempfolder, stats,
+                     check_workers=1, store_workers=1, write_workers=1, queue_size=16, verbosity=0):
+        """
+        back up the files of folders through a staged pipeline
+
+            scan -> check -> store -> write
+
+        scan walks the folders and stats the files, check runs check_file
+        (ext filters, quick check and, for contents probably stored
+        already, the hash and lookup), store compresses or chunks the
+        file in a single pass into a partial next to its place in the
+        destination, and write renames it into place and commits it to
+        the index, journal or meta files.  Small files and chunks go
+        straight into their packs and the chunk store from the store
+        stage.  Each stage runs its blocking work on its own thread
+        pool, and the stages are joined by queues of queue_size files: a
+        full queue holds the stage before it back, so a slow destination
+        stalls the source reading and compressing at most queue_size
+        files ahead, and a slow source leaves the store and write threads
+        idle instead of tied up.
+        Each file gets a sequence number as it is scanned; files that
+        finish ahead of an earlier one wait in a reorder buffer, so their
+        log records are replayed and their errors recorded in scan order.
+
+        :param folders: iterable of (folder, [DirEntry]), as from scan_tree
+        :param file_args: backup_file arguments shared by all the files
+        :param tempfolder: each worker thread gets its own folder under it
+        :param stats: RunStats to collect counts and per-file errors in
+        :param check_workers: threads running check_file
+        :param store_workers: threads compressing or chunking files
+        :param write_workers: threads writing files to the destination
+        :param queue_size: files queued between two stages
+        """
+        return asyncio.run(self.pipeline_stages(folders, file_args, tempfolder, stats,
+                                                check_workers=check_workers,
+                                                store_workers=store_workers,
+                                                write_workers=write_workers,
+                                                queue_size=queue_size,
+                                                verbosity=verbosity))
+
+    async def pipeline_stages(self, folders, file_args, tempfolder, stats,
+                              check_workers=1, store_workers=1, write_workers=1, queue_size=16,
+                              verbosity=0):
+        logger = logging.getLogger(__file__)
+        loop = asyncio.get_running_loop()
+        check_queue = asyncio.Queue(maxsize=queue_size)
+        store_queue = asyncio.Queue(maxsize=queue_size)
+        write_queue = asyncio.Queue(maxsize=queue_size)
+        scan_pool = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+        check_pool = concurrent.futures.ThreadPoolExecutor(max_workers=check_workers)
+        store_pool = concurrent.futures.ThreadPoolExecutor(max_workers=store_workers)
+        write_pool = concurrent.futures.ThreadPoolExecutor(max_workers=write_workers)
+        # finished files waiting for an earlier one, by sequence number
+        finished = {}
+        next_seq = [0]
+
+        def stat_entries(entries):
+            stats_lst = []
+            for entry in entries:
+                try:
+                    stats_lst.append(entry.stat())
+                except OSError:
+                    stats_lst.append(None)
+            return stats_lst
+
+        def finish(seq, item, task):
+            finished[seq] = (item, task)
+            while next_seq[0] in finished:
+                self.finish_file_task(*finished.pop(next_seq[0]), stats)
+                next_seq[0] += 1
+
+        async def scan():
+            seqs = itertools.count()
+            folder_iter = iter(folders)
+            while True:
+                item = await loop.run_in_executor(scan_pool, next, folder_iter, None)
+                if item is None:
+                    break
+                source_folder, entries = item
+                if verbosity > 0:
+                    logger.info(f"'{source_folder}' --> '{file_args['destroot']}' {len(entries)} files")
+                source_stats = await loop.run_in_executor(scan_pool, stat_entries, entries)
+                for entry, source_stat in zip(entries, source_stats):
+                    stats.add("files")
+                    await check_queue.put((next(seqs), dict(filename=entry.name,
+                                                            sourcefolder=source_folder,
+                                                            source_stat=source_stat)))
+
+        async def check():
+            while True:
+                entry = await check_queue.get()
+                if entry is None:
+                    return
+                seq, item = entry
+                task = await loop.run_in_executor(check_pool, self.backup_file_task, tempfolder,
+                                                  dict(file_args, check_only=True, **item), True)
+                plan, errmsg, records = task
+                if errmsg is None and isinstance(plan, GitBack.FilePlan):
+                    await store_queue.put((seq, item, plan, records))
+                else:
+                    finish(seq, item, task)
+
+        async def store():
+            while True:
+                entry = await store_queue.get()
+                if entry is None:
+                    return
+                seq, item, plan, records = entry
+                staged, errmsg, store_records = await loop.run_in_executor(
+                    store_pool, self.backup_file_task, tempfolder,
+                    dict(file_args, plan=plan, stage=True, **item), True)
+                records = records + store_records
+                if errmsg is None and isinstance(staged, GitBack.StagedFile):
+                    await write_queue.put((seq, item, staged, records))
+                else:
+                    finish(seq, item, (staged, errmsg, records))
+
+        async def write():
+            while True:
+                entry = await write_queue.get()
+                if entry is None:
+                    return
+                seq, item, staged, records = entry
+                result, errmsg, write_records = await loop.run_in_executor(
+                    write_pool, self.backup_file_task, tempfolder,
+                    dict(file_args, staged=staged, **item), True)
+                finish(seq, item, (result, errmsg, records + write_records))
+
+        checkers = [asyncio.ensure_future(check()) for _ in range(check_workers)]
+        storers = [asyncio.ensure_future(store()) for _ in range(store_workers)]
+        writers = [asyncio.ensure_future(write()) for _ in range(write_workers)]
+        try:
+            await scan()
+            for _ in checkers:
+                await check_queue.put(None)
+            await asyncio.gather(*checkers)
+            for _ in storers:
+                await store_queue.put(None)
+            await asyncio.gather(*storers)
+            for _ in writers:
+                await write_queue.put(None)
+            await asyncio.gather(*writers)
+        except BaseException:
+            for task in checkers + storers + writers:
+                task.cancel()
+            raise
+        finally:
+            for pool in (scan_pool, check_pool, store_pool, write_pool):
+                pool.shutdown(wait=True)
+            # after a failure, still replay what did finish, in order
+            for seq in sorted(finished):
+                self.finish_file_task(*finished.pop(seq), stats)
+
+    def worker_tempfolder(self, tempfolder):
+        """
+        a temp folder under tempfolder that only the calling thread uses,
+        so clean_temp_folder never wipes another worker's files
+        """
+        folders = getattr(self.thread_state, "tempfolders", None)
+        if folders is None:
+            folders = self.thread_state.tempfolders = {}
+        if tempfolder not in folders:
+            wfolder = os.path.join(tempfolder, "worker_{0}".format(next(self.worker_ids)))
+            os.makedirs(wfolder, exist_ok=True)
+            folders[tempfolder] = wfolder
+        return folders[tempfolder]
+
+    def backup_file_task(self, tempfolder, file_args, isolate=False):
+        """
+        run backup_file for one file, catching any error and holding back
+        its log records
+
+        :return: (result, errmsg, log records)
+        """
+        if isolate:
+            tempfolder = self.worker_tempfolder(tempfolder)
+        result = None
+        errmsg = None
+        self.log_filter.start()
+        try:
+            result = self.backup_file(tempfolder=tempfolder, **file_args)
+            self.clean_temp_folder(tempfolder=tempfolder)
+        except Exception:
+            errmsg = Utilities.last_exception_info()
+        finally:
+            records = self.log_filter.stop()
+        return result, errmsg, records
+
+    def finish_file_task(self, file_args, task, stats):
+        logger = logging.getLogger(__file__)
+        result, errmsg, records = task
+        for record in records:
+            logger.handle(record)
+        sourcepath = os.path.join(file_args["sourcefolder"], file_args["filename"])
+        if errmsg is None and result == -1:
+            errmsg = "could not read {0}".format(sourcepath)
+        if errmsg is not None:
+            stats.error(sourcepath, errmsg)
+            logger.error("{0}\n{1}".format(sourcepath, errmsg))
+
     @staticmethod
     def file_in_backup(sourcepath, dest_folder, temp_folder,
-                          sha_size=4096, verbosity=0):
+                          sha_size=None, index=None, source_sha256=None,
+                          algorithm="sha256", verbosity=0):
+        logger = logging.getLogger(__file__)
         if verbosity > 0:
-            logger = logging.getLogger(__file__)
             msg = f"{Utilities.whoami()} <{Utilities.now()}>"
             logger.info(msg)
-        source_sha256 = Utilities.sha_256(sourcepath, fmode='rb', encoding=None,
-                                          size=sha_size)
+        if source_sha256 is None:
+            source_sha256 = Utilities.sha_256(sourcepath, fmode='rb', encoding=None,
+                                              size=sha_size, algorithm=algorithm)
+        if index is not None:
+            # one indexed lookup instead of re-hashing every stored version
+            dpath = index.find_version(sourcepath, source_sha256)
+            if dpath is None:
+                return False
+            if verbosity > 1:
+                logger.info(f"found backed up version with matching sha256 {dpath}")
+            return dpath
+
         # now check and see if the dest folder exists
         found_sha_match = False
         if os.path.isdir(dest_folder):
@@ -1075,7 +4457,7 @@ class GitBack(object):
             dest_files = os.listdir(dest_folder)
             for dfile in dest_files:
                 dpath = os.path.join(dest_folder, dfile)
-                if not os.path.isfile(dpath):
+                if not os.path.isfile(dpath) or dfile.endswith(PARTIAL_EXT):
                     continue
                 dext = os.path.splitext(dfile)[1]
                 if dext == ".zip":
@@ -1083,9 +4465,15 @@ class GitBack(object):
                     temppath = Utilities.unzip_to_temp(dpath,
                                                        tempfolder=temp_folder,
                                                        verbosity=verbosity)
-                    dest_sha256 = Utilities.sha_256(temppath, size=sha_size)
+                    dest_sha256 = Utilities.sha_256(temppath, size=sha_size, algorithm=algorithm)
+                elif dext in Codecs.exts.values():
+                    codec = [name for name, ext in Codecs.exts.items() if ext == dext][0]
+                    temppath = Utilities.make_tempfilepath(temp_folder, base="temp",
+                                                           verbosity=verbosity)
+                    Codecs.decode_file(dpath, temppath, codec)
+                    dest_sha256 = Utilities.sha_256(temppath, size=sha_size, algorithm=algorithm)
                 else:
-                    dest_sha256 = Utilities.sha_256(dpath, size=sha_size)
+                    dest_sha256 = Utilities.sha_256(dpath, size=sha_size, algorithm=algorithm)
                 if source_sha256 == dest_sha256:
                     found_sha_match = True
                     msg = f"found backup up version wiht matching sha256"
@@ -1094,13 +4482,146 @@ class GitBack(object):
         return False
 
     @staticmethod
-    def zipped_or_orig(sourcepath, tempfolder, comp_thresh, verbosity=0):
+    def zipped_or_orig(sourcepath, tempfolder, comp_thresh,
+                       compresslevel=zlib.Z_DEFAULT_COMPRESSION,
+                       engine=None, dest_folder=None,
+                       probe=True, probe_margin=0.05,
+                       digest=None, codec="deflate", meter=None,
+                       index=None, content_hash=None, prefilter=None,
+                       size=None, memory_size=256 * 1024, probe_level=1, verbosity=0):
+        """
+        zip the file and decide from comp_thresh whether to keep the zip
+
+        With dest_folder the source is read once: each buffer feeds the
+        digest, the zip and, when the probe can't tell which will win, a
+        raw copy, all written straight into dest_folder under ".partial"
+        names.  The choice between them is made at the end and the loser
+        removed; the caller renames the winner into place.  Files of up
+        to memory_size, when it is not clear which will win, are compressed
+        in memory instead and only the winner is written.  Without
+        dest_folder the zip is made in tempfolder as before.
+
+        With probe, a few sampled blocks are compressed first; files that
+        clearly miss comp_thresh are stored as "orig" without compressing,
+        files that clearly meet it are only zipped.  The probe deflates, at
+        compresslevel when the codec is deflate and at probe_level else.
+        With an index, neither the probe nor the trial is made when the
+        index knows the contents or the file's type well enough to decide,
+        and with dest_folder the ratio reached is taught back to it.
+
+        :param digest: hashlib object updated with the source contents
+            during the single pass
+        :param codec: with dest_folder, the Codecs name to compress with at
+            compresslevel; "deflate" makes the zip, "stored" only copies
+        :param meter: StageMeter timing the single pass, with dest_folder
+        :param index: BackupIndex to take and learn compressibility from
+        :param content_hash: digest of the contents if known already,
+            made by the same algorithm as digest
+        :param prefilter: FileHasher.prefilter of the file, if known
+        :param size: size of the file, if known
+        :param probe_level: deflate level of the probe for codecs other than deflate
+        :return: (filepath, mode, ext), mode is "zip", "orig" or the
+            codec's name; with dest_folder, filepath is the partial to commit
+        """
         logger = logging.getLogger(__file__)
         if verbosity > 0:
             msg = f"{Utilities.whoami()} <{Utilities.now()}>"
             msg = f"  {sourcepath}  {tempfolder}"
             logger.info(msg)
 
+        orig_ext = os.path.splitext(sourcepath)[1]
+        algorithm = digest.name if digest is not None else "sha256"
+        hint = None
+        if index is not None and probe and codec != "stored":
+            hint = index.compress_hint(orig_ext, codec, comp_thresh,
+                                       content_hash=content_hash,
+                                       algorithm=algorithm,
+                                       prefilter=prefilter)
+            if verbosity > 1 and hint is not None:
+                logger.info(f"  learned {hint} {sourcepath}")
+        est_ratio = None
+        if probe and codec != "stored" and hint is None:
+            # other codecs' levels mean nothing to zlib
+            deflate_level = compresslevel if codec == "deflate" and compresslevel is not None else probe_level
+            est_ratio = Utilities.probe_compressibility(sourcepath,
+                                                        compresslevel=deflate_level)
+            if verbosity > 1 and est_ratio is not None:
+                logger.info(f"  probe ratio {est_ratio:.3f} {sourcepath}")
+
+        if dest_folder is not None:
+            # the probe deflates, other codecs do at least as well on text
+            #  and as badly on compressed data, so it is still a fair guide
+            want_zip = codec != "stored" and hint != "store" and (
+                est_ratio is None or est_ratio <= comp_thresh + probe_margin)
+            want_orig = codec == "stored" or hint == "store" or (
+                hint is None and (est_ratio is None or est_ratio >= comp_thresh - probe_margin))
+            comp_mode, comp_ext = "zip", ".zip"
+            if codec not in ("deflate", "stored"):
+                comp_mode, comp_ext = codec, Codecs.exts[codec]
+            os.makedirs(dest_folder, exist_ok=True)
+            stamp = Utilities.nowshortstr()
+            zippath = None
+            rawpath = None
+            if want_zip:
+                zippath = os.path.join(dest_folder, stamp + comp_ext + PARTIAL_EXT)
+            if want_orig:
+                rawpath = os.path.join(dest_folder, stamp + orig_ext + PARTIAL_EXT)
+            if size is None:
+                size = os.path.getsize(sourcepath)
+            try:
+                if zippath is not None and rawpath is not None and size <= memory_size:
+                    orig_size, comp_size, zipped = Utilities.encode_small(sourcepath, zippath, rawpath,
+                                                                          comp_thresh,
+                                                                          codec=codec,
+                                                                          compresslevel=compresslevel,
+                                                                          digest=digest,
+                                                                          meter=meter)
+                    if zipped:
+                        rawpath = None
+                    else:
+                        zippath = None
+                elif zippath is not None and comp_mode != "zip":
+                    orig_size, comp_size = Codecs.encode_file(sourcepath, zippath, codec,
+                                                              level=compresslevel,
+                                                              rawfilepath=rawpath,
+                                                              digest=digest,
+                                                              meter=meter)
+                else:
+                    orig_size, comp_size = Utilities.stream_zip(sourcepath, zippath,
+                                                                compresslevel=compresslevel,
+                                                                rawfilepath=rawpath,
+                                                                digest=digest,
+                                                                engine=engine,
+                                                                meter=meter)
+            except Exception:
+                for path in (zippath, rawpath):
+                    if path is not None and os.path.isfile(path):
+                        os.remove(path)
+                raise
+            if index is not None and codec != "stored" and (comp_size is not None or est_ratio is not None):
+                # stored untried on the probe's word, learn its estimate
+                learned_size = comp_size if comp_size is not None else int(round(est_ratio * orig_size))
+                index.learn_ratio(orig_ext, codec, orig_size, learned_size,
+                                  content_hash=digest.hexdigest() if digest is not None else content_hash,
+                                  algorithm=algorithm,
+                                  prefilter=prefilter)
+            if zippath is None:
+                return rawpath, "orig", orig_ext
+            comp_ratio = 1
+            if orig_size > 0:
+                comp_ratio = float(comp_size) / orig_size
+            if rawpath is not None and comp_ratio > comp_thresh:
+                os.remove(zippath)
+                return rawpath, "orig", orig_ext
+            if rawpath is not None:
+                os.remove(rawpath)
+            elif comp_ratio > comp_thresh and verbosity > 0:
+                logger.info(f"  ratio {comp_ratio:.3f} above comp_thresh, probe said zip {sourcepath}")
+            return zippath, comp_mode, comp_ext
+
+        if hint == "store" or (est_ratio is not None and est_ratio > comp_thresh + probe_margin):
+            return None, "orig", orig_ext
+
         # try to zip the file
         def zipit(sourcepath,
                   tempfolder,
@@ -1114,13 +4635,18 @@ class GitBack(object):
                                                       base="temp",
                                                       ext=".zip",
                                                       verbosity=verbosity)
+            if engine is not None:
+                # compressed on the engine's process pool
+                engine.zip_file(sourcepath, zipfilepath, compresslevel=compresslevel)
+                return zipfilepath, None
             tries = 0
             ok = False
             while tries < 10 and not ok:
                 try:
                     tries += 1
                     time.sleep(0.01)
-                    zf = Utilities.create_new_zip(sourcepath, zipfilepath)
+                    zf = Utilities.create_new_zip(sourcepath, zipfilepath,
+                                                  compresslevel=compresslevel)
                 except OSError as oe:
                     msg = "\n {tries} {sourcepath} {zipfilepath} "
                     msg += Utilities.last_exception_info()
@@ -1157,26 +4683,135 @@ class GitBack(object):
             infilepath = zipfilepath
         return zipfilepath, mode, ext
 
-    def backup_file(self,
-                    filename,
-                    sourcefolder,
-                    destroot,
-                    destfolder,
-                    tempfolder=None,
-                    include_exts=None,
-                    exclude_exts=None,
-                    dt_fmt='%Y-%m-%dT%H:%M:%S',
-                    comp_thresh=0.9,
-                    compression=zipfile.ZIP_DEFLATED,
-                    compresslevel=zlib.Z_DEFAULT_COMPRESSION,
-                    testing=False, verbosity=0):
+    @staticmethod
+    def link_version(shared_path, dest_folder, ext, verbosity=0):
+        """
+        hardlink a stored version into dest_folder as a new version
+
+        :param shared_path: stored file holding the same contents
+        :param dest_folder: backup folder of the source file
+        :param ext: extension for the new version's file
+        :return: path of the link, or None if the store can not hardlink
+        """
+        logger = logging.getLogger(__file__)
+        os.makedirs(dest_folder, exist_ok=True)
+        linkpath = os.path.join(dest_folder, Utilities.nowshortstr() + ext)
+        try:
+            os.link(shared_path, linkpath)
+        except OSError:
+            if verbosity > 1:
+                msg = f"  could not link {shared_path}"
+                msg += Utilities.last_exception_info()
+                logger.info(msg)
+            return None
+        return linkpath
+
+    def pack_file(self, sourcepath, source_stat, pack_store, index, journal=None,
+                  dt_fmt='%Y-%m-%dT%H:%M:%S', algorithm="sha256", use_prefilter=True,
+                  codec="deflate", level=None, verbosity=0):
+        """
+        back up a small file into the PackStore, the contents under their
+        digest (stored once for all paths and versions that share them)
+        and a meta record for the version
+
+        :return: 0 if a version was added, None if already stored, -1 if unreadable
+        """
+        logger = logging.getLogger(__file__)
+        try:
+            with open(sourcepath, mode="rb") as fp:
+                data = fp.read()
+        except PermissionError:
+            msg = f"Permission error on file {sourcepath}"
+            warnings.warn(msg)
+            return -1
+        source_sha256 = FileHasher.new(algorithm, data).hexdigest()
+        if index.find_version(sourcepath, source_sha256) is not None:
+            index.set_state(sourcepath, source_stat, source_sha256)
+            if verbosity > 0:
+                logger.info(f"no need to backup {sourcepath}, same contents already stored")
+            return
+        if pack_store.put(source_sha256, data, codec=codec, level=level) == 0 and self.stats is not None:
+            self.stats.add("dedup_files")
+            self.stats.add("dedup_bytes_saved", len(data))
+
+        meta_dict = OrderedDict()
+        meta_dict['filename'] = os.path.basename(sourcepath)
+        meta_dict['folder'] = os.path.dirname(sourcepath)
+        meta_dict['filepath'] = sourcepath
+        meta_dict['ctime'] = datetime.datetime.fromtimestamp(source_stat.st_ctime).strftime(dt_fmt)
+        meta_dict['mtime'] = datetime.datetime.fromtimestamp(source_stat.st_mtime).strftime(dt_fmt)
+        meta_dict['backup_mode'] = "packed"
+        meta_dict['sha256'] = source_sha256
+        meta_dict['algorithm'] = algorithm
+        if use_prefilter:
+            meta_dict['prefilter'] = FileHasher.prefilter(sourcepath, data=data)
+        meta_dict['size'] = len(data)
+        meta_dict['version'] = Utilities.nowshortstr()
+        pack_store.put_meta(meta_dict)
+
+        # put returns once the entry is indexed, by this or another worker
+        entry = index.find_pack_entry(source_sha256)
+        if entry is None:
+            raise RuntimeError("{0} of {1} is not in the packs".format(source_sha256, sourcepath))
+        packname = entry[0]
+        if journal is not None:
+            meta_dict['stored_path'] = index.relpath(pack_store.packpath(packname))
+            journal.append(meta_dict)
+        index.add_version(sourcepath=sourcepath,
+                          version=meta_dict['version'],
+                          sha256=source_sha256,
+                          size=meta_dict['size'],
+                          mode="packed",
+                          stored_path=pack_store.packpath(packname),
+                          ctime=meta_dict['ctime'],
+                          mtime=meta_dict['mtime'],
+                          algorithm=algorithm,
+                          prefilter=meta_dict.get('prefilter'))
+        index.set_state(sourcepath, source_stat, source_sha256)
+        if verbosity > 1:
+            logger.info(f"  packed {sourcepath} into {packname}")
+        return 0
+
+    def check_file(self,
+                   filename,
+                   sourcefolder,
+                   destroot,
+                   tempfolder=None,
+                   include_exts=None,
+                   exclude_exts=None,
+                   index=None,
+                   quick_check=True,
+                   paranoid=False,
+                   pack_store=None,
+                   dedup=True,
+                   snapshot=None,
+                   source_stat=None,
+                   algorithm="sha256",
+                   use_prefilter=True,
+                   verbosity=0):
+        """
+        the first half of backup_file: the ext filters, the quick check and,
+        if the contents are probably stored already, the hash and lookup
+
+        The contents are hashed with the algorithms of the stored versions
+        they could match, so versions hashed with another algorithm are
+        still found.  With use_prefilter, versions whose prefilter differs
+        are ruled out first, and if none are left the file is not hashed
+        twice.
+
+        :return: a FilePlan for the store half, or the result of
+            backup_file when there is nothing to store
+        """
         logger = logging.getLogger(__file__)
-        if verbosity > 0:
-            msg = f"{Utilities.whoami()} <{Utilities.now()}>"
-            msg = f"  {sourcefolder}  {destroot}"
-            logger.info(msg)
         pp_source_folder = PurePath(sourcefolder)
         # dirdrive = pp_source_folder.drive
+        # a stored version of the same contents under another source path
+        shared = None
+        source_sha256 = None
+        source_algorithm = algorithm
+        prefilter = None
+        packing = False
+        this_dest_folder = None
         try:
             if verbosity > 1:
                 msg = f"filename: {filename}, source_folder: {sourcefolder}"
@@ -1194,19 +4829,19 @@ class GitBack(object):
 
             # get the sha256 for the source file
             sourcepath = os.path.join(sourcefolder, filename)
-
-            # check to see if have permission to read file
-            try:
-                with open(sourcepath, "rb") as fp:
-                    onebyte = fp.read(1)
-            except PermissionError:
-                msg = "Permission error on file {sourcepath}"
-                warnings.warn(msg)
-                return -1
-            except Exception:
-                msg = "Error reading file {sourcepath}"
-                warnings.warn(msg)
-                return -1
+            if snapshot is not None:
+                snapshot.add(sourcepath)
+
+            # quick check, unchanged stat means no need to open the file,
+            #  the walker passes the stat it already has
+            if source_stat is None:
+                source_stat = os.stat(sourcepath)
+            packing = pack_store is not None and source_stat.st_size < pack_store.small_size
+            if quick_check and not paranoid and index is not None:
+                if index.unchanged(sourcepath, source_stat):
+                    if verbosity > 1:
+                        logger.info(f"  unchanged since last backup {sourcepath}")
+                    return
 
             # Note: source path becomes a dest folder,
             #  copies of source files are stored under there
@@ -1215,67 +4850,266 @@ class GitBack(object):
             # the backup file will go into the folder/dir this_outpath
             this_dest_folder = os.path.join(temp_dest_folder, filename)
 
-            if GitBack.file_in_backup(sourcepath=sourcepath,
-                                         dest_folder=this_dest_folder,
-                                         temp_folder=tempfolder,
-                                         sha_size=4096, verbosity=verbosity):
-                # then the same contents are already there
-                if verbosity > 0:
-                    msg = f"no need to backup {sourcepath}, found one in {dest_folder} with same contents"
-                    logger.info(msg)
-                return
+            # if the contents are probably stored already, here or under
+            #  another path with the same size, hash first and write nothing;
+            #  otherwise the single pass below hashes
+            algorithms = [algorithm]
+            if index is not None:
+                algorithms = []
+                if index.likely_stored(sourcepath, source_stat) \
+                        or (dedup and index.has_size(source_stat.st_size)):
+                    if use_prefilter:
+                        prefilter = FileHasher.prefilter(sourcepath)
+                    algorithms = index.candidate_algorithms(source_stat.st_size, prefilter,
+                                                            sourcepath=None if dedup else sourcepath)
+                    if len(algorithms) == 0 and verbosity > 1:
+                        logger.info(f"  prefilter rules out the stored versions {sourcepath}")
+            if len(algorithms) > 0:
+                try:
+                    source_digests = FileHasher.hexdigests(sourcepath, algorithms)
+                except PermissionError:
+                    msg = f"Permission error on file {sourcepath}"
+                    warnings.warn(msg)
+                    return -1
+                for source_algorithm, source_sha256 in source_digests.items():
+                    if GitBack.file_in_backup(sourcepath=sourcepath,
+                                                 dest_folder=this_dest_folder,
+                                                 temp_folder=tempfolder,
+                                                 sha_size=None, index=index,
+                                                 source_sha256=source_sha256,
+                                                 algorithm=source_algorithm,
+                                                 verbosity=verbosity):
+                        # then the same contents are already there
+                        if index is not None:
+                            index.set_state(sourcepath, source_stat, source_sha256)
+                        if verbosity > 0:
+                            msg = f"no need to backup {sourcepath}, found one in {this_dest_folder} with same contents"
+                            logger.info(msg)
+                        return
+                if dedup and index is not None and not packing:
+                    for source_algorithm, source_sha256 in source_digests.items():
+                        shared = index.find_by_hash(source_sha256)
+                        if shared is not None:
+                            break
 
         except OSError as oe:
             msg = Utilities.last_exception_info()
             logger.warning(msg)
-            OSError(oe)
+            raise OSError(oe)
         except Exception as e:
             msg = Utilities.last_exception_info()
             logger.warning(msg)
-            RuntimeError(e)
-
-        zipfilepath, mode, ext = GitBack.zipped_or_orig(sourcepath=sourcepath,
-                                                        tempfolder=tempfolder,
-                                                        comp_thresh=comp_thresh,
-                                                        verbosity=verbosity)
-        # construct the dest file path
-        ext = os.path.splitext(sourcepath)[1]
-        if mode == "zip":
-            ext = ".zip"
-        dest_file_path = Utilities.make_tempfilepath(this_dest_folder,
-                                                     base=file_base,
-                                                     ext=ext,
-                                                     verbosity=verbosity)
-        if mode == "orig":
-            source_file_path = sourcepath
-        else:
-            source_file_path = zipfilepath
-
-        # copy source to destination
-        try:
-            dfolder = os.path.split(dest_file_path)[0]
-            if not os.path.isdir(dfolder):
-                msg = " destination folder missing: {0}".format(dfolder)
-                logger.error(msg)
-                raise RuntimeError(msg)
+            raise RuntimeError(e)
 
-            if not os.path.isfile(source_file_path):
-                msg = " source file missing: {0}".format(source_file_path)
-                logger.error(msg)
-                raise RuntimeError(msg)
+        return GitBack.FilePlan(sourcepath, source_stat, source_sha256, source_algorithm, prefilter,
+                                shared, packing, file_ext, this_dest_folder)
 
-            shutil.copy(source_file_path, dest_file_path)
-        except OSError as oe:
-            errmsg = f"\ninfilepath: {source_file_path}\n dest_file_path: {dest_file_pat}"
-            errmsg += Utilities.last_exception_info()
-            logger.error(errmsg)
-            raise OSError(oe)
-        except Exception as exc:
-            errmsg = "infilepath: {0}\n dest_file_path: {1}".format(source_file_path,
-                                                                    dest_file_path)
-            errmsg += Utilities.last_exception_info()
-            logger.info(errmsg)
-            raise RuntimeError(exc)
+    def backup_file(self,
+                    filename,
+                    sourcefolder,
+                    destroot,
+                    destfolder,
+                    tempfolder=None,
+                    include_exts=None,
+                    exclude_exts=None,
+                    dt_fmt='%Y-%m-%dT%H:%M:%S',
+                    comp_thresh=0.9,
+                    compression=zipfile.ZIP_DEFLATED,
+                    compresslevel=zlib.Z_DEFAULT_COMPRESSION,
+                    index=None,
+                    quick_check=True,
+                    paranoid=False,
+                    engine=None,
+                    probe=True,
+                    chunk_store=None,
+                    pack_store=None,
+                    dedup=True,
+                    journal=None,
+                    snapshot=None,
+                    source_stat=None,
+                    algorithm="sha256",
+                    use_prefilter=True,
+                    codec_policy=None,
+                    adaptive=None,
+                    check_only=False,
+                    plan=None,
+                    stage=False,
+                    staged=None,
+                    testing=False, verbosity=0):
+        """
+        back up one file, check_file then the store half
+
+        :param algorithm: FileHasher algorithm for the digest of new versions
+        :param use_prefilter: record a prefilter with each version and
+            use it to skip the hash first pass for contents not stored
+        :param codec_policy: CodecPolicy choosing the codec and level,
+            None for deflate at compresslevel
+        :param adaptive: AdaptiveLevel shifting the chosen level, fed the
+            stage times of every file stored whole
+        :param check_only: return the FilePlan from check_file, storing nothing
+        :param plan: a FilePlan from an earlier check_only call, to only store
+        :param stage: encode a new whole file version into its partial in
+            the destination and return a StagedFile, committing nothing
+        :param staged: a StagedFile from an earlier stage call, to only
+            rename it into place and commit it
+        """
+        logger = logging.getLogger(__file__)
+        if verbosity > 0:
+            msg = f"{Utilities.whoami()} <{Utilities.now()}>"
+            msg = f"  {sourcefolder}  {destroot}"
+            logger.info(msg)
+        if staged is not None:
+            plan = staged.plan
+        elif plan is None:
+            plan = self.check_file(filename, sourcefolder, destroot,
+                                   tempfolder=tempfolder,
+                                   include_exts=include_exts,
+                                   exclude_exts=exclude_exts,
+                                   index=index,
+                                   quick_check=quick_check,
+                                   paranoid=paranoid,
+                                   pack_store=pack_store,
+                                   dedup=dedup,
+                                   snapshot=snapshot,
+                                   source_stat=source_stat,
+                                   algorithm=algorithm,
+                                   use_prefilter=use_prefilter,
+                                   verbosity=verbosity)
+            if check_only or not isinstance(plan, GitBack.FilePlan):
+                return plan
+        (sourcepath, source_stat, source_sha256, source_algorithm, prefilter,
+         shared, packing, file_ext, this_dest_folder) = plan
+
+        if staged is not None:
+            # encoded already, only the commit is left
+            partialpath, mode, ext = staged.partialpath, staged.mode, staged.ext
+        else:
+            # one small read tells media and archives, which neither
+            #  compress nor dedup in chunks, and text from other binaries
+            label = None
+            if codec_policy is not None or chunk_store is not None:
+                try:
+                    label = FileSniffer.classify(sourcepath)
+                except OSError:
+                    pass
+            codec, level = "deflate", compresslevel
+            if codec_policy is not None:
+                codec, level = codec_policy.choose(sourcepath, source_stat.st_size, label=label,
+                                                   compresslevel=compresslevel)
+            if adaptive is not None:
+                codec, level = adaptive.adjust(codec, level)
+            if packing:
+                # small files go into a pack, no folder or meta file of their own
+                return self.pack_file(sourcepath, source_stat, pack_store, index,
+                                      journal=journal, dt_fmt=dt_fmt, algorithm=algorithm,
+                                      use_prefilter=use_prefilter, codec=codec, level=level,
+                                      verbosity=verbosity)
+
+        if shared is None and staged is None:
+            # one read of the source feeds the digest, the zip and,
+            #  if needed, the raw copy
+            known_hash = source_sha256 if source_algorithm == algorithm else None
+            source_algorithm = algorithm
+            digest = FileHasher.new(algorithm)
+            if use_prefilter and prefilter is None:
+                digest = PrefilterTap(digest)
+            try:
+                if (chunk_store is not None and source_stat.st_size >= chunk_store.min_size
+                        and label not in FileSniffer.uncompressible):
+                    # split into chunks, each stored once under its hash
+                    os.makedirs(this_dest_folder, exist_ok=True)
+                    partialpath = os.path.join(this_dest_folder, Utilities.nowshortstr()
+                                               + ChunkStore.recipe_ext + PARTIAL_EXT)
+                    chunk_store.store_file(sourcepath, partialpath, digest=digest,
+                                           codec=codec, level=level)
+                    mode = "chunked"
+                    ext = ChunkStore.recipe_ext
+                else:
+                    meter = StageMeter()
+                    partialpath, mode, ext = GitBack.zipped_or_orig(sourcepath=sourcepath,
+                                                                    tempfolder=tempfolder,
+                                                                    comp_thresh=comp_thresh,
+                                                                    compresslevel=level,
+                                                                    engine=engine,
+                                                                    dest_folder=this_dest_folder,
+                                                                    probe=probe,
+                                                                    digest=digest,
+                                                                    codec=codec,
+                                                                    meter=meter,
+                                                                    index=index,
+                                                                    content_hash=known_hash,
+                                                                    prefilter=prefilter,
+                                                                    size=source_stat.st_size,
+                                                                    verbosity=verbosity)
+                    if adaptive is not None:
+                        adaptive.record(meter)
+            except PermissionError:
+                msg = f"Permission error on file {sourcepath}"
+                warnings.warn(msg)
+                return -1
+            source_sha256 = digest.hexdigest()
+            if isinstance(digest, PrefilterTap):
+                prefilter = digest.prefilter()
+            plan = plan._replace(source_sha256=source_sha256, source_algorithm=source_algorithm,
+                                 prefilter=prefilter)
+        if stage:
+            # the write stage commits the partial, or links the shared contents
+            if shared is not None:
+                return GitBack.StagedFile(plan, None, None, None)
+            return GitBack.StagedFile(plan, partialpath, mode, ext)
+
+        if shared is None:
+            dest_file_path = partialpath[:-len(PARTIAL_EXT)]
+
+            # commit to the destination with an atomic rename,
+            #  unless an earlier version turns out to have the same contents
+            try:
+                if index is not None and index.find_version(sourcepath, source_sha256) is not None:
+                    os.remove(partialpath)
+                    index.set_state(sourcepath, source_stat, source_sha256)
+                    if verbosity > 0:
+                        logger.info(f"no need to backup {sourcepath}, same contents already stored")
+                    return
+                if dedup and index is not None:
+                    # another worker may have stored the same contents meanwhile
+                    shared = index.find_by_hash(source_sha256)
+                if shared is not None:
+                    os.remove(partialpath)
+                else:
+                    os.replace(partialpath, dest_file_path)
+            except OSError as oe:
+                errmsg = f"\nsourcepath: {sourcepath}\n dest_file_path: {dest_file_path}"
+                errmsg += Utilities.last_exception_info()
+                logger.error(errmsg)
+                if os.path.isfile(partialpath):
+                    os.remove(partialpath)
+                raise OSError(oe)
+            except Exception as exc:
+                errmsg = "sourcepath: {0}\n dest_file_path: {1}".format(sourcepath,
+                                                                       dest_file_path)
+                errmsg += Utilities.last_exception_info()
+                logger.info(errmsg)
+                raise RuntimeError(exc)
+
+        shared_path = None
+        if shared is not None:
+            # same contents stored under another path, link to it
+            #  instead of writing them again
+            shared_path, mode = shared
+            ext = file_ext if mode == "orig" else os.path.splitext(shared_path)[1]
+            dest_file_path = None
+            if mode != "packed":
+                # a pack holds many entries, it is referred to, never linked
+                dest_file_path = GitBack.link_version(shared_path, this_dest_folder, ext,
+                                                      verbosity=verbosity)
+            if dest_file_path is not None:
+                shared_path = None
+            if self.stats is not None:
+                self.stats.add("dedup_files")
+                self.stats.add("dedup_bytes_saved",
+                               source_stat.st_size if mode == "packed" else os.path.getsize(shared[0]))
+            if verbosity > 0:
+                logger.info(f"{sourcepath} has the same contents as {shared[0]}, not stored again")
 
         # write meta info into file
         try:
@@ -1284,22 +5118,57 @@ class GitBack(object):
             meta_dict['filename'] = filename
             meta_dict['folder'] = sourcefolder
             meta_dict['filepath'] = sourcepath
-            meta_dict['ctime'] = datetime.datetime.fromtimestamp(os.path.getctime(sourcepath)). \
+            meta_dict['ctime'] = datetime.datetime.fromtimestamp(source_stat.st_ctime). \
                 strftime(dt_fmt)
-            meta_dict['mtime'] = datetime.datetime.fromtimestamp(os.path.getmtime(sourcepath)). \
+            meta_dict['mtime'] = datetime.datetime.fromtimestamp(source_stat.st_mtime). \
                 strftime(dt_fmt)
             meta_dict['backup_mode'] = mode
+            meta_dict['sha256'] = source_sha256
+            meta_dict['algorithm'] = source_algorithm
+            if use_prefilter:
+                # from the check's head/tail read or the store pass, the
+                #  file is not read again for it
+                meta_dict['prefilter'] = prefilter
+            meta_dict['size'] = source_stat.st_size
+            if shared_path is None:
+                meta_dict['version'] = os.path.splitext(os.path.basename(dest_file_path))[0]
+            else:
+                # no link possible, the index refers to the other path's file
+                meta_dict['version'] = Utilities.nowshortstr()
+                dest_file_path = shared_path
+            meta_dict['stored_path'] = os.path.relpath(dest_file_path, destroot)
 
-            # construct a path for this meta data
-            meta_folder = os.path.join(this_dest_folder, "meta_files")
-            meta_file_path = Utilities.make_tempfilepath(meta_folder,
-                                                         base="meta",
-                                                         ext=".txt",
-                                                         verbosity=verbosity)
-
-            with open(meta_file_path, mode="w", encoding="UTF-8") as fp:
-                for key in meta_dict.keys():
-                    fp.write("{0}: {1}\n".format(key, meta_dict[key]))
+            if journal is not None:
+                journal.append(meta_dict)
+            else:
+                # no run journal, a meta txt file next to the stored versions
+                if shared_path is None:
+                    meta_dict['stored_file'] = os.path.basename(dest_file_path)
+                else:
+                    meta_dict['stored_file'] = ''
+                    meta_dict['shared_path'] = meta_dict['stored_path']
+                meta_folder = os.path.join(this_dest_folder, "meta_files")
+                meta_file_path = Utilities.make_tempfilepath(meta_folder,
+                                                             base="meta",
+                                                             ext=".txt",
+                                                             verbosity=verbosity)
+
+                with open(meta_file_path, mode="w", encoding="UTF-8") as fp:
+                    for key in meta_dict.keys():
+                        fp.write("{0}: {1}\n".format(key, meta_dict[key]))
+
+            if index is not None:
+                index.add_version(sourcepath=sourcepath,
+                                  version=meta_dict['version'],
+                                  sha256=source_sha256,
+                                  size=meta_dict['size'],
+                                  mode=mode,
+                                  stored_path=dest_file_path,
+                                  ctime=meta_dict['ctime'],
+                                  mtime=meta_dict['mtime'],
+                                  algorithm=source_algorithm,
+                                  prefilter=meta_dict.get('prefilter'))
+                index.set_state(sourcepath, source_stat, source_sha256)
         except FileNotFoundError as fnfe:
             errmsg = Utilities.last_exception_info()
             logger.info(errmsg)
@@ -1313,51 +5182,28 @@ class GitBack(object):
             err_msg = Utilities.last_exception_info()
             logger.warning(err_msg)
             raise RuntimeError(e)
-
-        # clean up
-        try:
-            # remove the temporary zipfile
-            if os.path.isfile(zipfilepath):
-                try:
-                    # wait until file fully copied
-                    source_size = os.path.getsize(source_file_path)
-                    dest_size = os.path.getsize(dest_file_path)
-                    tries = 0
-                    while dest_size < source_size:
-                        dest_size = os.path.getsize(dest_file_path)
-                        tries += 1
-                        if tries > 20:
-                            break
-                        time.sleep(0.01)
-                    if dest_size > source_size:
-                        msg = " {0} tries checking on file, dest not written".format(tries)
-                        raise RuntimeError(msg)
-                    GitBack.clean_temp_folder(tempfolder, verbosity=verbosity)
-                except Exception as e:
-                    msg = f"\n  Problem removing zipfile: {zipfilepath}"
-                    msg += f"\n zfile: {zipfile}"
-                    msg += Utilities.last_exception_info()
-                    logger.warning(msg)
-                    raise RuntimeError(e)
-            else:
-                msg = "can't find zipfile {0}".format(zipfilepath)
-                raise RuntimeError(msg)
-        except OSError as oe:
-            errmsg = Utilities.last_exception_info()
-            logger.info(errmsg)
-            raise OSError(oe)
-        except Exception as e:
-            err_msg = Utilities.last_exception_info()
-            logger.warning(err_msg)
-            raise RuntimeError(e)
-        finally:
-            return 0
+        return 0
 
     def find_files_in_backup(self,
                              backuproot,
                              filenames,
                              origfolder=None,
+                             use_index=True,
                              verbosity=0):
+        """
+        find every stored version of some files
+
+        With an index this is one indexed query per name; a store without
+        one is walked once for all the names.
+
+        :param backuproot: backup root
+        :param filenames: list of file names, exact source paths, or globs of either
+        :param origfolder: only versions of files under this source folder
+        :param use_index: query the store's BackupIndex if it has one
+        :param verbosity: level of diagnostics
+        :return: OrderedDict of name -> list of dicts with filepath, version,
+            sha256, size, backup_mode, stored_path, ctime and mtime, -1 on bad arguments
+        """
         argdict = locals().copy()
         verbosity = max(verbosity, self.verbosity)
         logger = logging.getLogger(__file__)
@@ -1375,13 +5221,19 @@ class GitBack(object):
         if not os.path.isdir(backuproot):
             warnings.warn("backuproot <{0}> not a dir".format(backuproot))
             return -1
+        if isinstance(filenames, str):
+            filenames = [filenames]
 
-        found_map = OrderedDict()
-        for filename in filenames:
-            found_list = self.find_file_in_backup(backuproot=backuproot,
-                                                  target_filename=filename,
-                                                  verbosity=verbosity)
-            found_map[filename] = found_list
+        if use_index and os.path.isfile(os.path.join(backuproot, BackupIndex.dbname)):
+            index = self.get_index(backuproot, verbosity=verbosity)
+            found_map = OrderedDict((name, index.find_versions(name)) for name in filenames)
+        else:
+            found_map = GitBack.scan_store_versions(backuproot, filenames, verbosity=verbosity)
+        if origfolder is not None:
+            prefix = GitBack.drop_drive(origfolder).rstrip(os.sep) + os.sep
+            for name in found_map:
+                found_map[name] = [r for r in found_map[name]
+                                   if GitBack.drop_drive(r["filepath"]).startswith(prefix)]
         return found_map
 
     def find_file_in_backup(self,
@@ -1389,123 +5241,438 @@ class GitBack(object):
                             target_filename,
                             origfolder=None,
                             verbosity=0):
-        argdict = locals().copy()
-        verbosity = max(verbosity, self.verbosity)
-        logger = logging.getLogger(__file__)
-        if verbosity > 0:
-            msg = "{0} <{1}>".format(Utilities.whoami(), Utilities.now())
-            for key in argdict.keys():
-                msg += "\n  {0}: {1}".format(key, argdict[key])
-            logger.info(msg)
+        """
+        every stored version of one file, see find_files_in_backup
+        """
         if target_filename is None:
             warnings.warn("target_filename is None")
             return -1
-        if backuproot is None:
-            warnings.warn("backuproot is None")
-            return -1
-        if not os.path.isdir(backuproot):
-            warnings.warn("backuproot <{0}> not a dir".format(backuproot))
+        found_map = self.find_files_in_backup(backuproot=backuproot,
+                                              filenames=[target_filename],
+                                              origfolder=origfolder,
+                                              verbosity=verbosity)
+        if found_map == -1:
             return -1
+        return found_map[target_filename]
 
-        pp_backuproot = PurePath(backuproot)
-        if not pp_backuproot.is_absolute():
-            logger.warning("backuproot must be absolute, {0}".format(backuproot))
-
-        found_list = []
-        for source_folder, dirnames, filenames in os.walk(backuproot, topdown=True):
-            # pp_source_folder = PurePath(source_folder)
-            # dirdrive = pp_source_folder.drive
-            # dirfolder = os.sep.join(pp_source_folder.parts[1:])
-            for dirname in dirnames:
-                dirfolder = os.path.join(source_folder, dirname)
-                if dirname == target_filename:
-                    files = [f for f in os.listdir(dirfolder) if os.path.isfile(os.path.join(dirfolder,f))]
-                    tup = (dirname, files)
-                    found_list.append(tup)
-        return found_list
-
-    @staticmethod
-    def recover(folder,
-                filelist,
-                outdir,
-                verbosity=0):
-        logger = logging.getLogger(__file__)
-        if not os.path.isdir(folder):
-            logger.warning("{0} is not a folder".format(folder))
-            return None
-        raise RuntimeError("FixMe")
-        meta = None # Utilities.get_meta(folder, meta_filename)
+    @staticmethod
+    def drop_drive(path):
+        # the store keeps source paths without their drive or root
+        return os.sep.join(PurePath(path).parts[1:])
 
-        if not meta:
-            return None
+    @staticmethod
+    def pattern_matches(pattern, sourcepath):
+        """
+        True if sourcepath matches a file name, an exact source path,
+        or a glob of either, as BackupIndex.find_versions does
+        """
+        if "/" in pattern or os.sep in pattern:
+            return fnmatch.fnmatchcase(GitBack.drop_drive(sourcepath), GitBack.drop_drive(pattern))
+        return fnmatch.fnmatchcase(os.path.basename(sourcepath), pattern)
 
-        if len(meta) == 1:
-            logger.warning("No file_info records")
-            return None
+    @staticmethod
+    def scan_store_versions(backuproot, patterns, verbosity=0):
+        """
+        find the versions of files matching patterns in a store without an
+        index: one walk of the store for all the patterns, plus its journals
 
-        filemap = {}
-        for i, e in enumerate(meta[1:]):
-            filemap[e['filename']] = i+1
-        for filename in filelist:
-            if filename in filemap.keys():
-                ei = filemap[filename]
-                msg = "Found {0} as entry {1}".format(filename, ei)
-                logger.info(msg)
-                file_info = meta[ei]
-                logger.info(file_info)
-                if file_info['compressed']:
-                    outfilepath = Utilities.make_tempfilepath(outdir, base="temp", ext=".zip",
-                                                              verbosity=verbosity)
-                else:
-                    outfilepath = os.path.join(outdir, file_info['filename'])
-                logger.info("outfilepath= {0}".format(outfilepath))
-                outfilepath = os.path.abspath(outfilepath) # make sure folder is absolute
-                logger.info("outfilepath= {0}".format(outfilepath))
-                infilename = file_info['sha256']
-                infilepath = os.path.join(folder, infilename)
-                if not os.path.isfile(infilepath):
-                    logger.warning("Cannot fine backup file {0} in {1}".format(infilename, folder))
-                    continue
-                try:
-                    if verbosity > 0:
-                        logger.info("copying {0} to {1}".format(infilepath, outfilepath))
-                        shutil.copy(infilepath, outfilepath)
-                except Exception as e:
-                    (extype, exval, tb) = sys.exc_info()
-                    logger.warning("extype= {0}, exval= {1}\n {2}".format(extype, exval, tb))
+        :return: OrderedDict of pattern -> list of version dicts
+        """
+        logger = logging.getLogger(__file__)
+        found_map = OrderedDict((pattern, []) for pattern in patterns)
+        seen = set()
+
+        def add(pattern, record):
+            key = (pattern, record["filepath"], record["version"])
+            if key not in seen:
+                seen.add(key)
+                found = OrderedDict((k, record.get(k)) for k in BackupIndex.version_fields)
+                found["stored_path"] = os.path.join(backuproot, record["stored_path"])
+                found_map[pattern].append(found)
+
+        # the journals first, they have the full records
+        for record in RunJournal.records(backuproot):
+            for pattern in patterns:
+                if GitBack.pattern_matches(pattern, record["filepath"]):
+                    add(pattern, record)
+        for dest_folder, dirnames, filenames in RunJournal.walk_store(backuproot):
+            data_files = [f for f in filenames if not f.endswith(PARTIAL_EXT)]
+            if dest_folder == backuproot or len(data_files) == 0:
+                continue
+            # a folder holding versions is named after the source file
+            folder_source = os.sep + os.path.relpath(dest_folder, backuproot)
+            matched = [p for p in patterns if GitBack.pattern_matches(p, folder_source)]
+            if len(matched) == 0:
+                continue
+            try:
+                records = RunJournal.folder_records(backuproot, dest_folder, data_files)
+            except Exception:
+                msg = f"  problem reading the meta_files in {dest_folder}"
+                msg += Utilities.last_exception_info()
+                logger.warning(msg)
+                records = []
+            if len(records) == 0:
+                for dfile in sorted(data_files):
+                    dext = os.path.splitext(dfile)[1]
+                    mode = {".zip": "zip", ChunkStore.recipe_ext: "chunked"}.get(dext, "orig")
+                    records.append(OrderedDict(filepath=folder_source,
+                                               version=os.path.splitext(dfile)[0],
+                                               sha256=None, size=None, backup_mode=mode,
+                                               stored_path=os.path.relpath(os.path.join(dest_folder, dfile),
+                                                                           backuproot),
+                                               ctime=None, mtime=None))
+            for record in records:
+                for pattern in matched:
+                    add(pattern, record)
+        for pattern in patterns:
+            found_map[pattern].sort(key=lambda r: (r["filepath"], r["version"]))
+        return found_map
 
-                if file_info['compressed']:
-                    zipfilepath = outfilepath
-                    outfilepath = os.path.join(outdir, file_info['filename'])
-                    logger.info("outfilepath {0}".format(outfilepath))
-                if verbosity > 0:
-                    logger.info("Unzipping {0} to {1}".format(zipfilepath, outfilepath))
+    @staticmethod
+    def restore_version(stored_path, mode, outpath, destroot=None, sha256=None, packs=None,
+                        algorithm="sha256"):
+        """
+        write the original contents of one stored version to outpath
+
+        :param stored_path: the version's file in the store
+        :param mode: backup_mode of the version, "orig", "zip", "chunked", "packed"
+            or the name of the Codecs codec that compressed it
+        :param outpath: where to write the restored file
+        :param destroot: backup root, needed to find the chunks of a "chunked"
+            version and the pack entry of a "packed" one
+        :param sha256: the version's digest, the key of a "packed" version
+        :param packs: PackStore of destroot, opened here if not given
+        :param algorithm: FileHasher algorithm that made the digest
+        :return: outpath
+        """
+        outfolder = os.path.dirname(outpath)
+        if outfolder:
+            os.makedirs(outfolder, exist_ok=True)
+        if mode == "orig":
+            return Utilities.copy_atomic(stored_path, outpath)
+        if mode == "zip":
+            partialpath = outpath + PARTIAL_EXT
+            with zipfile.ZipFile(stored_path, mode='r') as zfile:
+                zinfolist = zfile.infolist()
+                if len(zinfolist) != 1:
+                    zlen = len(zinfolist)
+                    msg = "file = {0}, zinfolist len= {1}, should be 1".format(stored_path, zlen)
+                    raise ValueError(msg)
+                with zfile.open(zinfolist[0], mode='r') as zfp, open(partialpath, mode="wb") as fp:
+                    shutil.copyfileobj(zfp, fp, 1024 * 1024)
+            os.replace(partialpath, outpath)
+            return outpath
+        if mode in Codecs.exts:
+            return Codecs.decode_file(stored_path, outpath, mode)
+        if mode not in ("chunked", "packed"):
+            raise ValueError("unknown backup_mode {0} for {1}".format(mode, stored_path))
+        if destroot is None:
+            raise ValueError("destroot is needed to restore a {0} version".format(mode))
+        own_packs = packs is None and os.path.isdir(os.path.join(destroot, PackStore.foldername))
+        if own_packs:
+            index = BackupIndex(destroot)
+            packs = PackStore(destroot, index)
+        try:
+            if mode == "chunked":
+                return ChunkStore(destroot, packs=packs).restore_file(stored_path, outpath)
+            if packs is None or sha256 is None:
+                raise ValueError("no pack entry to restore {0} from".format(outpath))
+            data = packs.get(sha256)
+            if FileHasher.new(algorithm, data).hexdigest() != sha256:
+                raise RuntimeError("{0} mismatch restoring {1} from the packs".format(algorithm, outpath))
+            partialpath = outpath + PARTIAL_EXT
+            with open(partialpath, mode="wb") as fp:
+                fp.write(data)
+            os.replace(partialpath, outpath)
+            return outpath
+        finally:
+            if own_packs:
+                index.close()
 
-                zfile = zipfile.ZipFile(zipfilepath, mode='r')
-                for zm in zfile.infolist():
-                    logger.info(zm)
-                try:
-                    zipname = file_info['zipname']
-                    logger.info("zipname= {0}  outfilepath= {1}".format(zipname, outfilepath))
-                    zfile.extract(member=zipname,
-                                  path=outfilepath, pwd=None)
-                except Exception as e:
-                    (extype, exval, tb) = sys.exc_info()
-                    logger.warning("extype= {0}, exval= {1}\n {2}".format(extype, exval, tb))
-                    raise Exception(e)
-                zfile.close()
-                os.remove(zipfilepath)
-        else:
-            msg = "No entry for {0}".format(filename)
-            logger.warning(msg)
-        return None
+    @staticmethod
+    def recover(destroot, outdir, target=None, snapshot=None, workers=4,
+                progress_seconds=5.0, verbosity=0):
+        """
+        restore files from a snapshot manifest
+
+        :param destroot: backup root
+        :param outdir: files are restored to outdir/<source path without the drive>
+        :param target: source path of one file or of a folder to restore,
+            None for the whole snapshot
+        :param snapshot: path or file name of the manifest, None for the latest
+        :param workers: number of threads reading, decompressing and writing files
+        :param progress_seconds: log progress this often
+        :param verbosity: level of diagnostics
+        :return: RunStats with the files and bytes restored and any errors
+        """
+        logger = logging.getLogger(__file__)
+        snapshot_path = Snapshot.find(destroot, snapshot)
+        header, records = Snapshot.load(snapshot_path)
+        if target is not None:
+            target = os.path.normpath(target)
+            records = [r for r in records
+                       if r["filepath"] == target or r["filepath"].startswith(target.rstrip(os.sep) + os.sep)]
+        # restore in store order, files of one pack or folder together
+        records.sort(key=lambda r: r["stored_path"])
+        total_bytes = sum(r.get("size") or 0 for r in records)
+        msg = "recover {0} files, {1} MB from {2}".format(len(records), np.round(total_bytes / 2 ** 20, 2),
+                                                          snapshot_path)
+        logger.info(msg)
 
+        stats = RunStats()
+        index = None
+        packs = None
+        if os.path.isdir(os.path.join(destroot, PackStore.foldername)):
+            index = BackupIndex(destroot, verbosity=verbosity)
+            packs = PackStore(destroot, index)
+
+        def restore_one(record):
+            outpath = os.path.join(outdir, *PurePath(record["filepath"]).parts[1:])
+            GitBack.restore_version(os.path.join(destroot, record["stored_path"]),
+                                    record["backup_mode"], outpath,
+                                    destroot=destroot, sha256=record["sha256"], packs=packs,
+                                    algorithm=record.get("algorithm") or "sha256")
+            return record.get("size") or 0
+
+        def finish(record, future):
+            try:
+                nbytes = future.result()
+            except Exception:
+                errmsg = Utilities.last_exception_info()
+                stats.error(record["filepath"], errmsg)
+                logger.error("{0}\n{1}".format(record["filepath"], errmsg))
+                return
+            stats.add("files")
+            stats.add("bytes", nbytes)
+
+        # a bounded window of files in flight, not one future per file
+        start = time.time()
+        last_report = start
+        pending = deque()
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max(workers, 1)) as pool:
+            for record in records:
+                pending.append((record, pool.submit(restore_one, record)))
+                while len(pending) >= 4 * max(workers, 1):
+                    finish(*pending.popleft())
+                now = time.time()
+                if now - last_report >= progress_seconds:
+                    last_report = now
+                    done = stats.counts.get("bytes", 0)
+                    msg = "  restored {0}/{1} files, {2} MB, {3} MB/s".format(
+                        stats.counts.get("files", 0), len(records), np.round(done / 2 ** 20, 2),
+                        np.round(done / 2 ** 20 / (now - start), 2))
+                    logger.info(msg)
+            while len(pending) > 0:
+                finish(*pending.popleft())
+        if index is not None:
+            index.close()
+        seconds = max(time.time() - start, 1e-6)
+        msg = "Recover done, {0}, {1} MB/s".format(stats.summary(),
+                                                   np.round(stats.counts.get("bytes", 0) / 2 ** 20 / seconds, 2))
+        logger.info(msg)
+        for sourcepath, errmsg in stats.errors:
+            logger.error("  failed: {0}".format(sourcepath))
+        return stats
 
 def _get_args_dict(fn, args, kwargs):
     args_names = fn.__code__.co_varnames[:fn.__code__.co_argcount]
     return {**dict(zip(args_names, args)), **kwargs}
 
 
+class BackupScheduler(object):
+    """
+    runs backup jobs read from Sync1.ini style job files, in one long
+    running process
+
+    A job file has a [Params] section:
+
+        [Params]
+        From = K:\\testing1
+        To = E:\\
+        Freq = 1
+        Total_time = 5
+
+    From is one or more source folders separated by ';', To the backup
+    drive.  Every Freq minutes the job backs up its folders, until
+    Total_time minutes after the scheduler started (0 for no limit).
+    Optional keys: Folder, the backup folder under To (default "backup"),
+    Units (seconds, minutes or hours), Exclude_folders and Exclude_exts.
+
+    Each job runs on its own fork of one GitBack, so jobs running at the
+    same time keep their own stats and temp folder (a subfolder of
+    temp_folder named after the job), while the index of a backup root
+    stays open and its file_state stays loaded between runs.  A run that
+    comes due while the previous run of the same job is still going is
+    skipped.
+    """
+    section = "Params"
+    units = {"seconds": 1, "minutes": 60, "hours": 3600}
+    Job = namedtuple("Job", ["name", "folders", "dest_drive", "dest_folder", "freq_seconds",
+                             "total_seconds", "exclude_folders", "exclude_exts"])
+
+    def __init__(self, job_files, gitback=None, temp_folder=None,
+                 workers=1, storage="file", verbosity=0):
+        self.jobs = [BackupScheduler.read_job(path) for path in job_files]
+        self.gitback = gitback if gitback is not None else GitBack(verbosity=verbosity)
+        self.temp_folder = temp_folder
+        self.workers = workers
+        self.storage = storage
+        self.verbosity = verbosity
+        self.stats = RunStats()
+        self.threads = {}
+        self.job_gitbacks = {}
+
+    @staticmethod
+    def clean_path(value):
+        # "E: \\" in a hand written job file means the root of E:
+        value = value.strip().strip('"')
+        m = re.match(r"^([A-Za-z]:)\s*\\?$", value)
+        if m is not None:
+            return m.group(1) + "\\"
+        return value
+
+    @staticmethod
+    def read_job(path):
+        """
+        parse one job file
+
+        :param path: job file with a [Params] section
+        :return: a BackupScheduler.Job
+        """
+        parser = configparser.ConfigParser()
+        if not parser.read(path):
+            raise ValueError("cannot read job file {0}".format(path))
+        if not parser.has_section(BackupScheduler.section):
+            raise ValueError("{0} has no [{1}] section".format(path, BackupScheduler.section))
+        params = parser[BackupScheduler.section]
+        errmsg = ""
+        for key in ["From", "To", "Freq"]:
+            if key not in params:
+                errmsg += "No {0} in {1}. ".format(key, path)
+        if len(errmsg) > 0:
+            raise ValueError(errmsg)
+        unit = params.get("Units", "minutes").strip().lower()
+        if unit not in BackupScheduler.units:
+            raise ValueError("{0}: Units should be one of {1}, got {2}".format(
+                path, list(BackupScheduler.units.keys()), unit))
+        scale = BackupScheduler.units[unit]
+        freq_seconds = params.getfloat("Freq") * scale
+        if freq_seconds <= 0:
+            raise ValueError("{0}: Freq should be > 0".format(path))
+        total_seconds = params.getfloat("Total_time", fallback=0) * scale
+
+        def split(value):
+            return [v.strip() for v in value.split(";") if len(v.strip()) > 0]
+
+        name = os.path.basename(path)
+        for ext in [".py", ".ini"]:
+            if name.lower().endswith(ext):
+                name = name[:-len(ext)]
+        return BackupScheduler.Job(
+            name=name,
+            folders=[BackupScheduler.clean_path(v) for v in split(params["From"])],
+            dest_drive=BackupScheduler.clean_path(params["To"]),
+            dest_folder=params.get("Folder", "backup").strip(),
+            freq_seconds=freq_seconds,
+            total_seconds=total_seconds,
+            exclude_folders=split(params.get("Exclude_folders", "zztemp")),
+            exclude_exts=split(params.get("Exclude_exts", "")))
+
+    def job_temp_folder(self, job):
+        """
+        the temp folder of job alone, backup_folder empties it on each run
+        """
+        temp_folder = self.temp_folder
+        if temp_folder is None:
+            temp_folder = os.path.join(os.path.splitext(__file__)[0], "zztemp")
+        return os.path.join(temp_folder, job.name)
+
+    def job_gitback(self, job):
+        if job.name not in self.job_gitbacks:
+            self.job_gitbacks[job.name] = self.gitback.fork()
+        return self.job_gitbacks[job.name]
+
+    def run_job(self, job):
+        logger = logging.getLogger(__file__)
+        gitback = self.job_gitback(job)
+        try:
+            gitback.backup_folders(folders=job.folders,
+                                   dest_drive=job.dest_drive,
+                                   dest_folder=job.dest_folder,
+                                   temp_folder=self.job_temp_folder(job),
+                                   exclude_folders=list(job.exclude_folders),
+                                   exclude_exts=job.exclude_exts,
+                                   workers=self.workers,
+                                   storage=self.storage,
+                                   verbosity=self.verbosity)
+            self.stats.add("runs")
+            if gitback.stats is not None:
+                logger.info("job {0}: {1}".format(job.name, gitback.stats.summary()))
+        except Exception:
+            msg = "job {0} failed\n".format(job.name)
+            msg += Utilities.last_exception_info(verbose=self.verbosity)
+            logger.error(msg)
+            self.stats.error(job.name, msg)
+
+    def start_job(self, job):
+        """
+        start a run of job in its own thread, unless the last one is still going
+        """
+        logger = logging.getLogger(__file__)
+        thread = self.threads.get(job.name)
+        if thread is not None and thread.is_alive():
+            logger.warning("job {0}: previous run still going, skipping this one".format(job.name))
+            self.stats.add("skipped")
+            return False
+        if thread is None:
+            # first run: keep the quick check state in memory from now on
+            index = self.gitback.get_index(os.path.join(job.dest_drive, job.dest_folder),
+                                           verbosity=self.verbosity)
+            index.warm()
+        logger.info("job {0}: starting run".format(job.name))
+        thread = threading.Thread(target=self.run_job, args=(job,),
+                                  name="job_" + job.name, daemon=True)
+        self.threads[job.name] = thread
+        thread.start()
+        return True
+
+    def run(self, stop_event=None, poll_seconds=1.0):
+        """
+        run the jobs until all their windows are over, or stop_event is set
+
+        :param stop_event: optional threading.Event to stop early
+        :param poll_seconds: how often to check for due jobs
+        :return: RunStats with the counts of runs, skipped runs and errors
+        """
+        logger = logging.getLogger(__file__)
+        start = time.monotonic()
+        next_run = {job.name: start for job in self.jobs}
+        while stop_event is None or not stop_event.is_set():
+            now = time.monotonic()
+            active = 0
+            for job in self.jobs:
+                if job.total_seconds > 0 and now - start >= job.total_seconds:
+                    continue
+                active += 1
+                if now >= next_run[job.name]:
+                    self.start_job(job)
+                    # keep to the schedule, dropping the slots that were missed
+                    missed = (now - next_run[job.name]) // job.freq_seconds
+                    next_run[job.name] += (missed + 1) * job.freq_seconds
+            if active == 0:
+                break
+            wait = min(next_run.values()) - time.monotonic()
+            wait = min(max(wait, 0.0), poll_seconds)
+            if stop_event is not None:
+                stop_event.wait(wait)
+            else:
+                time.sleep(wait)
+        for thread in self.threads.values():
+            thread.join()
+        logger.info("Scheduler done, {0}".format(self.stats.summary()))
+        return self.stats
+
+
 def test_func_name():
     frame = inspect.getframeinfo(inspect.currentframe())
     fname = frame.function
@@ -1520,11 +5687,72 @@ def get_fname(i=1):
 
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="backup folders to the backup drive")
+    parser.add_argument("--paranoid", action="store_true",
+                        help="read and hash every file, even if its stat is unchanged")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="number of threads backing up files")
+    parser.add_argument("--check-workers", type=int, default=None,
+                        help="threads checking and hashing files ahead of the store threads,"
+                             " default --workers")
+    parser.add_argument("--write-workers", type=int, default=None,
+                        help="threads committing stored files on the backup drive, default --workers")
+    parser.add_argument("--queue-size", type=int, default=None,
+                        help="files queued between pipeline stages, default 4 * --workers")
+    parser.add_argument("--compress-processes", type=int, default=0,
+                        help="size of the process pool doing the compression, 0 for none")
+    parser.add_argument("--storage", choices=["file", "chunked", "packed"], default="file",
+                        help="whole file copies, large files as deduplicated chunks,"
+                             " or chunks and small files in pack files")
+    parser.add_argument("--pack-size", type=int, default=64 * 1024 * 1024,
+                        help="size in bytes at which a pack file is sealed")
+    parser.add_argument("--chunker", choices=["fixed", "gear"], default="fixed",
+                        help="fixed size chunks, or content defined chunks that survive inserts")
+    parser.add_argument("--chunk-size", type=int, default=1024 * 1024,
+                        help="chunk size in bytes, the average size for the gear chunker")
+    parser.add_argument("--import-meta-files", action="store_true",
+                        help="first copy the meta_files of the backup into a journal")
+    parser.add_argument("--recover", metavar="OUTDIR", default=None,
+                        help="restore from a snapshot into OUTDIR instead of backing up")
+    parser.add_argument("--target", default=None,
+                        help="with --recover, the source file or folder to restore")
+    parser.add_argument("--snapshot", default=None,
+                        help="with --recover, the snapshot to restore from, default the latest")
+    parser.add_argument("--watch", action="store_true",
+                        help="after a full pass, keep backing up files as they change (Linux)")
+    parser.add_argument("--no-dedup", action="store_true",
+                        help="store identical files under different paths separately")
+    parser.add_argument("--digest", choices=list(FileHasher.algorithms.keys()), default="sha256",
+                        help="digest of new versions, blake2b is faster without SHA instructions")
+    parser.add_argument("--no-prefilter", action="store_true",
+                        help="do not use size and head/tail hashes to rule out stored versions")
+    parser.add_argument("--codec", choices=["auto"] + list(Codecs.tags.keys()), default=None,
+                        help="codec for every file, or auto to choose by extension and size,"
+                             " default deflate")
+    parser.add_argument("--adaptive", action="store_true",
+                        help="tune the compression levels during the run for the best MB/s")
+    parser.add_argument("--cpu-budget", type=float, default=0.5,
+                        help="with --adaptive, the most of the time compression may take")
+    parser.add_argument("--jobs", nargs="+", metavar="JOBFILE", default=None,
+                        help="run the Sync1.ini style job files on their schedule")
+    args = parser.parse_args()
+
     Utils = Utilities()
     warnings.formatwarning = Utils.warning_on_one_line
 
     logger = logging.getLogger(__file__)
 
+    if args.jobs is not None:
+        scheduler = BackupScheduler(args.jobs,
+                                    temp_folder="./zztemp",
+                                    workers=args.workers,
+                                    storage=args.storage,
+                                    verbosity=1)
+        scheduler.run()
+        scheduler.gitback.close_indexes()
+        print("Done")
+        sys.exit(0)
+
     # initialize parameters
     # for new lenovo
     computername = str(os.getenv("COMPUTERNAME"))
@@ -1600,16 +5828,52 @@ if __name__ == "__main__":
 
     # create instance of class
     GB = GitBack(verbosity=1)
-    if True:
+    if args.import_meta_files:
+        RunJournal.import_meta_files(os.path.join(dest_drive, dest_folder), verbosity=1)
+    if args.recover is not None:
+        GitBack.recover(destroot=os.path.join(dest_drive, dest_folder),
+                        outdir=args.recover,
+                        target=args.target,
+                        snapshot=args.snapshot,
+                        workers=max(args.workers, 4))
+    elif args.watch:
+        GB.watch_folders(folders=bfolders,
+                         dest_drive=dest_drive,
+                         dest_folder=dest_folder,
+                         exclude_folders=["zztemp"],
+                         exclude_exts=['.exe'],
+                         temp_folder="./zztemp",
+                         workers=args.workers,
+                         storage=args.storage,
+                         verbosity=1)
+        GB.close_indexes()
+    else:
         res = GB.backup_folders(folders=bfolders,
                                 dest_drive=dest_drive,
                                 dest_folder=dest_folder,
                                 exclude_folders=["zztemp"],
                                 exclude_exts=['.exe'],
                                 temp_folder="./zztemp",
+                                paranoid=args.paranoid,
+                                workers=args.workers,
+                                check_workers=args.check_workers,
+                                write_workers=args.write_workers,
+                                queue_size=args.queue_size,
+                                compress_processes=args.compress_processes,
+                                storage=args.storage,
+                                chunker=args.chunker,
+                                chunk_size=args.chunk_size,
+                                pack_size=args.pack_size,
+                                dedup=not args.no_dedup,
+                                algorithm=args.digest,
+                                use_prefilter=not args.no_prefilter,
+                                codec_policy=args.codec,
+                                adaptive=args.adaptive,
+                                cpu_budget=args.cpu_budget,
                                 verbosity=2)
         # noinspection SpellCheckingInspection
         backuproot = os.path.join(dest_drive, dest_folder)
         res = GB.find_files_in_backup(backuproot=backuproot,
                                   filenames=['addenv.bat'])
+        GB.close_indexes()
     print("Done")
\ No newline at end of file
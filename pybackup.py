@@ -9,11 +9,17 @@ import zlib
 import pickle
 from collections import OrderedDict
 
-def sha_256(fpath, size=4096):
+def sha_256(fpath, size=1024 * 1024):
+    # small files in one read, larger ones through one reused buffer
     m = hashlib.sha256()
     with open(fpath, mode='rb') as fp:
-        for chunk in iter(lambda: fp.read(size), b''):
-            m.update(chunk)
+        if os.fstat(fp.fileno()).st_size < size:
+            m.update(fp.read())
+            return m.hexdigest()
+        buf = bytearray(size)
+        view = memoryview(buf)
+        for n in iter(lambda: fp.readinto(buf), 0):
+            m.update(view[:n])
     return m.hexdigest()
 
 def backup(folder, include_exts=None,
@@ -113,7 +119,7 @@ def backup(folder, include_exts=None,
                 orig_data = fp.read()
             comp_data = zlib.compress(orig_data)
             res[filepath]['data'] = comp_data
-            res[filepath]['sha256'] = sha_256(filepath, size=4096)
+            res[filepath]['sha256'] = sha_256(filepath)
             res[filepath]['ctime'] = os.path.getctime(filepath)
             res[filepath]['mtime'] = os.path.getmtime(filepath)
             pickle.dump(res, ofp)
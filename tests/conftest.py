@@ -0,0 +1,62 @@
+import logging
+import os
+import random
+import sys
+from pathlib import PurePath
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import gitback  # noqa: E402
+
+
+@pytest.fixture
+def gb(tmp_path):
+    backup = gitback.GitBack(logfilepath=str(tmp_path / "gitback.log"))
+    logging.getLogger(gitback.__file__).setLevel(logging.WARNING)
+    yield backup
+    backup.close_indexes()
+
+
+def text_bytes(rng, size):
+    words = [b"backup", b"version", b"chunk", b"index", b"folder", b"the", b"of", b"\n"]
+    return b" ".join(rng.choices(words, k=size // 4 + 1))[:size]
+
+
+def make_tree(root, seed=1):
+    """
+    a small tree with every path through the store: empty, tiny, text
+    and random files, a copy of another file, one streamed (over the
+    in memory limit) and one chunked (over the 1 MB chunk and pack limits)
+    """
+    rng = random.Random(seed)
+    files = {"empty.txt": b"",
+             "tiny.txt": b"x",
+             "notes.txt": text_bytes(rng, 5000),
+             "random.bin": rng.randbytes(20000),
+             "sub/deeper/log.txt": text_bytes(rng, 40000),
+             "sub/copy_of_notes.txt": None,
+             "sub/streamed.csv": text_bytes(rng, 300 * 1024),
+             "sub/large.dat": text_bytes(rng, 2 * 1024 * 1024) + rng.randbytes(300 * 1024)}
+    files["sub/copy_of_notes.txt"] = files["notes.txt"]
+    for relpath, data in files.items():
+        fpath = os.path.join(root, *relpath.split("/"))
+        os.makedirs(os.path.dirname(fpath), exist_ok=True)
+        with open(fpath, "wb") as fp:
+            fp.write(data)
+    return files
+
+
+def tree_bytes(root):
+    found = {}
+    for folder, dirnames, filenames in os.walk(root):
+        for name in filenames:
+            fpath = os.path.join(folder, name)
+            with open(fpath, "rb") as fp:
+                found[os.path.relpath(fpath, root).replace(os.sep, "/")] = fp.read()
+    return found
+
+
+def restored_root(outdir, sourceroot):
+    # recover writes to outdir/<source path without the drive>
+    return os.path.join(outdir, *PurePath(sourceroot).parts[1:])
@@ -0,0 +1,58 @@
+import gitback
+
+MB = 1024 * 1024
+
+
+def meter(read_s, compress_s, write_s, bytes_in, bytes_out):
+    m = gitback.StageMeter()
+    m.seconds.update(read=read_s, compress=compress_s, write=write_s)
+    m.bytes_in = bytes_in
+    m.bytes_out = bytes_out
+    return m
+
+
+def test_slow_compression_steps_down_to_stored():
+    stats = gitback.RunStats()
+    adaptive = gitback.AdaptiveLevel(cpu_budget=0.5, window_bytes=64 * MB, stats=stats)
+    assert adaptive.adjust("deflate", 6) == ("deflate", 6)
+    levels = []
+    for _ in range(4):
+        # compressing takes most of the time and saves little
+        adaptive.evaluate(meter(1.0, 8.0, 1.0, 100 * MB, 90 * MB))
+        levels.append(adaptive.adjust("deflate", 6))
+    assert levels == [("deflate", 3), ("deflate", 1), ("stored", None), ("stored", None)]
+    # the shift goes on down the longest ladder, zstd's
+    assert adaptive.adjust("zstd", 19) == ("zstd", 1)
+    assert stats.counts["level_changes"] == 4
+
+
+def test_slow_destination_steps_up():
+    adaptive = gitback.AdaptiveLevel(cpu_budget=0.5, window_bytes=64 * MB)
+    # writing is the bottleneck and compression saves a lot of it
+    adaptive.evaluate(meter(1.0, 1.0, 10.0, 100 * MB, 30 * MB))
+    assert adaptive.adjust("deflate", 6) == ("deflate", 9)
+    assert adaptive.adjust("zstd", 3) == ("zstd", 9)
+    # the top of the ladder is as far as it goes
+    adaptive.evaluate(meter(1.0, 1.0, 10.0, 100 * MB, 30 * MB))
+    assert adaptive.adjust("deflate", 6) == ("deflate", 9)
+
+
+def test_stored_steps_back_up_when_compression_would_pay():
+    adaptive = gitback.AdaptiveLevel(cpu_budget=0.5, window_bytes=64 * MB)
+    for _ in range(3):
+        adaptive.evaluate(meter(1.0, 8.0, 1.0, 100 * MB, 90 * MB))
+    assert adaptive.adjust("deflate", 6) == ("stored", None)
+    # the destination slowed down: at the last measured compress rate and
+    #  ratio, compressing would now cost less time than it saves writing
+    adaptive.evaluate(meter(1.0, 0.0, 100.0, 100 * MB, 100 * MB))
+    assert adaptive.adjust("deflate", 6) == ("deflate", 1)
+
+
+def test_record_evaluates_per_window():
+    adaptive = gitback.AdaptiveLevel(cpu_budget=0.5, window_bytes=64 * MB)
+    adaptive.record(meter(0.5, 4.0, 0.5, 50 * MB, 45 * MB))
+    # not a full window yet
+    assert adaptive.shift == 0
+    adaptive.record(meter(0.5, 4.0, 0.5, 50 * MB, 45 * MB))
+    assert adaptive.shift == -1
+    assert adaptive.window.bytes_in == 0
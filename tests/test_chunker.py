@@ -0,0 +1,36 @@
+import io
+import random
+
+import pytest
+
+import gitback
+
+
+def chunk_list(chunker, data):
+    return list(chunker.chunks(io.BytesIO(data)))
+
+
+@pytest.mark.parametrize("read_size", [64 * 1024, 8 * 1024 * 1024])
+def test_chunks_cover_the_data(read_size):
+    data = random.Random(1).randbytes(3 * 1024 * 1024 + 123)
+    chunker = gitback.GearChunker(avg_size=16 * 1024, read_size=read_size)
+    chunks = chunk_list(chunker, data)
+    assert b"".join(chunks) == data
+    assert all(chunker.min_size <= len(chunk) <= chunker.max_size for chunk in chunks[:-1])
+    # the cut points do not depend on how the file was read
+    assert chunks == chunk_list(gitback.GearChunker(avg_size=16 * 1024), data)
+
+
+def test_insert_only_changes_nearby_chunks():
+    rng = random.Random(2)
+    data = rng.randbytes(2 * 1024 * 1024)
+    middle = len(data) // 2
+    changed = data[:middle] + rng.randbytes(100) + data[middle:]
+    chunker = gitback.GearChunker(avg_size=16 * 1024)
+    before = chunk_list(chunker, data)
+    after = chunk_list(chunker, changed)
+    known = set(before)
+    new = [chunk for chunk in after if chunk not in known]
+    # the chunks after the insert line up again with the old ones
+    assert len(new) <= 3
+    assert after[-1] == before[-1]
@@ -0,0 +1,64 @@
+import hashlib
+import os
+import random
+
+import gitback
+from conftest import text_bytes
+
+
+def test_stored_digests_still_match_after_a_switch(gb, tmp_path):
+    src = str(tmp_path / "src")
+    dst = str(tmp_path / "dst")
+    data = text_bytes(random.Random(1), 20000)
+    os.makedirs(os.path.join(src, "a"))
+    with open(os.path.join(src, "a", "notes.txt"), "wb") as fp:
+        fp.write(data)
+    gb.backup_folder(sourceroot=src, destroot=dst, tempfolder=str(tmp_path / "tmp"),
+                     algorithm="sha256")
+    # the same contents under another path and new ones, backed up with blake2b
+    os.makedirs(os.path.join(src, "b"))
+    with open(os.path.join(src, "b", "copy.txt"), "wb") as fp:
+        fp.write(data)
+    with open(os.path.join(src, "b", "new.txt"), "wb") as fp:
+        fp.write(data[::-1])
+    gb.backup_folder(sourceroot=src, destroot=dst, tempfolder=str(tmp_path / "tmp"),
+                     algorithm="blake2b")
+    assert gb.stats.errors == []
+    assert gb.stats.counts["dedup_files"] == 1
+    rows = gb.get_index(dst).conn.execute("SELECT sourcepath, sha256, algorithm FROM versions")
+    found = sorted((os.path.basename(path), sha256, algorithm) for path, sha256, algorithm in rows)
+    # the copy is found under the digest it was stored with
+    assert found == [("copy.txt", hashlib.sha256(data).hexdigest(), "sha256"),
+                     ("new.txt", hashlib.blake2b(data[::-1], digest_size=32).hexdigest(), "blake2b"),
+                     ("notes.txt", hashlib.sha256(data).hexdigest(), "sha256")]
+
+
+def test_prefilter_mismatch_skips_the_hash(gb, tmp_path, monkeypatch):
+    src = str(tmp_path / "src")
+    dst = str(tmp_path / "dst")
+    os.makedirs(src)
+    rng = random.Random(2)
+    size = 4 * gitback.FileHasher.prefilter_block
+    data = rng.randbytes(size)
+    with open(os.path.join(src, "first.bin"), "wb") as fp:
+        fp.write(data)
+    gb.backup_folder(sourceroot=src, destroot=dst, tempfolder=str(tmp_path / "tmp"))
+
+    hashed = []
+    hexdigests = gitback.FileHasher.hexdigests
+
+    def recording_hexdigests(fpath, algorithms):
+        hashed.append(os.path.basename(fpath))
+        return hexdigests(fpath, algorithms)
+
+    monkeypatch.setattr(gitback.FileHasher, "hexdigests", staticmethod(recording_hexdigests))
+    # same size: one differs in its first block, one only in the middle
+    with open(os.path.join(src, "other_head.bin"), "wb") as fp:
+        fp.write(rng.randbytes(16) + data[16:])
+    middle = size // 2
+    with open(os.path.join(src, "other_middle.bin"), "wb") as fp:
+        fp.write(data[:middle] + rng.randbytes(16) + data[middle + 16:])
+    gb.backup_folder(sourceroot=src, destroot=dst, tempfolder=str(tmp_path / "tmp"))
+    assert gb.stats.errors == []
+    assert hashed == ["other_middle.bin"]
+    assert len(gb.get_index(dst).conn.execute("SELECT * FROM versions").fetchall()) == 3
@@ -0,0 +1,47 @@
+import os
+
+import pytest
+
+from conftest import make_tree
+
+
+@pytest.mark.parametrize("storage", ["file", "chunked"])
+def test_find_from_index_and_scan(gb, tmp_path, storage):
+    src = str(tmp_path / "src")
+    dst = str(tmp_path / "dst")
+    make_tree(src)
+
+    def backup():
+        gb.backup_folder(sourceroot=src, destroot=dst, tempfolder=str(tmp_path / "tmp"),
+                         storage=storage)
+        assert gb.stats.errors == []
+
+    backup()
+    with open(os.path.join(src, "notes.txt"), "ab") as fp:
+        fp.write(b"one more line\n")
+    backup()
+    gb.close_indexes()
+
+    patterns = ["notes.txt", "*.csv", os.path.join(src, "sub", "*"), "missing.txt"]
+
+    def versions(use_index):
+        found_map = gb.find_files_in_backup(dst, patterns, use_index=use_index)
+        return {pattern: sorted((found["filepath"], found["version"], found["sha256"],
+                                 found["backup_mode"], os.path.normpath(found["stored_path"]))
+                                for found in found_list)
+                for pattern, found_list in found_map.items()}
+
+    # the index and the walk of the store give the same answer
+    from_index = versions(True)
+    assert from_index == versions(False)
+    assert len(from_index["notes.txt"]) == 2
+    assert len(from_index["*.csv"]) == 1
+    # a glob's * also matches the folder separator
+    assert len(from_index[patterns[2]]) == 4
+    assert from_index["missing.txt"] == []
+    for found in from_index["notes.txt"]:
+        assert os.path.isfile(found[-1])
+
+    under_sub = gb.find_files_in_backup(dst, ["*.txt"], origfolder=os.path.join(src, "sub"))
+    assert sorted(os.path.basename(found["filepath"]) for found in under_sub["*.txt"]) == \
+        ["copy_of_notes.txt", "log.txt"]
@@ -0,0 +1,31 @@
+import hashlib
+import random
+import threading
+
+import pytest
+
+import gitback
+
+
+@pytest.fixture
+def small_hasher(monkeypatch):
+    # thresholds a few KB apart, so small files take every path
+    monkeypatch.setattr(gitback.FileHasher, "small_size", 4 * 1024)
+    monkeypatch.setattr(gitback.FileHasher, "mmap_size", 64 * 1024)
+    monkeypatch.setattr(gitback.FileHasher, "block_size", 1000)
+    monkeypatch.setattr(gitback.FileHasher, "local", threading.local())
+    return gitback.FileHasher
+
+
+@pytest.mark.parametrize("size,strategy", [(0, "read"), (4 * 1024 - 1, "read"),
+                                           (4 * 1024, "readinto"), (50 * 1000 + 7, "readinto"),
+                                           (64 * 1024, "mmap"), (200 * 1000 + 13, "mmap")])
+def test_strategies_give_the_same_digest(small_hasher, tmp_path, size, strategy):
+    data = random.Random(size).randbytes(size)
+    fpath = tmp_path / "data.bin"
+    fpath.write_bytes(data)
+    assert small_hasher.strategy(size) == strategy
+    digest = hashlib.sha256()
+    assert small_hasher.update(digest, str(fpath)) == size
+    assert digest.hexdigest() == hashlib.sha256(data).hexdigest()
+    assert small_hasher.hexdigest(str(fpath)) == hashlib.sha256(data).hexdigest()
@@ -0,0 +1,38 @@
+import hashlib
+import os
+import random
+
+import gitback
+from conftest import text_bytes
+
+
+def test_learned_ratios_come_back(gb, tmp_path):
+    src = str(tmp_path / "src")
+    dst = str(tmp_path / "dst")
+    os.makedirs(src)
+    rng = random.Random(1)
+    datas = {}
+    for i in range(gitback.BackupIndex.hist_min_samples):
+        datas["notes{0}.txt".format(i)] = text_bytes(rng, 20000)
+        datas["noise{0}.bin".format(i)] = rng.randbytes(20000)
+    for name, data in datas.items():
+        with open(os.path.join(src, name), "wb") as fp:
+            fp.write(data)
+    gb.backup_folder(sourceroot=src, destroot=dst, tempfolder=str(tmp_path / "tmp"))
+    assert gb.stats.errors == []
+    gb.close_indexes()
+
+    # a new process opens the index again
+    index = gitback.BackupIndex(dst)
+    text_hash = hashlib.sha256(datas["notes0.txt"]).hexdigest()
+    noise_hash = hashlib.sha256(datas["noise0.bin"]).hexdigest()
+    assert index.known_ratio(text_hash) < 0.5
+    assert index.known_ratio(noise_hash) > 0.9
+    assert index.known_ratio(hashlib.sha256(b"never stored").hexdigest()) is None
+    assert index.compress_hint(".txt", "deflate", 0.9, content_hash=text_hash) == "compress"
+    assert index.compress_hint(".bin", "deflate", 0.9, content_hash=noise_hash) == "store"
+    # unseen contents of a known type, from the histogram of the extension
+    assert index.compress_hint(".TXT", "deflate", 0.9) == "compress"
+    assert index.compress_hint(".bin", "deflate", 0.9) == "store"
+    assert index.compress_hint(".csv", "deflate", 0.9) is None
+    index.close()
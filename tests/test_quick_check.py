@@ -0,0 +1,43 @@
+import builtins
+import os
+
+import gitback
+
+
+def opened_paths(monkeypatch):
+    """
+    record every path gitback opens, from here on
+    """
+    opened = []
+
+    def recording_open(file, *args, **kwargs):
+        opened.append(os.path.abspath(file) if isinstance(file, str) else file)
+        return builtins.open(file, *args, **kwargs)
+
+    monkeypatch.setattr(gitback, "open", recording_open, raising=False)
+    return opened
+
+
+def test_unchanged_file_is_not_opened(gb, tmp_path, monkeypatch):
+    src = str(tmp_path / "src")
+    dst = str(tmp_path / "dst")
+
+    def backup(**kwargs):
+        gb.backup_folder(sourceroot=src, destroot=dst, tempfolder=str(tmp_path / "tmp"), **kwargs)
+
+    os.makedirs(src)
+    fpath = os.path.join(src, "notes.txt")
+    with open(fpath, "wb") as fp:
+        fp.write(b"some notes\n" * 100)
+    backup()
+
+    opened = opened_paths(monkeypatch)
+    backup()
+    assert fpath not in opened
+
+    # paranoid reads and hashes it anyway, but finds the contents stored
+    backup(paranoid=True)
+    assert fpath in opened
+    versions_folder = os.path.join(dst, *os.path.abspath(fpath).split(os.sep)[1:])
+    assert len([name for name in os.listdir(versions_folder)
+                if os.path.isfile(os.path.join(versions_folder, name))]) == 1
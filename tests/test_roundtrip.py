@@ -0,0 +1,76 @@
+import glob
+import os
+
+import pytest
+
+import gitback
+from conftest import make_tree, tree_bytes, restored_root
+
+storages = ["file", "chunked", "packed"]
+codecs = [None, "auto", "stored", "deflate", "bz2", "lzma", "zstd"]
+
+
+def backup_and_recover(gb, tmp_path, **kwargs):
+    src = str(tmp_path / "src")
+    dst = str(tmp_path / "dst")
+    gb.backup_folder(sourceroot=src, destroot=dst, tempfolder=str(tmp_path / "tmp"), **kwargs)
+    assert gb.stats.errors == []
+    modes = set(row[0] for row in gb.get_index(dst).conn.execute("SELECT mode FROM versions"))
+    gb.close_indexes()
+    stats = gitback.GitBack.recover(dst, str(tmp_path / "out"), workers=2)
+    assert stats.errors == []
+    return tree_bytes(restored_root(str(tmp_path / "out"), src)), modes
+
+
+@pytest.mark.parametrize("storage", storages)
+@pytest.mark.parametrize("codec", codecs)
+def test_roundtrip(gb, tmp_path, storage, codec):
+    if codec is not None and codec != "auto" and not gitback.Codecs.available(codec):
+        pytest.skip("{0} is not installed".format(codec))
+    files = make_tree(str(tmp_path / "src"))
+    restored, modes = backup_and_recover(gb, tmp_path, storage=storage, codec_policy=codec)
+    assert restored == files
+    if storage != "file":
+        # the codec goes into the chunks and pack entries
+        assert storage in modes
+    elif codec == "stored":
+        assert modes == {"orig"}
+    elif codec in gitback.Codecs.exts:
+        assert codec in modes
+    else:
+        assert "zip" in modes
+
+
+@pytest.mark.parametrize("storage", storages)
+def test_roundtrip_pipeline(gb, tmp_path, storage):
+    files = make_tree(str(tmp_path / "src"))
+    restored, modes = backup_and_recover(gb, tmp_path, storage=storage, workers=3, write_workers=2)
+    assert restored == files
+    # every partial was renamed into place
+    partials = glob.glob(os.path.join(str(tmp_path / "dst"), "**", "*" + gitback.PARTIAL_EXT),
+                         recursive=True)
+    assert partials == []
+
+
+def test_roundtrip_compression_engine(gb, tmp_path):
+    files = make_tree(str(tmp_path / "src"))
+    restored, modes = backup_and_recover(gb, tmp_path, compress_processes=2, probe=False)
+    assert restored == files
+    assert "zip" in modes
+
+
+@pytest.mark.parametrize("storage", storages)
+def test_roundtrip_after_changes(gb, tmp_path, storage):
+    src = str(tmp_path / "src")
+    make_tree(src)
+    gb.backup_folder(sourceroot=src, destroot=str(tmp_path / "dst"),
+                     tempfolder=str(tmp_path / "tmp"), storage=storage)
+    with open(os.path.join(src, "notes.txt"), "ab") as fp:
+        fp.write(b"one more line\n")
+    with open(os.path.join(src, "sub", "large.dat"), "r+b") as fp:
+        fp.seek(1024 * 1024 + 10)
+        fp.write(b"changed in place")
+    os.remove(os.path.join(src, "tiny.txt"))
+    files = tree_bytes(src)
+    restored, modes = backup_and_recover(gb, tmp_path, storage=storage)
+    assert restored == files
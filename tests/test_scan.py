@@ -0,0 +1,46 @@
+import os
+
+import gitback
+from conftest import tree_bytes, restored_root
+
+
+def make_folders(root):
+    for relpath in ["top.txt", "keep/a.txt", "keep/deeper/b.txt", "skip/c.txt",
+                    "keep/skip/d.txt", "keep/skip/deeper/e.txt"]:
+        fpath = os.path.join(root, *relpath.split("/"))
+        os.makedirs(os.path.dirname(fpath), exist_ok=True)
+        with open(fpath, "wb") as fp:
+            fp.write(relpath.encode("UTF-8"))
+
+
+def test_excluded_folders_are_not_entered(tmp_path, monkeypatch):
+    src = str(tmp_path / "src")
+    make_folders(src)
+    scanned = []
+    scandir = os.scandir
+
+    def recording_scandir(path):
+        scanned.append(os.path.relpath(path, src))
+        return scandir(path)
+
+    monkeypatch.setattr(gitback.os, "scandir", recording_scandir)
+    found = {os.path.relpath(folder, src): sorted(entry.name for entry in entries)
+             for folder, entries in gitback.Utilities.scan_tree(src, exclude_folders=["skip"])}
+    assert found == {".": ["top.txt"],
+                     "keep": ["a.txt"],
+                     os.path.join("keep", "deeper"): ["b.txt"]}
+    assert sorted(scanned) == sorted(found)
+
+
+def test_backup_leaves_out_excluded_folders(gb, tmp_path):
+    src = str(tmp_path / "src")
+    dst = str(tmp_path / "dst")
+    make_folders(src)
+    gb.backup_folder(sourceroot=src, destroot=dst, tempfolder=str(tmp_path / "tmp"),
+                     exclude_folders=["skip"])
+    assert gb.stats.errors == []
+    gb.close_indexes()
+    stats = gitback.GitBack.recover(dst, str(tmp_path / "out"))
+    assert stats.errors == []
+    assert sorted(tree_bytes(restored_root(str(tmp_path / "out"), src))) == \
+        ["keep/a.txt", "keep/deeper/b.txt", "top.txt"]
@@ -0,0 +1,73 @@
+import os
+import threading
+
+import gitback
+
+
+def test_read_job(tmp_path):
+    path = str(tmp_path / "Sync1.ini.py")
+    with open(path, "w") as fp:
+        fp.write("[Params]\nFrom = K:\\testing1; K:\\testing2\nTo = E: \\\nFreq = 2\n"
+                 "Total_time = 5\nExclude_exts = .tmp;.bak\n")
+    job = gitback.BackupScheduler.read_job(path)
+    assert job.name == "Sync1"
+    assert job.folders == ["K:\\testing1", "K:\\testing2"]
+    assert (job.dest_drive, job.dest_folder) == ("E:\\", "backup")
+    assert (job.freq_seconds, job.total_seconds) == (120, 300)
+    assert job.exclude_exts == [".tmp", ".bak"]
+
+
+def test_busy_job_is_skipped(gb, tmp_path, monkeypatch):
+    src = str(tmp_path / "src")
+    os.makedirs(src)
+    path = str(tmp_path / "job.ini")
+    with open(path, "w") as fp:
+        fp.write("[Params]\nFrom = {0}\nTo = {1}\nFreq = 1\nUnits = seconds\n".format(
+            src, str(tmp_path / "dst")))
+    started = threading.Event()
+    release = threading.Event()
+
+    def slow_backup(**kwargs):
+        started.set()
+        release.wait(10)
+
+    monkeypatch.setattr(gb, "backup_folders", slow_backup)
+    scheduler = gitback.BackupScheduler([path], gitback=gb, temp_folder=str(tmp_path / "tmp"))
+    job = scheduler.jobs[0]
+    assert scheduler.start_job(job)
+    assert started.wait(10)
+    # due again while the first run is still going
+    assert not scheduler.start_job(job)
+    release.set()
+    scheduler.threads[job.name].join()
+    assert scheduler.start_job(job)
+    scheduler.threads[job.name].join()
+    assert scheduler.stats.counts["runs"] == 2
+    assert scheduler.stats.counts["skipped"] == 1
+    assert scheduler.stats.errors == []
+
+
+def test_jobs_keep_their_own_stats(gb, tmp_path):
+    paths = []
+    for name, nfiles in [("one", 2), ("two", 5)]:
+        src = tmp_path / "src_{0}".format(name)
+        src.mkdir()
+        for i in range(nfiles):
+            (src / "f{0}.txt".format(i)).write_bytes(b"%s %d\n" % (name.encode(), i) * 100)
+        path = str(tmp_path / "{0}.ini".format(name))
+        with open(path, "w") as fp:
+            fp.write("[Params]\nFrom = {0}\nTo = {1}\nFreq = 1\nUnits = seconds\n".format(
+                src, str(tmp_path / "dst")))
+        paths.append(path)
+    scheduler = gitback.BackupScheduler(paths, gitback=gb, temp_folder=str(tmp_path / "tmp"))
+    # both at once, into the same backup root
+    for job in scheduler.jobs:
+        assert scheduler.start_job(job)
+    for thread in scheduler.threads.values():
+        thread.join()
+    assert scheduler.stats.counts["runs"] == 2
+    assert scheduler.stats.errors == []
+    for job, nfiles in zip(scheduler.jobs, [2, 5]):
+        assert scheduler.job_gitback(job).stats.counts["files"] == nfiles
+    temp_folders = set(scheduler.job_temp_folder(job) for job in scheduler.jobs)
+    assert len(temp_folders) == 2
@@ -0,0 +1,60 @@
+import gzip
+import io
+import os
+import random
+import zipfile
+
+import pytest
+
+import gitback
+
+
+def zip_bytes():
+    buf = io.BytesIO()
+    with zipfile.ZipFile(buf, "w") as zfile:
+        zfile.writestr("a.txt", "hello")
+    return buf.getvalue()
+
+
+@pytest.mark.parametrize("header,label", [
+    (b"\x89PNG\r\n\x1a\n" + b"\x00" * 100, "media"),
+    (b"\xff\xd8\xff\xe0" + bytes(range(256)), "media"),
+    (b"\x00\x00\x00\x18ftypmp42", "media"),
+    (zip_bytes(), "archive"),
+    (gzip.compress(b"some text"), "archive"),
+    (b"\x7fELF\x02\x01\x01" + b"\x00" * 50, "executable"),
+    (b"plain ascii text\nwith lines\n", "text"),
+    ("accents é and ü, in utf-8\n".encode("utf-8"), "text"),
+    (b"\xef\xbb\xbfa bom first", "text"),
+    (b"", "text"),
+    (b"some text\x00with a nul", "binary"),
+    (random.Random(1).randbytes(4096), "binary"),
+])
+def test_classify_bytes(header, label):
+    assert gitback.FileSniffer.classify_bytes(header) == label
+
+
+def test_multibyte_character_cut_by_the_header(tmp_path):
+    data = "é".encode("utf-8") * gitback.FileSniffer.header_size
+    # the header ends inside a two byte character
+    data = b"x" + data
+    fpath = tmp_path / "cut.txt"
+    fpath.write_bytes(data)
+    assert gitback.FileSniffer.classify(str(fpath)) == "text"
+
+
+def test_media_is_stored_without_compressing(gb, tmp_path):
+    src = tmp_path / "src"
+    src.mkdir()
+    body = b"compresses well " * 4096
+    # named as something else: the header decides, not the extension
+    (src / "picture.dat").write_bytes(b"\x89PNG\r\n\x1a\n" + body)
+    (src / "notes.dat").write_bytes(body)
+    dst = str(tmp_path / "dst")
+    gb.backup_folder(sourceroot=str(src), destroot=dst, tempfolder=str(tmp_path / "tmp"),
+                     codec_policy="auto")
+    assert gb.stats.errors == []
+    rows = gb.get_index(dst).conn.execute("SELECT sourcepath, mode FROM versions")
+    modes = dict((os.path.basename(path), mode) for path, mode in rows)
+    assert modes["picture.dat"] == "orig"
+    assert modes["notes.dat"] != "orig"
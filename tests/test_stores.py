@@ -0,0 +1,106 @@
+import concurrent.futures
+import glob
+import hashlib
+import os
+import threading
+
+import pytest
+
+import gitback
+from conftest import tree_bytes, restored_root
+
+workers = 8
+
+
+def chunks(n=20):
+    datas = [b"chunk %d " % i * (100 + i) for i in range(n)]
+    return [(hashlib.sha256(data).hexdigest(), data) for data in datas]
+
+
+def put_from_threads(put, items, check):
+    """
+    every thread puts every item, all starting together, and checks
+    with check(key, data) that it is there as soon as put returns
+
+    :return: bytes written per key, by thread
+    """
+    barrier = threading.Barrier(workers)
+
+    def run():
+        barrier.wait()
+        results = []
+        for key, data in items:
+            results.append((key, put(key, data)))
+            check(key, data)
+        return results
+
+    written = {}
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as pool:
+        for results in pool.map(lambda _: run(), range(workers)):
+            for key, nbytes in results:
+                written.setdefault(key, []).append(nbytes)
+    return written
+
+
+def test_packstore_concurrent_put(tmp_path):
+    index = gitback.BackupIndex(str(tmp_path))
+    packs = gitback.PackStore(str(tmp_path), index)
+    items = chunks()
+
+    def check(key, data):
+        assert index.find_pack_entry(key) is not None
+        assert packs.get(key) == data
+
+    written = put_from_threads(packs.put, items, check)
+    packs.close()
+    for key, data in items:
+        # written by one thread, found stored by the others
+        assert sum(1 for nbytes in written[key] if nbytes > 0) == 1
+        assert index.find_pack_entry(key) is not None
+        assert packs.get(key) == data
+    entries = [entry for packpath in glob.glob(os.path.join(packs.root, "*" + gitback.PackStore.pack_ext))
+               for entry in gitback.PackStore.scan(packpath)]
+    assert sorted(entry[3] for entry in entries) == sorted(key for key, _ in items)
+    index.close()
+
+
+@pytest.mark.parametrize("with_packs", [False, True])
+def test_chunkstore_concurrent_put(tmp_path, with_packs):
+    index = gitback.BackupIndex(str(tmp_path))
+    packs = gitback.PackStore(str(tmp_path), index) if with_packs else None
+    store = gitback.ChunkStore(str(tmp_path), index=index, packs=packs)
+    items = chunks()
+
+    def check(key, data):
+        assert store.get(key) == data
+
+    written = put_from_threads(store.put, items, check)
+    if packs is not None:
+        packs.close()
+    for key, data in items:
+        assert sum(1 for nbytes in written[key] if nbytes > 0) == 1
+        assert store.get(key) == data
+    if not with_packs:
+        stored = [path for path in glob.glob(os.path.join(store.root, "**", "*"), recursive=True)
+                  if os.path.isfile(path)]
+        assert len(stored) == len(items)
+    index.close()
+
+
+@pytest.mark.parametrize("storage", ["chunked", "packed"])
+def test_backup_identical_files_concurrently(gb, tmp_path, storage):
+    src = str(tmp_path / "src")
+    dst = str(tmp_path / "dst")
+    for d in range(8):
+        os.makedirs(os.path.join(src, "d{0}".format(d)))
+        for f in range(25):
+            with open(os.path.join(src, "d{0}".format(d), "f{0}.txt".format(f)), "wb") as fp:
+                fp.write(b"same %d\n" % (f % 3) * 100)
+    files = tree_bytes(src)
+    gb.backup_folder(sourceroot=src, destroot=dst, tempfolder=str(tmp_path / "tmp"),
+                     storage=storage, chunk_size=512, workers=workers)
+    assert gb.stats.errors == []
+    gb.close_indexes()
+    stats = gitback.GitBack.recover(dst, str(tmp_path / "out"), workers=4)
+    assert stats.errors == []
+    assert tree_bytes(restored_root(str(tmp_path / "out"), src)) == files
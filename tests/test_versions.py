@@ -0,0 +1,63 @@
+import concurrent.futures
+import os
+
+import pytest
+
+import gitback
+from conftest import tree_bytes, restored_root
+
+
+def test_nowshortstr_sorts_and_never_repeats():
+    stamps = [gitback.Utilities.nowshortstr() for _ in range(5000)]
+    assert stamps == sorted(stamps)
+    assert len(set(stamps)) == len(stamps)
+
+
+def test_nowshortstr_unique_across_threads():
+    with concurrent.futures.ThreadPoolExecutor(max_workers=4) as pool:
+        lists = list(pool.map(lambda _: [gitback.Utilities.nowshortstr() for _ in range(2000)],
+                              range(4)))
+    stamps = [stamp for stamps in lists for stamp in stamps]
+    assert len(set(stamps)) == len(stamps)
+    for stamps in lists:
+        assert stamps == sorted(stamps)
+
+
+@pytest.mark.parametrize("storage", ["file", "packed"])
+def test_versions_in_backup_order(gb, tmp_path, storage):
+    src = str(tmp_path / "src")
+    dst = str(tmp_path / "dst")
+    os.makedirs(src)
+    fpath = os.path.join(src, "notes.txt")
+    contents = [b"version %d\n" % i * (10 + i) for i in range(5)]
+    for data in contents:
+        with open(fpath, "wb") as fp:
+            fp.write(data)
+        # several runs within one second, the stamps still have to sort
+        gb.backup_folder(sourceroot=src, destroot=dst, tempfolder=str(tmp_path / "tmp"),
+                         storage=storage)
+        assert gb.stats.errors == []
+
+    index = gb.get_index(dst)
+    rows = index.versions(fpath)
+    versions = [row[0] for row in rows]
+    assert versions == sorted(versions)
+    assert len(set(versions)) == len(contents)
+    for i, (version, sha256, size, mode, stored_path, ctime, mtime) in enumerate(rows):
+        outpath = str(tmp_path / "v{0}".format(i))
+        gitback.GitBack.restore_version(index.abspath(stored_path), mode, outpath,
+                                        destroot=dst, sha256=sha256)
+        with open(outpath, "rb") as fp:
+            assert fp.read() == contents[i]
+    assert index.current_version(fpath)["version"] == versions[-1]
+    gb.close_indexes()
+
+    snapshots = gitback.Snapshot.snapshot_paths(dst)
+    assert len(snapshots) == len(contents)
+    for i, snapshot in enumerate([None, snapshots[0]]):
+        out = str(tmp_path / "out{0}".format(i))
+        stats = gitback.GitBack.recover(dst, out, snapshot=snapshot)
+        assert stats.errors == []
+        # no snapshot given means the latest
+        expected = contents[-1] if snapshot is None else contents[0]
+        assert tree_bytes(restored_root(out, src)) == {"notes.txt": expected}
@@ -0,0 +1,71 @@
+import hashlib
+import os
+import sys
+import threading
+import time
+
+import pytest
+
+import gitback
+from conftest import tree_bytes, restored_root
+
+pytestmark = pytest.mark.skipif(not sys.platform.startswith("linux"), reason="inotify is Linux only")
+
+
+def wait_for(condition, timeout=20.0):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if condition():
+            return True
+        time.sleep(0.05)
+    return False
+
+
+def snapshot_hashes(dst):
+    paths = gitback.Snapshot.snapshot_paths(dst)
+    if len(paths) == 0:
+        return {}
+    header, records = gitback.Snapshot.load(paths[-1])
+    return {record["filepath"]: record["sha256"] for record in records}
+
+
+def test_watch_batch_stores_new_versions(gb, tmp_path):
+    src = str(tmp_path / "src")
+    dst = str(tmp_path / "dst")
+    os.makedirs(os.path.join(src, "sub"))
+    notes = os.path.join(src, "notes.txt")
+    with open(notes, "wb") as fp:
+        fp.write(b"first\n" * 100)
+    with open(os.path.join(src, "sub", "kept.txt"), "wb") as fp:
+        fp.write(b"kept\n" * 100)
+
+    stop = threading.Event()
+    watch = threading.Thread(target=gb.watch_folders,
+                             kwargs=dict(folders=[src], dest_drive=dst, dest_folder="",
+                                         temp_folder=str(tmp_path / "tmp"),
+                                         quiet_seconds=0.2, stop_event=stop))
+    watch.start()
+    try:
+        assert wait_for(lambda: notes in snapshot_hashes(dst))
+        nfiles = gb.stats.counts["files"]
+        with open(notes, "wb") as fp:
+            fp.write(b"second\n" * 100)
+        added = os.path.join(src, "sub", "added.txt")
+        with open(added, "wb") as fp:
+            fp.write(b"added\n" * 100)
+        # the batch rewrites the latest snapshot with the new versions
+        assert wait_for(lambda: snapshot_hashes(dst).get(notes)
+                        == hashlib.sha256(b"second\n" * 100).hexdigest()
+                        and added in snapshot_hashes(dst))
+    finally:
+        stop.set()
+        watch.join()
+
+    # the full pass and the batch add up, in one journal
+    assert gb.stats.counts["files"] == nfiles + 2
+    assert gb.stats.errors == []
+    assert len(gitback.RunJournal.journal_paths(dst)) == 1
+    gb.close_indexes()
+    stats = gitback.GitBack.recover(dst, str(tmp_path / "out"))
+    assert stats.errors == []
+    assert tree_bytes(restored_root(str(tmp_path / "out"), src)) == tree_bytes(src)
@@ -0,0 +1,103 @@
+import io
+import random
+import zipfile
+import zlib
+
+import pytest
+
+import gitback
+from conftest import text_bytes
+
+sizes = [0, 1, 1000, 300 * 1024, 3 * 1024 * 1024]
+
+
+def file_data(size, compressible=True):
+    rng = random.Random(size)
+    return text_bytes(rng, size) if compressible else rng.randbytes(size)
+
+
+def check_zip(zippath_or_fp, srcpath, data):
+    # the entry is named as ZipInfo.from_file names it
+    name = zipfile.ZipInfo.from_file(srcpath).filename
+    with zipfile.ZipFile(zippath_or_fp) as zfile:
+        assert zfile.testzip() is None
+        infos = zfile.infolist()
+        assert [info.filename for info in infos] == [name]
+        assert infos[0].compress_type == zipfile.ZIP_DEFLATED
+        assert infos[0].file_size == len(data)
+        assert infos[0].CRC == zlib.crc32(data)
+        assert zfile.read(name) == data
+
+
+@pytest.mark.parametrize("size", sizes)
+def test_zip_entry_writer(tmp_path, size):
+    data = file_data(size)
+    src = tmp_path / "data.txt"
+    src.write_bytes(data)
+    buf = io.BytesIO()
+    writer = gitback.ZipEntryWriter(buf, zipfile.ZipInfo.from_file(str(src)))
+    comp = zlib.compressobj(6, zlib.DEFLATED, -15)
+    # written in pieces, as the streaming paths do
+    for pos in range(0, len(data), 64 * 1024):
+        writer.write(comp.compress(data[pos:pos + 64 * 1024]))
+    writer.write(comp.flush())
+    writer.close(zlib.crc32(data), len(data))
+    check_zip(io.BytesIO(buf.getvalue()), str(src), data)
+
+
+@pytest.mark.parametrize("size", sizes)
+@pytest.mark.parametrize("compressible", [True, False])
+def test_stream_zip(tmp_path, size, compressible):
+    data = file_data(size, compressible)
+    src = tmp_path / "data.bin"
+    src.write_bytes(data)
+    zippath = str(tmp_path / "data.zip")
+    orig_size, comp_size = gitback.Utilities.stream_zip(str(src), zippath, bufsize=256 * 1024)
+    assert orig_size == len(data)
+    check_zip(zippath, str(src), data)
+
+
+@pytest.mark.parametrize("size", sizes[:4])
+def test_encode_small(tmp_path, size):
+    data = file_data(size)
+    src = tmp_path / "data.txt"
+    src.write_bytes(data)
+    zippath = str(tmp_path / "data.zip")
+    rawpath = str(tmp_path / "data.raw")
+    # a threshold nothing misses, so even one byte is zipped
+    orig_size, comp_size, zipped = gitback.Utilities.encode_small(str(src), zippath, rawpath,
+                                                                  comp_thresh=1000)
+    assert zipped == (size > 0)
+    if zipped:
+        check_zip(zippath, str(src), data)
+
+
+def test_zip_file_compression_engine(tmp_path):
+    data = file_data(9 * 1024 * 1024)
+    src = tmp_path / "data.txt"
+    src.write_bytes(data)
+    zippath = str(tmp_path / "data.zip")
+    with gitback.CompressionEngine(processes=2, chunk_size=1024 * 1024) as engine:
+        engine.zip_file(str(src), zippath)
+    check_zip(zippath, str(src), data)
+
+
+@pytest.mark.parametrize("compressible", [True, False])
+def test_probe_decides_orig_or_zip(tmp_path, compressible):
+    data = file_data(1024 * 1024, compressible)
+    src = tmp_path / "data.bin"
+    src.write_bytes(data)
+    ratio = gitback.Utilities.probe_compressibility(str(src))
+    assert (ratio < 0.5) if compressible else (ratio > 0.95)
+    tempfolder = tmp_path / "tmp"
+    tempfolder.mkdir()
+    zippath, mode, ext = gitback.GitBack.zipped_or_orig(sourcepath=str(src),
+                                                         tempfolder=str(tempfolder),
+                                                         comp_thresh=0.9)
+    if compressible:
+        assert mode == "zip"
+        check_zip(zippath, str(src), data)
+    else:
+        # decided from the sampled blocks, nothing was zipped
+        assert (zippath, mode) == (None, "orig")
+        assert list(tempfolder.iterdir()) == []